@@ -58,6 +58,11 @@ if path != "/":  # Output folder must have been selected
         # Get the token
         token = get_token(sts, path, client_id, client_secret)
         
+        # The list of study sites is shared between the functions below, so it is not retrieved for every action
+        # Sites and role assignments are also kept between runs if the output folder has a metadata store (option 8)
+        store = open_store(path + "metadata.db", api, client_id) if os.path.exists(path + "metadata.db") else None
+        sitecache = new_site_cache(store = store)
+        
     except:
         print("Unable to save a log file to the selected output folder. Select a folder where you have write permission.")
         token = ""  # If writing to log failed, save an empty token, so further code won't run.
@@ -67,29 +72,64 @@ else: token = ""
 userInput = None
 while(userInput != "0" and token != ""):  # Allow user input if a token exists and until 0 is entered
     print("Please select what you want to do:\n1: Get an Excel export with all study sites\n2: Get an Excel export with all study users")
-    print("3: Create sites from Excel file\n4: Create users from Excel file\n0: End this program")
+    print("3: Create sites from Excel file\n4: Create users from Excel file")
+    print("5: Plan site import from Excel file (dry run)\n6: Plan user import from Excel file (dry run)")
+    print("7: Compare existing sites with Excel file (report only)\n8: Refresh the local metadata store\n0: End this program")
     userInput = input("Choose one of the above options: ")
     print("")
     if(userInput == "1"):
         writelog("User input: 1: Get an Excel export with all study sites.", path)
-        get_sites(token, api, path)
+        get_sites(token, api, path, sitecache = sitecache)
     elif(userInput == "2"):
         writelog("User input: 2: Get an Excel export with all study users.", path)
-        get_users(token, api, path)
+        # An incremental export reuses the roles of unchanged users from the snapshot in the output folder
+        incremental = input("Only retrieve the roles of users that changed since the previous export (incremental)? (Y/N): ").strip().upper() == "Y"
+        writelog("Incremental export: " + ("Yes" if incremental else "No") + ".", path, disp = False)
+        get_users(token, api, path, incremental = incremental, sitecache = sitecache)
     elif(userInput== "3"):
         writelog("User input: 3: Create sites from Excel file.", path)
         # Select the Excel file in a dialog window
         print("Select the Excel file containing the site details to import.")
         excelfile = askopenfilename(title = "Select the Excel file to import", parent = root)
         writelog("Selected Excel: " + excelfile, path)
-        create_sites(token, api, path, excelfile)
+        create_sites(token, api, path, excelfile, sitecache = sitecache)
     elif(userInput== "4"):
         writelog("User input: 4: Create users from Excel file.", path)
         # Select the Excel file in a dialog window
         print("Select the Excel file containing the user details to import.")
         excelfile = askopenfilename(title = "Select the Excel file to import", parent = root)
         writelog("Selected Excel: " + excelfile, path)
-        create_users(token, api, path, excelfile)
+        # Checking the existing roles retrieves the roles of every user in the file, so it is only done when requested
+        skipexisting = input("Skip rows for roles the users already have? This first retrieves the roles of the users in the file (Y/N): ").strip().upper() == "Y"
+        writelog("Skip existing role assignments: " + ("Yes" if skipexisting else "No") + ".", path, disp = False)
+        create_users(token, api, path, excelfile, sitecache = sitecache, skipexisting = skipexisting)
+    elif(userInput== "5"):
+        writelog("User input: 5: Plan site import from Excel file (dry run).", path)
+        # Select the Excel file in a dialog window
+        print("Select the Excel file containing the site details to plan.")
+        excelfile = askopenfilename(title = "Select the Excel file to plan", parent = root)
+        writelog("Selected Excel: " + excelfile, path)
+        plan_sites(token, api, path, excelfile, sitecache = sitecache)
+    elif(userInput== "6"):
+        writelog("User input: 6: Plan user import from Excel file (dry run).", path)
+        # Select the Excel file in a dialog window
+        print("Select the Excel file containing the user details to plan.")
+        excelfile = askopenfilename(title = "Select the Excel file to plan", parent = root)
+        writelog("Selected Excel: " + excelfile, path)
+        plan_users(token, api, path, excelfile, sitecache = sitecache)
+    elif(userInput== "7"):
+        writelog("User input: 7: Compare existing sites with Excel file.", path)
+        # Select the Excel file in a dialog window
+        print("Select the Excel file containing the site details to compare.")
+        excelfile = askopenfilename(title = "Select the Excel file to compare", parent = root)
+        writelog("Selected Excel: " + excelfile, path)
+        compare_sites(token, api, path, excelfile, sitecache = sitecache)
+    elif(userInput== "8"):
+        writelog("User input: 8: Refresh the local metadata store.", path)
+        # Create the metadata store in the output folder on first use
+        if(sitecache["store"] is None):
+            sitecache["store"] = open_store(path + "metadata.db", api, client_id)
+        refresh_store(token, api, path, sitecache)
     elif(userInput == "0"): print("")
     else: print("Not a valid option.\n")
 try:
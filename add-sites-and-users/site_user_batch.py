@@ -0,0 +1,180 @@
+import argparse
+import contextlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from site_user_import.profiling import start_profile, stop_profile, profile_summary
+from site_user_import.site_user_functions import get_server, get_token, create_sites, create_users, plan_sites, plan_users, new_site_cache, open_store, writelog
+
+
+def read_manifest(manifestfile):
+    """
+    Reads the batch manifest with one row per study, and checks that the server of every study is known
+    before any study is started.
+    Args:
+        manifestfile (str): Path to the Excel or CSV manifest.
+    Returns:
+        (list): One dict per study.
+    Raises:
+        ValueError: If required columns are missing, or a study has neither tokenUrl and apiUrl nor a server option 1-10.
+    """
+    if manifestfile.lower().endswith(".csv"):
+        studies = pd.read_csv(manifestfile, dtype = str)
+    else:
+        studies = pd.read_excel(manifestfile, dtype = str)
+    cols = ["study", "clientId", "clientSecret"]
+    if not all(value in studies.columns for value in cols):
+        raise ValueError("Invalid manifest layout. Required columns: " + ", ".join(cols) + ", and server or tokenUrl and apiUrl.")
+    # Blank cells are read as NaN; use empty strings so they can be checked with a simple truth test
+    for col in ["server", "tokenUrl", "apiUrl"]:
+        if col not in studies.columns:
+            studies[col] = ""
+    studies = studies.fillna("")
+    studies["server"] = studies["server"].str.strip()
+    # Option 11 (Other) of site_user_app.py asks for the URLs, which is not possible in a worker process
+    invalid = [str(x["study"]) for x in studies.to_dict("records")
+        if not (x["tokenUrl"] and x["apiUrl"]) and x["server"] not in [str(x) for x in range(1, 11)]]
+    if invalid:
+        raise ValueError("No valid server (1-10) or tokenUrl and apiUrl for studies: " + ", ".join(invalid) + ".")
+    return studies.to_dict("records")
+
+
+def study_folder(study, outputroot):
+    """
+    Returns the folder for the log file of a study, ending with a slash, and creates it if needed.
+    """
+    path = study.get("outputFolder") or os.path.join(outputroot, study["study"])
+    path = path.rstrip("/\\") + "/"
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def run_study(study, outputroot, dryrun = False, storefile = None, profile = False, skipexisting = False):
+    """
+    Runs the site and user imports for a single study. Executed in a worker process.
+    Args:
+        study (dict): Manifest row for the study.
+        outputroot (str): Folder in which a subfolder per study is created for the log file.
+        dryrun (bool): If True, only the import plans are created (see plan_sites and plan_users).
+        storefile (str): Optional SQLite file of the metadata store shared by all studies (see open_store).
+        profile (bool): If True, the study is profiled and the results are saved next to its log file (see stop_profile).
+        skipexisting (bool): If True, rows for roles the users already have are skipped (see create_users).
+    Returns:
+        (dict): Result summary for the study.
+    """
+    path = study_folder(study, outputroot)
+    # The functions also print their log messages. In a worker process these would mix with those of the
+    # other studies in one console, so they are only written to the log file of the study
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if not profile:
+            return import_study(study, path, dryrun, storefile, skipexisting)
+        running = start_profile()
+        try:
+            return import_study(study, path, dryrun, storefile, skipexisting)
+        finally:
+            stop_profile(running, path + "profile")
+
+
+def import_study(study, path, dryrun, storefile, skipexisting):
+    """
+    Runs the imports of a study for run_study, which describes the arguments. path is the folder of the log file.
+    """
+    summary = {"study": study["study"], "log": path + "log.txt", "token": "Failed",
+        "sitesCreated": None, "sitesFailed": "", "usersAdded": None, "usersFailed": "", "usersSkipped": ""}
+
+    # Use explicit URLs if given, otherwise the server option as in site_user_app.py (1-10)
+    if study.get("tokenUrl") and study.get("apiUrl"):
+        sts, api = study["tokenUrl"], study["apiUrl"]
+    else:
+        sts, api = get_server(study["server"])
+
+    writelog("Batch import for study " + study["study"] + ". Obtaining token from " + sts, path, disp = False, option = "firstentry")
+    token = get_token(sts, path, study["clientId"], study["clientSecret"])
+    if not token:
+        return summary
+    summary["token"] = "Success"
+    sitecache = new_site_cache(store = open_store(storefile, api, study["study"]) if storefile else None)
+
+    # For a dry run, only save the plans; the sites are not created, so the users plan is based on the existing sites
+    if dryrun:
+        if study.get("sitesExcel"):
+            plan = plan_sites(token, api, path, study["sitesExcel"], sitecache = sitecache)
+            summary["sitesCreated"] = None if plan is None else int((plan["action"] == "create").sum())
+        if study.get("usersExcel"):
+            plan = plan_users(token, api, path, study["usersExcel"], sitecache = sitecache)
+            summary["usersAdded"] = None if plan is None else int((plan["action"] == "create").sum())
+        writelog("Batch dry run ended.", path, disp = False)
+        return summary
+    
+    # Sites are created first, so that users can be invited to the new sites
+    if study.get("sitesExcel"):
+        writelog("Selected Excel: " + study["sitesExcel"], path, disp = False)
+        result = create_sites(token, api, path, study["sitesExcel"], sitecache = sitecache)
+        if result is not None:
+            summary["sitesCreated"] = result["sitesCreated"]
+            summary["sitesFailed"] = ", ".join(str(x) for x in result["failed"] + result["notinvited"])
+    if study.get("usersExcel"):
+        writelog("Selected Excel: " + study["usersExcel"], path, disp = False)
+        result = create_users(token, api, path, study["usersExcel"], sitecache = sitecache, skipexisting = skipexisting)
+        if result is not None:
+            summary["usersAdded"] = result["usersAdded"]
+            summary["usersFailed"] = ", ".join(str(x) for x in result["failed"])
+            summary["usersSkipped"] = ", ".join(str(x) for x in result["skipped"])
+    writelog("Batch import ended.", path, disp = False)
+    return summary
+
+
+def run_batch(manifestfile, outputroot, workers, dryrun = False, storefile = None, profile = False, skipexisting = False):
+    """
+    Runs the imports for all studies in the manifest concurrently and writes a combined report.
+    Args:
+        manifestfile (str): Path to the Excel or CSV manifest.
+        outputroot (str): Folder for the study subfolders and the combined report.
+        workers (int): Number of studies imported at the same time.
+        dryrun (bool): If True, only the import plans are created. The report then lists the rows to be created.
+        storefile (str): Optional SQLite file of the metadata store shared by all studies (see open_store).
+        profile (bool): If True, each study is profiled, and the hotspots of all studies together are
+            printed and saved as profile_hotspots.txt in the output folder.
+        skipexisting (bool): If True, rows for roles the users already have are skipped (see create_users).
+    Returns:
+        (DataFrame): The combined report, one row per study.
+    """
+    studies = read_manifest(manifestfile)
+    print("Importing " + str(len(studies)) + " studies using " + str(workers) + " worker processes.")
+    summaries = []
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(run_study, study, outputroot, dryrun, storefile, profile, skipexisting): study["study"] for study in studies}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:  # An unexpected error in one study must not stop the others
+                summary = {"study": futures[future], "token": "Error: " + str(e)}
+            print("Study " + summary["study"] + " finished.")
+            summaries.append(summary)
+
+    report = pd.DataFrame(summaries).sort_values("study")
+    try:  # Using a try statement, as permission may be denied
+        report.to_excel(os.path.join(outputroot, "batch_report.xlsx"), index = False, sheet_name = "Report")
+        print("Combined report saved: " + os.path.join(outputroot, "batch_report.xlsx"))
+    except:
+        print("Unable to write Excel file. Permission denied.")
+    
+    # Combine the profiles of the studies, which are run in the worker processes
+    if profile:
+        files = [study_folder(study, outputroot) + "profile.prof" for study in studies]
+        print(profile_summary([x for x in files if os.path.exists(x)], os.path.join(outputroot, "profile_hotspots.txt")))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Viedoc site and user import for multiple studies")
+    parser.add_argument("--manifest", required = True, help = "Excel or CSV file with one row per study")
+    parser.add_argument("--output", required = False, default = ".", help = "Folder for the study logs and combined report")
+    parser.add_argument("--workers", required = False, default = 4, type = int, help = "Number of studies imported at the same time")
+    parser.add_argument("--dry_run", required = False, default = "N", choices = ["Y", "N"], help = "Only create the import plans (Y/N)")
+    parser.add_argument("--store", required = False, help = "SQLite file in which the sites and role assignments are kept between runs")
+    parser.add_argument("--profile", required = False, default = "N", choices = ["Y", "N"], help = "Profile each study and summarize the hotspots (Y/N)")
+    parser.add_argument("--skip_existing", required = False, default = "N", choices = ["Y", "N"], help = "Skip rows for roles the users already have (Y/N)")
+    args = parser.parse_args()
+    run_batch(args.manifest, args.output, args.workers, args.dry_run == "Y", args.store, args.profile == "Y", args.skip_existing == "Y")
@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import time
+
+
+def open_store(dbfile, url, study, ttl = 86400):
+    """
+    Opens the local metadata store, a SQLite file with the sites and role assignments of studies,
+    so that later runs can use them without retrieving them from the API again.
+    The file may hold several studies; all rows are keyed by API URL and study.
+    Args:
+        dbfile (str): Path to the SQLite file. It is created if it does not exist.
+        url (str): API URL obtained from Viedoc Admin.
+        study (str): Study key, e.g. the Client ID, as each API client belongs to a single study.
+        ttl (int): Number of seconds the stored data is used before it is retrieved from the API again.
+    Returns:
+        (dict): The store, to pass to new_site_cache.
+    """
+    db = sqlite3.connect(dbfile, timeout = 30)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS refreshes (url TEXT, study TEXT, kind TEXT, refreshed REAL, complete INTEGER,
+            PRIMARY KEY (url, study, kind));
+        CREATE TABLE IF NOT EXISTS sites (url TEXT, study TEXT, siteGuid TEXT, siteCode TEXT, siteName TEXT, site TEXT);
+        CREATE INDEX IF NOT EXISTS sites_siteCode ON sites (url, study, siteCode);
+        CREATE INDEX IF NOT EXISTS sites_siteName ON sites (url, study, siteName);
+        CREATE TABLE IF NOT EXISTS roles (url TEXT, study TEXT, userGuid TEXT, email TEXT COLLATE NOCASE, displayName TEXT,
+            roleOID TEXT, roleName TEXT, siteGuid TEXT);
+        CREATE INDEX IF NOT EXISTS roles_email ON roles (url, study, email);
+        CREATE INDEX IF NOT EXISTS roles_roleOID ON roles (url, study, roleOID);
+        """)
+    return {"db": db, "url": url, "study": study, "ttl": ttl}
+
+
+def store_age(store, kind, complete = False):
+    """
+    Returns the number of seconds since the sites or roles were stored, if they can still be used.
+    Args:
+        store (dict): The store from open_store, or None.
+        kind (str): "sites" or "roles".
+        complete (bool): Whether all details are needed. Sites and roles added by create_sites and
+            create_users only contain the details sent to the API.
+    Returns:
+        (float): The age. None if nothing is stored, the data is older than ttl, or it is not complete.
+    """
+    if store is None:
+        return None
+    row = store["db"].execute("SELECT refreshed, complete FROM refreshes WHERE url = ? AND study = ? AND kind = ?",
+        (store["url"], store["study"], kind)).fetchone()
+    if row is None or row[0] is None or time.time() - row[0] >= store["ttl"] or (complete and not row[1]):
+        return None
+    return time.time() - row[0]
+
+
+def set_refreshed(store, kind, refreshed, complete = True):
+    """
+    Records when the sites or roles were stored. refreshed None marks them as outdated.
+    """
+    store["db"].execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?, ?)",
+        (store["url"], store["study"], kind, refreshed, int(complete)))
+
+
+def save_stored_sites(store, sites):
+    """
+    Replaces the stored sites of the study with the sites as returned by /admin/studysites.
+    """
+    with store["db"]:
+        store["db"].execute("DELETE FROM sites WHERE url = ? AND study = ?", (store["url"], store["study"]))
+        store["db"].executemany("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?)",
+            [(store["url"], store["study"], x.get("siteGuid"), x.get("siteCode"), x.get("siteName"), json.dumps(x)) for x in sites])
+        set_refreshed(store, "sites", time.time())
+
+
+def add_stored_site(store, site):
+    """
+    Adds a created site to the stored sites. The stored sites are then no longer complete.
+    """
+    with store["db"]:
+        store["db"].execute("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?)",
+            (store["url"], store["study"], site.get("siteGuid"), site.get("siteCode"), site.get("siteName"), json.dumps(site)))
+        store["db"].execute("UPDATE refreshes SET complete = 0 WHERE url = ? AND study = ? AND kind = 'sites'", (store["url"], store["study"]))
+
+
+def load_stored_sites(store, siteCode = None, siteName = None):
+    """
+    Returns the stored sites of the study, as returned by /admin/studysites.
+    Args:
+        siteCode (str): Optional siteCode to look up.
+        siteName (str): Optional siteName to look up.
+    Returns:
+        (list): The sites.
+    """
+    query = "SELECT site FROM sites WHERE url = ? AND study = ?"
+    params = [store["url"], store["study"]]
+    for column, value in (("siteCode", siteCode), ("siteName", siteName)):
+        if value is not None:
+            query += " AND " + column + " = ?"
+            params.append(value)
+    return [json.loads(x[0]) for x in store["db"].execute(query, params)]
+
+
+def save_stored_roles(store, roles):
+    """
+    Replaces the stored role assignments of the study.
+    Args:
+        roles (list): One dict per user, role and site, with userGuid, email, displayName, roleOID, roleName
+            and siteGuid (None for roles without site). See role_records.
+    """
+    with store["db"]:
+        store["db"].execute("DELETE FROM roles WHERE url = ? AND study = ?", (store["url"], store["study"]))
+        store["db"].executemany("INSERT INTO roles VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(store["url"], store["study"], x["userGuid"],
+            x["email"], x["displayName"], x["roleOID"], x["roleName"], x["siteGuid"]) for x in roles])
+        set_refreshed(store, "roles", time.time())
+
+
+def add_stored_role(store, email, roleOID, siteGuid = None):
+    """
+    Adds an assigned role to the stored role assignments. The stored roles are then no longer complete.
+    """
+    with store["db"]:
+        store["db"].execute("INSERT INTO roles (url, study, email, roleOID, siteGuid) VALUES (?, ?, ?, ?, ?)",
+            (store["url"], store["study"], email, roleOID, siteGuid))
+        store["db"].execute("UPDATE refreshes SET complete = 0 WHERE url = ? AND study = ? AND kind = 'roles'", (store["url"], store["study"]))
+
+
+def load_stored_roles(store, email = None, roleOID = None):
+    """
+    Returns the stored role assignments of the study.
+    Args:
+        email (str): Optional email to look up.
+        roleOID (str): Optional roleOID to look up.
+    Returns:
+        (list): One dict per user, role and site, see save_stored_roles.
+    """
+    query = "SELECT userGuid, email, displayName, roleOID, roleName, siteGuid FROM roles WHERE url = ? AND study = ?"
+    params = [store["url"], store["study"]]
+    for column, value in (("email", email), ("roleOID", roleOID)):
+        if value is not None:
+            query += " AND " + column + " = ?"
+            params.append(value)
+    cursor = store["db"].execute(query, params)
+    columns = [x[0] for x in cursor.description]
+    return [dict(zip(columns, x)) for x in cursor]
+
+
+def invalidate_store(store, kinds = ("sites", "roles")):
+    """
+    Marks the stored sites and/or roles as outdated, so that they are retrieved from the API again.
+    """
+    with store["db"]:
+        for kind in kinds:
+            set_refreshed(store, kind, None)
@@ -0,0 +1,149 @@
+import difflib
+import functools
+import re
+from types import MappingProxyType
+import pandas as pd
+from site_user_import.timezones import tz_conversion
+
+
+def fold(x):
+    """
+    Returns the lookup key of a value: lowercase, without leading, trailing or repeated whitespace.
+    """
+    return re.sub(r"\s+", " ", str(x)).strip().casefold()
+
+
+# Role names of the system roles, which may be used instead of the roleOID in the import file
+sysRoles = MappingProxyType({
+    "study manager": "RoleStudyManager",
+    "site manager": "RoleSiteManager",
+    "api manager": "ApiManager",
+    "designer": "RoleDesigner",
+    "unblinded statistician": "UnblindedStatistician",
+    "dictionary manager": "DictionaryManager",
+    "reference data source manager": "RefDataSourceManager",
+    "etmf manager": "EtmfManager",
+    "design impact analyst": "DesignImpactAnalyst"})
+systemRoles = frozenset(sysRoles.values())
+# System roles that are assigned to the study rather than to a site
+studyRoles = systemRoles - {"RoleSiteManager"}
+# Role names and roleOIDs of the system roles, in any case, to the roleOID
+roleAliases = MappingProxyType({**{fold(x): x for x in systemRoles}, **sysRoles})
+
+# Values accepted for isTrainingEnabled and isProductionEnabled
+booleans = MappingProxyType({**{x: "True" for x in ["true", "t", "yes", "y", "1"]},
+    **{x: "False" for x in ["false", "f", "no", "n", "0"]}})
+
+# Viedoc labels, short forms and API ids of the timezones, in any case, to the API id
+timezoneIds = MappingProxyType({**{fold(x): x for x in tz_conversion.values()}, **{fold(k): v for k, v in tz_conversion.items()}})
+_labelPattern = re.compile(r"^\(utc(?:([+-])(\d\d):(\d\d))?\) (.+)$")
+
+
+def _timezone_fallbacks():
+    """
+    Builds the fallback tables of the timezones from the Viedoc labels:
+    the label without its offset, each unique place name in a label, and the offset itself.
+    An offset is only converted if it identifies a timezone: the fixed-offset API id (such as UTC-11)
+    if there is one, otherwise the only timezone with that offset.
+    """
+    places, offsets = {}, {}
+    if "UTC" in tz_conversion.values():
+        offsets[("+", 0, 0)] = {"UTC"}
+    ambiguous = set()
+    for label, tzid in tz_conversion.items():
+        match = _labelPattern.match(fold(label))
+        if not match:
+            continue
+        sign, hours, minutes, names = match.groups()
+        places[names] = tzid
+        for place in names.split(", "):
+            if place in places and places[place] != tzid:
+                ambiguous.add(place)
+            places[place] = tzid
+        offsets.setdefault((sign or "+", int(hours or 0), int(minutes or 0)), set()).add(tzid)
+    for place in ambiguous:
+        del places[place]
+    for offset, tzids in list(offsets.items()):
+        fixed = [x for x in tzids if re.match(r"^UTC([+-]\d\d)?$", x)]
+        if fixed:
+            offsets[offset] = fixed[0]
+        elif len(tzids) == 1:
+            offsets[offset] = tzids.pop()
+        else:
+            del offsets[offset]
+    # API ids may also be given without " Standard Time"
+    for tzid in tz_conversion.values():
+        if fold(tzid).endswith(" standard time"):
+            places.setdefault(fold(tzid)[:-len(" standard time")], tzid)
+    return MappingProxyType(places), MappingProxyType(offsets)
+
+
+timezonePlaces, timezoneOffsets = _timezone_fallbacks()
+_offsetPattern = re.compile(r"^(?:\(?(?:utc|gmt))?\s*([+-])(\d{1,2})(?::?(\d\d))?\)?$")
+
+
+@functools.lru_cache(maxsize = None)
+def normalize_timezone(value):
+    """
+    Converts a timezone, in any of the formats below, to the API id. The first match is used:
+    (1) the Viedoc label, a short form or the API id, in any case (see timezones.py),
+    (2) the label without its offset, a single place name of a label, or the API id without 'Standard Time',
+    (3) an offset such as 'UTC-11:00', 'GMT+4:30' or '+0430', if it identifies a single timezone.
+    Misspelled values are not converted, as a close spelling may be another timezone (see timezone_candidates).
+    Returns:
+        (str): The API id. None if the timezone is not recognized.
+    """
+    if pd.isnull(value):
+        return None
+    key = fold(value)
+    if key in timezoneIds:
+        return timezoneIds[key]
+    if key in timezonePlaces:
+        return timezonePlaces[key]
+    match = _offsetPattern.match(key.replace(" ", ""))
+    if match:
+        sign, hours, minutes = match.groups()
+        return timezoneOffsets.get((sign, int(hours), int(minutes or 0)))
+    return None
+
+
+def timezone_candidates(value, n = 3):
+    """
+    Returns the API ids of the timezones with a spelling close to an unrecognized timezone, to suggest in the log.
+    They are never used for the import.
+    """
+    if pd.isnull(value):
+        return []
+    close = difflib.get_close_matches(fold(value), list(timezoneIds) + list(timezonePlaces), n = n, cutoff = 0.8)
+    return list(dict.fromkeys(timezoneIds.get(x) or timezonePlaces[x] for x in close))
+
+
+def normalize_boolean(value):
+    """
+    Converts values such as Yes, y, T or 1 to 'True' and No, n, F or 0 to 'False'. Other values are returned as they are.
+    """
+    if pd.isnull(value):
+        return value
+    return booleans.get(fold(value), value)
+
+
+def normalize_role(value):
+    """
+    Converts the role name or roleOID of a system role, in any case, to the roleOID. Other values are returned as they are.
+    """
+    if pd.isnull(value):
+        return value
+    return roleAliases.get(fold(value), value)
+
+
+def normalize_column(column, normalize):
+    """
+    Applies a normalize function to a DataFrame column. Each distinct value is converted only once.
+    Args:
+        column (Series): The column to convert.
+        normalize (function): normalize_timezone, normalize_boolean or normalize_role.
+    Returns:
+        (Series): The converted column, with the same index.
+    """
+    lookup = {x: normalize(x) for x in column.dropna().unique()}
+    return column.map(lookup)
@@ -4,7 +4,16 @@ import pandas as pd
 import datetime
 import os.path
 import re
-from site_user_import.timezones import tz_conversion
+import time
+import io
+import functools
+import openpyxl
+from site_user_import.normalization import systemRoles, studyRoles, normalize_timezone, normalize_boolean, normalize_role, normalize_column, timezone_candidates
+from site_user_import.metadata_store import (open_store, store_age, save_stored_sites, add_stored_site, load_stored_sites,
+    save_stored_roles, add_stored_role, load_stored_roles, invalidate_store)
+
+# Number of users requested per page from /admin/users
+usersPageSize = 500
 
 def get_server(Server):
     """
@@ -48,6 +57,8 @@ def get_server(Server):
         print("\nOther was selected. Manually provide the URLs.")
         sts = input("Provide the token URL from Admin: ")
         api = input("Provide the API URL from Admin: ")
+    else:
+        raise ValueError("Unknown server option: " + str(Server) + ".")
     return sts, api
 
 
@@ -81,163 +92,487 @@ def get_token(url, path, clientid, secret):
         return ""
 
 
-def get_sites(token, url, path):
+def get_sites(token, url, path, sitecache = None):
     """
     Retrieves sites from Viedoc and saves to Excel.
     Args:
         token (str): Authentication token obtained from the STS server.
         url (str): API URL obtained from Viedoc Admin.
         path (str): Path where the log and Excel file should be saved.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+    Returns:
+        (DataFrame): The study sites. None if unsuccessful or if no sites exist.
+    """
+    sites = load_sites(token, url, path, sitecache = sitecache)
+    if(sites is not None):
+        save_sites_excel(sites, path)
+    writelog("Returning to user input.", path, disp = False)
+    return sites
+
+
+def load_sites(token, url, path = None, session = None, sitecache = None):
+    """
+    Retrieves sites from Viedoc, without saving them. For use as a library.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str or function): Path where the log file should be saved, a function that receives the
+            log messages, or None for no logging (see writelog).
+        session (requests.Session): Optional session to reuse connections.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
     Returns:
-        None
+        (DataFrame): The study sites. None if unsuccessful or if no sites exist.
     """
     writelog("Retrieving list of study sites from " + url + "/admin/studysites.", path)
     
-    # Define the request headers and make the API call
-    header = {"Accept" : "application/json", "Authorization" : "Bearer " + token}
-    response = requests.get(url + "/admin/studysites", headers = header)
+    # Make the API call, or use the site cache; all site details are needed for the export
+    response = fetch_sites(token, url, path, sitecache, complete = True, session = session)
     
-    # Check the status code in the response
-    if(response.status_code == 200):
-        writelog("Status code: 200 - Success.", path)
-        
-        # Convert the response contents to a data frame; end this function if no sites exist
-        sites = pd.DataFrame(response.json())
-        if sites.empty:
-            writelog("No study sites were obtained\n", path)
-            return
-        
-        # Delete not needed columns
-        del sites["siteType"]
-        del sites["tzOffset"]
-        
-        # Write the output to Excel
-        try:  # Using a try statement, as permission may be denied
-            writer = pd.ExcelWriter(path + "export_studySites.xlsx", engine = "openpyxl")
-            sites.to_excel(writer, index = False, sheet_name = "Export")
-            ws = writer.sheets["Export"]
-            columnwidths = {"A": 37, "B": 10, "C": 15, "D": 60, "E": 10, "F": 25,
-                "G": 12, "H": 30, "I": 35, "J": 35, "K": 35, "L": 16, "M": 19}
-            for column in columnwidths.keys():  # Set the column widths in the Excel file
-                ws.column_dimensions[column].width = columnwidths[column]
-            writer.close()
-            writelog("Output saved: " + path + "export_studySites.xlsx.\n", path)
-        except:
-            writelog("Unable to write Excel file. Permission denied.\n", path)
-    
-    # If the status code indicates failure
-    elif(response.status_code == 403):
-        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
+    # Check whether the sites were obtained
+    if(response is None):
+        return
+    # Convert the response contents to a data frame; end this function if no sites exist
+    sites = pd.DataFrame(response)
+    if sites.empty:
+        writelog("No study sites were obtained\n", path)
         return
     
-    writelog("Returning to user input.", path, disp = False)
+    # Delete not needed columns
+    return sites.drop(columns = ["siteType", "tzOffset"], errors = "ignore")
 
 
-def get_users(token, url, path):
+def save_sites_excel(sites, path):
+    """
+    Saves the study sites from load_sites to export_studySites.xlsx.
+    """
+    try:  # Using a try statement, as permission may be denied
+        writer = pd.ExcelWriter(path + "export_studySites.xlsx", engine = "openpyxl")
+        sites.to_excel(writer, index = False, sheet_name = "Export")
+        ws = writer.sheets["Export"]
+        columnwidths = {"A": 37, "B": 10, "C": 15, "D": 60, "E": 10, "F": 25,
+            "G": 12, "H": 30, "I": 35, "J": 35, "K": 35, "L": 16, "M": 19}
+        for column in columnwidths.keys():  # Set the column widths in the Excel file
+            ws.column_dimensions[column].width = columnwidths[column]
+        writer.close()
+        writelog("Output saved: " + path + "export_studySites.xlsx.\n", path)
+    except:
+        writelog("Unable to write Excel file. Permission denied.\n", path)
+
+
+def get_users(token, url, path, incremental = False, sitecache = None, maxage = 86400):
     """
     Retrieves users from Viedoc and saves to Excel.
     Args:
         token (str): Authentication token obtained from the STS server.
         url (str): API URL obtained from Viedoc Admin.
         path (str): Path where the log and Excel file should be saved.
+        incremental (bool): If True, roles are only retrieved for users that are new, whose user info
+            changed since the previous run, or whose roles were last retrieved more than maxage seconds ago;
+            the roles of other users are taken from the snapshot saved by the previous run. A diff of added
+            and removed role assignments is saved. Delete snapshot_studyUsers.json to force a full refresh.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+        maxage (int): Number of seconds the roles of a user are taken from the snapshot. A role change that
+            does not change the user info (e.g. a role revoked at a site) is seen within this time.
     Returns:
-        None
+        (int): Number of rows (users, roles and sites) saved. None if unsuccessful.
     """
-    # Retrieve list of users from the API
-    writelog("Retrieving list of users from " + url + "/admin/users.", path)
-    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token, "Content-type" : "application/json" }
-    response = requests.post(url + "/admin/users",headers = header, json = {})
-    if(response.status_code == 200):
-        writelog("Status code: 200 - Success.", path)
-        response = response.json()
-    elif(response.status_code == 403):
-        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
+    # Load the snapshot of the previous run, if an incremental run was requested
+    snapshot = None
+    if incremental:
+        snapshot = load_users_snapshot(path)
+        writelog("Loaded snapshot with " + str(len(snapshot["users"])) + " users from " + path + "snapshot_studyUsers.json.", path)
+        previousExport = snapshot["export"]
+        # Role changes that do not change the user info are only seen when the roles are retrieved again
+        now = time.time()
+        stale = [x for x, user in snapshot["users"].items() if now - user.get("checked", 0) >= maxage]
+        for userGuid in stale:
+            del snapshot["users"][userGuid]
+        if stale:
+            writelog("Roles of " + str(len(stale)) + " users were retrieved more than " + str(maxage // 3600) + " hours ago and are retrieved again.", path)
+    
+    if not incremental:
+        # Write the rows of each user as soon as they are retrieved, so that memory use does not grow with the study
+        try:
+            count = save_users_excel(iter_user_rows(token, url, path, sitecache = sitecache), path)
+        except RuntimeError:
+            return
+        writelog("Returning to user input.", path, disp = False)
+        return count
+    
+    # The incremental run keeps all rows, for the snapshot and the diff
+    userExcel = load_users(token, url, path, sitecache = sitecache, snapshot = snapshot)
+    if(userExcel is None):
         return
+    count = save_users_excel(userExcel, path)
     
+    # Save the snapshot for the next run and write the changes since the previous run
+    try:  # Writing the files within try statement, as permission may be denied.
+        with open(path + "snapshot_studyUsers.json", "w") as f:
+            json.dump(snapshot, f)
+        if previousExport is not None:
+            diff = diff_role_assignments(pd.DataFrame(previousExport), userExcel)
+            diff.to_excel(path + "diff_studyUsers.xlsx", index = False, sheet_name = "Diff")
+            writelog(str((diff["change"] == "added").sum()) + " role assignments added and " + str((diff["change"] == "removed").sum()) + 
+                " removed since the previous run. Output saved: " + path + "diff_studyUsers.xlsx.\n", path)
+    except:
+        writelog("Unable to write snapshot or diff file. Permission denied.", path)
+    writelog("Returning to user input.", path, disp = False)
+    return count
+
+
+def load_users(token, url, path = None, session = None, sitecache = None, snapshot = None):
+    """
+    Retrieves users and their roles from Viedoc, without saving them. For use as a library.
+    All rows are held in memory; get_users writes them to Excel as they are retrieved instead (see iter_user_rows).
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str or function): Path where the log file should be saved, a function that receives the
+            log messages, or None for no logging (see writelog).
+        session (requests.Session): Optional session to reuse connections.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+        snapshot (dict): Optional snapshot of a previous run (see load_users_snapshot). The roles of users whose
+            user info did not change are taken from it, and it is updated to the users retrieved in this run.
+    Returns:
+        (DataFrame): One row per user, role and site. None if unsuccessful.
+    """
+    rows = [pd.DataFrame({x: [] for x in userColumns})]
+    try:
+        rows += list(iter_user_rows(token, url, path, session = session, sitecache = sitecache, snapshot = snapshot))
+    except RuntimeError:
+        return
+    users = pd.concat(rows)
+    if snapshot is not None:
+        snapshot["export"] = users.astype(str).to_dict("records")
+    return users
+
+
+def iter_user_rows(token, url, path = None, session = None, sitecache = None, snapshot = None):
+    """
+    Retrieves users and their roles from Viedoc, and yields the export rows of each user as soon as they are retrieved,
+    so that they can be written without holding all users in memory. The role assignments are saved in the
+    local metadata store, if used, once all users are retrieved.
+    Args:
+        See load_users.
+    Yields:
+        (DataFrame): The rows of one user, one per role and site.
+    Raises:
+        RuntimeError: If the users, sites or roles could not be retrieved. The reason is logged.
+    """
+    store = sitecache["store"] if sitecache is not None else None
+    storeRoles = []
+    for userInfo, userRoles, sites in iter_user_roles(token, url, path, session = session, sitecache = sitecache, snapshot = snapshot):
+        # Only the compact role records are kept for the store, not the rows of the export
+        if(store is not None):
+            storeRoles += role_records(userInfo, userRoles)
+        yield roles_to_rows(userRoles, userInfo, sites)
+    if(store is not None):
+        save_stored_roles(store, storeRoles)
+
+
+def iter_user_roles(token, url, path = None, session = None, sitecache = None, snapshot = None, emails = None):
+    """
+    Retrieves the users of the study and yields the roles of each user as soon as they are retrieved.
+    Args:
+        See load_users.
+        emails (set): Optional lowercase emails. If given, the roles are only retrieved for the users with these
+            emails, and only these users are yielded.
+    Yields:
+        (tuple): [0] The user entry from /admin/users, [1] the roles from /admin/users/{userGuid}/roles,
+            [2] the study sites (DataFrame), for the siteName and siteCode.
+    Raises:
+        RuntimeError: If the users, sites or roles could not be retrieved. The reason is logged.
+    """
     # Retrieve list of sites from the API for the siteName and siteCode
     writelog("Retrieving list of sites from " + url + "/admin/studysites (for siteName and siteCode).", path)
-    response_sites = requests.get(url + "/admin/studysites", headers = header)
-    if(response_sites.status_code == 200):
-        writelog("Status code: 200 - Success.", path)
-        response_sites = response_sites.json()
-        sites = pd.DataFrame(response_sites)
-        if sites.empty:
-            sites = pd.DataFrame({"siteGuid": [], "siteName": [], "siteCode": []})
-    elif(response_sites.status_code == 403):
-        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
-        return
+    response_sites = fetch_sites(token, url, path, sitecache, session = session)
+    if(response_sites is None):
+        raise RuntimeError("Sites could not be retrieved.")
+    sites = pd.DataFrame(response_sites)
+    if sites.empty:
+        sites = pd.DataFrame({"siteGuid": [], "siteName": [], "siteCode": []})
     
-    # Retrieve the detailed role info per user
-    writelog("Retrieving role info per user.", path)
-    userExcel = pd.DataFrame({"userGuid":[], "displayName":[], "email":[], "roleName":[], "siteGuid":[], "siteName":[], "siteCode":[], "access_to_siteGroup":[]})
-    for i in range(0, len(response["userInfos"])):
+    # Retrieve the detailed role info per user, page by page as the users are listed
+    previousUsers = snapshot["users"] if snapshot is not None else {}
+    newUsers = {}
+    reused = 0
+    count = 0
+    for userInfo in iter_users(token, url, path, session = session):
+        if(emails is not None and (userInfo["email"] or "").lower() not in emails):
+            continue
+        count += 1
+        previous = previousUsers.get(userInfo["userGuid"])
+        snapshotInfo = dict(userInfo)  # Copy before the API client display values are filled in
         # If a user has no email, or it is the same is userGuid, it is an API client
-        if((response["userInfos"][i]["email"] == None) | (response["userInfos"][i]["email"] == response["userInfos"][i]["userGuid"])):
-            response["userInfos"][i]["displayName"] = "<<API CLIENT>>"
-            response["userInfos"][i]["email"] = "<<API CLIENT>>"
-            writelog("Retrieving info for API client user from " + url + "/admin/users/" + response["userInfos"][i]["userGuid"] + "/roles.", path)
+        if((userInfo["email"] == None) | (userInfo["email"] == userInfo["userGuid"])):
+            userInfo["displayName"] = "<<API CLIENT>>"
+            userInfo["email"] = "<<API CLIENT>>"
+        # Reuse the roles from the snapshot if the user info did not change since the previous run
+        if(previous is not None and previous["info"] == snapshotInfo):
+            userRoles = previous["roles"]
+            checked = previous.get("checked")
+            reused += 1
         else:
-            writelog("Retrieving info for user " + response["userInfos"][i]["email"] + " from " + url + "/admin/users/" + response["userInfos"][i]["userGuid"] + "/roles.", path)
-        response2 = requests.get(url + "/admin/users/" + response["userInfos"][i]["userGuid"] + "/roles", headers = header)
-        if(response2.status_code == 200):
-            writelog("Status code: 200 - Success.", path)
-        elif(response2.status_code == 403):
-            writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function\n.", path)
+            userRoles = get_user_roles(token, url, userInfo, path, session = session)
+            checked = time.time()
+        if snapshot is not None:
+            newUsers[userInfo["userGuid"]] = {"info": snapshotInfo, "roles": userRoles, "checked": checked}
+        yield userInfo, userRoles, sites
+    if snapshot is not None:
+        snapshot["users"] = newUsers
+        writelog("Roles reused from snapshot for " + str(reused) + " of " + str(count) + " users.", path)
+
+
+def get_user_roles(token, url, userInfo, path = None, session = None):
+    """
+    Retrieves the roles of one user from /admin/users/{userGuid}/roles.
+    Args:
+        userInfo (dict): The user entry from /admin/users, or a stored role record, with userGuid and email.
+        Others: see load_users.
+    Returns:
+        (list): The roles of the user.
+    Raises:
+        RuntimeError: If the roles could not be retrieved. The reason is logged.
+    """
+    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token, "Content-type" : "application/json" }
+    if(userInfo["email"] == "<<API CLIENT>>"):
+        writelog("Retrieving info for API client user from " + url + "/admin/users/" + userInfo["userGuid"] + "/roles.", path)
+    else:
+        writelog("Retrieving info for user " + userInfo["email"] + " from " + url + "/admin/users/" + userInfo["userGuid"] + "/roles.", path)
+    response = (session or requests).get(url + "/admin/users/" + userInfo["userGuid"] + "/roles", headers = header)
+    if(response.status_code != 200):
+        check_list_status(response, path)
+        raise RuntimeError("Roles of user " + userInfo["userGuid"] + " could not be retrieved.")
+    writelog("Status code: 200 - Success.", path)
+    return response.json()["roles"]
+
+
+def iter_users(token, url, path = None, session = None, pagesize = usersPageSize):
+    """
+    Lists the users of the study from /admin/users, one page at a time, so that only one page is held in memory.
+    Users are yielded as soon as their page is retrieved. The pageIndex and pageSize fields are not documented
+    for /admin/users. If the API does not page the list, the first response contains all users: either more
+    users than requested, or the first page is returned again for the next pageIndex. Both end the list, as
+    before paging was requested. If a later page only repeats users of other earlier pages, the list is
+    inconsistent and an error is raised.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str or function): Log file path, log function or None (see writelog).
+        session (requests.Session): Optional session to reuse connections.
+        pagesize (int): Number of users requested per page.
+    Yields:
+        (dict): The user entry from /admin/users.
+    Raises:
+        RuntimeError: If a page could not be retrieved, or only repeats users of pages other than the first.
+            The reason is logged.
+    """
+    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token, "Content-type" : "application/json" }
+    seen = set()  # userGuids already yielded, to detect pages that repeat earlier users
+    firstPage = None
+    page = 0
+    while True:
+        writelog("Retrieving list of users from " + url + "/admin/users" + (" (page " + str(page + 1) + ")" if page > 0 else "") + ".", path)
+        response = (session or requests).post(url + "/admin/users", headers = header, json = {"pageIndex": page, "pageSize": pagesize})
+        if(response.status_code != 200):
+            check_list_status(response, path)
+            raise RuntimeError("Users could not be retrieved.")
+        writelog("Status code: 200 - Success.", path)
+        userInfos = response.json()["userInfos"]
+        del response
+        guids = [x["userGuid"] for x in userInfos]
+        if(page == 0):
+            firstPage = guids
+        elif(guids == firstPage):
+            # The API ignores pageIndex and returned the first page again, so the first page held all users
+            writelog("Page " + str(page + 1) + " of /admin/users is the same as the first page. The API does not page the list; "
+                + str(len(seen)) + " users retrieved.", path)
             return
-        
-        # Transform the role info per user and append to the userExcel variable
-        # Convert the roles information from the API response to a data frame
-        roles = pd.DataFrame(response2.json()["roles"])
-        roles["siteGuids"] = roles["siteGuids"].fillna("").apply(list)
-        # Expand the siteGuids column (which may contain a list with multiple values) to separate columns for each list element
-        siteGuids = pd.DataFrame([pd.Series(x) for x in roles.siteGuids])
-        siteGuids.columns = ["site_{}".format(x+1) for x in siteGuids.columns]
-        if siteGuids.empty:
-            roles["site_1"] = ""
-        else:
-            roles = roles.join(siteGuids)
-        # Pivot the roles data frame to one row per role-siteGuid combination
-        roles = pd.melt(roles, id_vars = [col for col in roles if not col.startswith('site_')], value_vars = [col for col in roles if col.startswith('site_')], var_name = "sitenr", value_name = "siteGuid")
-        # Remove duplicate rows without siteGuid
-        roles = roles[(roles.sitenr == "site_1") | (~roles.siteGuid.isna())]
-        # Add columns userGuid, email and displayName
-        user = pd.DataFrame(response["userInfos"]).loc[i,["userGuid","email","displayName"]]
-        [roles.insert(0, x, user[x]) for x in reversed(user.index)]
-        # Add columns siteName and siteCode
-        roles = roles.merge(sites[["siteGuid","siteName","siteCode"]], on="siteGuid", how="left")
-        # Add whether the role has access to a site group
-        # siteGroupGuids may be None, [] or have an actual value. None and [] evaluate to boolean False
-        roles["access_to_siteGroup"] = ["Yes" if x==True else "No" for x in roles.siteGroupGuids.astype(bool)]
-        # Drop not needed columns
-        roles = roles.drop(columns=["roleId","siteGuids","sitenr","siteGroupGuids"])
-        # Add to the userExcel variable created outside the loop
-        userExcel = pd.concat([userExcel, roles])
-    
-    # Write the userExcel variable to Excel
+        repeated = [x for x in userInfos if x["userGuid"] in seen]
+        if(page > 0 and userInfos and len(repeated) == len(userInfos)):
+            # The API returned the users of other earlier pages again, so the remaining users cannot be retrieved
+            writelog("Page " + str(page + 1) + " of /admin/users only repeats users of earlier pages, and only the first "
+                + str(len(seen)) + " users could be retrieved.", path)
+            raise RuntimeError("Users could not be retrieved completely.")
+        if(repeated):
+            writelog("Page " + str(page + 1) + " of /admin/users repeats " + str(len(repeated)) + " users of earlier pages; they are skipped.", path)
+        for userInfo in userInfos:
+            if userInfo["userGuid"] not in seen:
+                seen.add(userInfo["userGuid"])
+                yield userInfo
+        # A short page is the last page. More users than requested means the API does not page the list
+        if(len(userInfos) != pagesize):
+            return
+        page += 1
+
+
+def check_list_status(response, path):
+    """
+    Logs the reason why a list of users, sites or roles could not be retrieved.
+    """
+    if(response.status_code == 403):
+        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
+    else:
+        writelog("Status code: " + str(response.status_code) + " - Failure. Ending execution of this function.\n", path)
+
+
+# Columns and column widths of export_studyUsers.xlsx
+userColumns = ["userGuid", "displayName", "email", "roleName", "siteGuid", "siteName", "siteCode", "access_to_siteGroup"]
+userColumnWidths = {"A": 37, "B": 25, "C": 35, "D": 25, "E": 37, "F": 25, "G": 12, "H": 20}
+
+
+def save_users_excel(users, path):
+    """
+    Saves the users to export_studyUsers.xlsx. The rows are streamed to the workbook, so an iterable of
+    DataFrames (e.g. from iter_user_rows) is written as it is retrieved, without holding all users in memory.
+    Args:
+        users (DataFrame or iterable): The users from load_users, or the rows per user from iter_user_rows.
+        path (str): Path where the log and Excel file should be saved.
+    Returns:
+        (int): Number of rows saved. None if the file could not be written.
+    Raises:
+        RuntimeError: From iter_user_rows, if the users could not be retrieved.
+    """
+    if isinstance(users, pd.DataFrame):
+        users = [users]
+    wb = openpyxl.Workbook(write_only = True)
+    ws = wb.create_sheet("Export")
+    for column, width in userColumnWidths.items():
+        ws.column_dimensions[column].width = width
+    header = []
+    for column in userColumns:
+        cell = openpyxl.cell.WriteOnlyCell(ws, value = column)
+        cell.font = openpyxl.styles.Font(bold = True)
+        header.append(cell)
+    ws.append(header)
+    count = 0
+    try:
+        for chunk in users:
+            for row in chunk.reindex(columns = userColumns).itertuples(index = False):
+                ws.append([None if pd.isnull(x) else x for x in row])
+                count += 1
+    except:
+        ws.close()  # Discard the rows written so far
+        raise
     try:  # Writing the Excel file within try statement, as permission may be denied.
-        writer = pd.ExcelWriter(path + "export_studyUsers.xlsx", engine = "openpyxl")
-        userExcel.to_excel(writer, index = False, sheet_name = "Export")
-        ws = writer.sheets["Export"]
-        columnwidths = {"A": 37, "B": 25, "C": 35, "D": 25, "E": 37, "F": 25, "G": 12, "H": 20}
-        for column in columnwidths.keys():
-            ws.column_dimensions[column].width = columnwidths[column]
-        writer.close()
+        wb.save(path + "export_studyUsers.xlsx")
         writelog("Output saved: " + path + "export_studyUsers.xlsx.\n", path)
     except:
         writelog("Unable to write Excel file. Permission denied.", path)
-    writelog("Returning to user input.", path, disp = False)
+        return
+    return count
 
 
-def create_sites(token, url, path, excelfile):
+def roles_to_rows(userRoles, userInfo, sites):
+    """
+    Transforms the roles of one user to one row per role-siteGuid combination.
+    Args:
+        userRoles (list): Roles as returned by /admin/users/{userGuid}/roles.
+        userInfo (dict): The user entry from /admin/users.
+        sites (DataFrame): Study sites, for the siteName and siteCode.
+    Returns:
+        (DataFrame): The rows to add to the users export.
+    """
+    # Convert the roles information from the API response to a data frame
+    roles = pd.DataFrame(userRoles)
+    roles["siteGuids"] = roles["siteGuids"].fillna("").apply(list)
+    # Expand the siteGuids column (which may contain a list with multiple values) to separate columns for each list element
+    siteGuids = pd.DataFrame([pd.Series(x) for x in roles.siteGuids])
+    siteGuids.columns = ["site_{}".format(x+1) for x in siteGuids.columns]
+    if siteGuids.empty:
+        roles["site_1"] = ""
+    else:
+        roles = roles.join(siteGuids)
+    # Pivot the roles data frame to one row per role-siteGuid combination
+    roles = pd.melt(roles, id_vars = [col for col in roles if not col.startswith('site_')], value_vars = [col for col in roles if col.startswith('site_')], var_name = "sitenr", value_name = "siteGuid")
+    # Remove duplicate rows without siteGuid
+    roles = roles[(roles.sitenr == "site_1") | (~roles.siteGuid.isna())]
+    # Add columns userGuid, email and displayName
+    user = pd.Series(userInfo)[["userGuid","email","displayName"]]
+    [roles.insert(0, x, user[x]) for x in reversed(user.index)]
+    # Add columns siteName and siteCode
+    roles = roles.merge(sites[["siteGuid","siteName","siteCode"]], on="siteGuid", how="left")
+    # Add whether the role has access to a site group
+    # siteGroupGuids may be None, [] or have an actual value. None and [] evaluate to boolean False
+    roles["access_to_siteGroup"] = ["Yes" if x==True else "No" for x in roles.siteGroupGuids.astype(bool)]
+    # Drop not needed columns
+    return roles.drop(columns=["roleId","siteGuids","sitenr","siteGroupGuids"])
+
+
+def role_records(userInfo, userRoles):
+    """
+    Transforms the roles of one user to one record per role and site, as kept in the metadata store.
+    Args:
+        userInfo (dict): The user entry from /admin/users.
+        userRoles (list): Roles as returned by /admin/users/{userGuid}/roles.
+    Returns:
+        (list): Dicts with userGuid, email, displayName, roleOID, roleName and siteGuid (None for roles without site).
+    """
+    return [{"userGuid": userInfo["userGuid"], "email": userInfo["email"], "displayName": userInfo["displayName"],
+        "roleOID": role.get("roleId"), "roleName": role.get("roleName"), "siteGuid": siteGuid or None}
+        for role in userRoles for siteGuid in (role.get("siteGuids") or [""])]
+
+
+def load_users_snapshot(path):
+    """
+    Loads the users snapshot saved by the previous incremental run of get_users.
+    Returns:
+        (dict): The snapshot, with per userGuid the user info, the roles and when they were retrieved ("checked"),
+            and the rows of the previous export. Empty if no valid snapshot exists.
+    """
+    empty = {"users": {}, "export": None}
+    try:
+        with open(path + "snapshot_studyUsers.json") as f:
+            snapshot = json.load(f)
+    except OSError:
+        return empty
+    except ValueError:
+        writelog("Snapshot " + path + "snapshot_studyUsers.json is not valid JSON. Retrieving the roles of all users.", path)
+        return empty
+    # Check the layout, as the file may have been edited or written by another version
+    valid = (isinstance(snapshot, dict) and isinstance(snapshot.get("users"), dict) and "export" in snapshot and
+        (snapshot["export"] is None or isinstance(snapshot["export"], list)) and
+        all(isinstance(x, dict) and isinstance(x.get("info"), dict) and isinstance(x.get("roles"), list) for x in snapshot["users"].values()))
+    if not valid:
+        writelog("Snapshot " + path + "snapshot_studyUsers.json has an invalid layout. Retrieving the roles of all users.", path)
+        return empty
+    return snapshot
+
+
+def diff_role_assignments(previous, current):
+    """
+    Compares two users exports and lists the role assignments that were added or removed.
+    Args:
+        previous (DataFrame): The users export of the previous run.
+        current (DataFrame): The users export of this run.
+    Returns:
+        (DataFrame): The changed rows of the users export, with a column 'change' (added/removed).
+    """
+    keys = ["userGuid", "email", "roleName", "siteGuid"]
+    previous = previous.astype(str).drop_duplicates(keys)
+    current = current.astype(str).drop_duplicates(keys)
+    merged = previous.merge(current, on = keys, how = "outer", suffixes = ("_previous", ""), indicator = True)
+    added = current.merge(merged.loc[merged["_merge"] == "right_only", keys], on = keys)
+    removed = previous.merge(merged.loc[merged["_merge"] == "left_only", keys], on = keys)
+    added.insert(0, "change", "added")
+    removed.insert(0, "change", "removed")
+    return pd.concat([added, removed], ignore_index = True)
+
+
+def create_sites(token, url, path, excelfile, sitecache = None, resultsformat = "csv"):
     """
     Creates sites in Viedoc from an Excel input.
     Args:
         token (str): Authentication token obtained from the STS server.
         url (str): API URL obtained from Viedoc Admin.
         path (str): Path where the log file should be saved.
-        excelfile (str): Path to the Excel file.
+        excelfile (str): Path to the Excel file, or to a plan created by plan_sites. For a plan, only
+            the rows with action 'create' are imported.
+        sitecache (dict): Optional site cache of the session, see new_site_cache. Created sites are added to it.
+        resultsformat (str): Format of the results file, "csv" or "parquet" (see save_results).
     Returns:
-        None
+        (dict): Number of sites created, the failed Excel rows and the results per row (see save_results).
+            None if the import was not started.
     """
     writelog("Loading data from Excel.", path)
     try:  # Reading the Excel file within try statement, as permission may be denied
@@ -254,6 +589,7 @@ def create_sites(token, url, path, excelfile):
         writelog("Invalid data layout. Use the import template. Ending execution of this function.\n", path)
         return
     writelog("Correct Excel template was used.", path)
+    sitesToAdd, rownr = select_plan_rows(sitesToAdd, path)
     
     # Check if all sites have a value for the required fields
     requiredcols = ["siteCode", "siteName", "countryCode", "timeZoneId", "isTrainingEnabled", "isProductionEnabled"]
@@ -274,32 +610,37 @@ def create_sites(token, url, path, excelfile):
     
     # Retrieve existing sites from the API to check later if siteName or siteCode are already in the system
     writelog("Retrieving existing sites from " + url + "/admin/studysites to check for duplicates.", path)
-    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token}
-    response = requests.get(url + "/admin/studysites", headers = header)
-    if(response.status_code == 200):
-        writelog("Status code: 200 - Success.", path)
-    elif(response.status_code == 403):
-        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
+    response = fetch_sites(token, url, path, sitecache)
+    if(response is None):
         return
-    sites = pd.DataFrame(response.json())
+    sites = pd.DataFrame(response)
+    
+    # Convert the timeZoneId to the API import format and the Training/Production flags to True or False
+    timeZoneIds = normalize_column(sitesToAdd["timeZoneId"], normalize_timezone)
+    for j in ["isTrainingEnabled", "isProductionEnabled"]:
+        sitesToAdd[j] = normalize_column(sitesToAdd[j], normalize_boolean)
     
     # Loop over all rows, perform checks, then proceed to importing the sites
     sitesCreated = 0
     failed = []
     notinvited = []
+    results = []
     for i in range(0, sitesToAdd.shape[0]):
         params = sitesToAdd.iloc[i][cols].to_dict()
-        writelog("Working on Excel row " + str(i+2) + " - siteName: '" + params["siteName"] + "', siteCode: '" + params["siteCode"] + "'.", path)
+        started = time.perf_counter()
+        writelog("Working on Excel row " + str(rownr[i]) + " - siteName: '" + params["siteName"] + "', siteCode: '" + params["siteCode"] + "'.", path)
         
         # Check if siteName or siteCode already exist in the system, if so: skip the Excel row
         if(not sites.empty):
             if(params["siteCode"] in sites["siteCode"].values):
                 writelog("SiteCode " + params["siteCode"] + " already exists in the study. Skipping this Excel row.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, None, "siteCodeExists", row = rownr[i], siteCode = params["siteCode"])
                 continue
             if(params["siteName"] in sites["siteName"].values):
                 writelog("SiteName " + params["siteName"] + " already exists in the study. Skipping this Excel row.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, None, "siteNameExists", row = rownr[i], siteCode = params["siteCode"])
                 continue
         
         # Remove optional fields if they were blank in the Excel file
@@ -313,14 +654,16 @@ def create_sites(token, url, path, excelfile):
                 writelog("Value " + params[j] + " ignored as it is not numeric (" + j +").", path)
                 del params[j]
         
-        # Check the timeZoneId. If provided in "Viedoc format" instead of "API import format", convert it
-        if(params["timeZoneId"] in tz_conversion.keys()):
-            writelog(params["timeZoneId"] + " converted to " + tz_conversion[params["timeZoneId"]] + " for import.", path)
-            params["timeZoneId"] = tz_conversion[params["timeZoneId"]]
-        
-        # Check isTrainingEnabled and isProductionEnabled: Convert their value to True or False
-        params["isTrainingEnabled"] = toTrueFalse(params["isTrainingEnabled"])
-        params["isProductionEnabled"] = toTrueFalse(params["isProductionEnabled"])
+        # Check the timeZoneId. Unrecognized values are not sent, the same as in plan_sites
+        if(not isinstance(timeZoneIds.iloc[i], str)):
+            writelog("Error creating site " + params["siteCode"] + ". " + timezone_reason(params["timeZoneId"]) + "\n", path)
+            failed.append(rownr[i])
+            add_result(results, started, None, "invalidTimeZoneId", row = rownr[i], siteCode = params["siteCode"])
+            continue
+        # If not provided in "API import format", use the converted value
+        if(timeZoneIds.iloc[i] != params["timeZoneId"]):
+            writelog(params["timeZoneId"] + " converted to " + timeZoneIds.iloc[i] + " for import.", path)
+            params["timeZoneId"] = timeZoneIds.iloc[i]
         
         # Make sure the countryCode is in uppercase
         params["countryCode"] = params["countryCode"].upper()
@@ -331,6 +674,7 @@ def create_sites(token, url, path, excelfile):
             writelog("- " + j + ": " + params[j], path, option = "notimestamp")
         header = { "Accept" : "application/json", "Authorization" : "Bearer " + token, "Content-type" : "application/json"}
         response = requests.post(url + "/admin/studysites", json = params, headers = header)
+        siteResult = {"row": rownr[i], "siteCode": params["siteCode"], "endpoint": "/admin/studysites"}
         
         # Check whether the site was successfully created
         if(response.status_code == 201):
@@ -339,39 +683,48 @@ def create_sites(token, url, path, excelfile):
         elif(response.status_code == 400):
             if(response.content.startswith(b'{"errorMessage":"Study does not have a valid license.')):
                 writelog("Status code: 400 - Failure. License required to enable Production status.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "noLicense", **siteResult)
                 continue
             if(response.content.startswith(b'{"errorMessage":"Combined production and training mode is not allowed in this study.')):
                  writelog("Status code: 400 - Failure. Study settings do not allow a site with both Training and Production status.\n", path)
-                 failed.append(i+2)
+                 failed.append(rownr[i])
+                 add_result(results, started, response, "trainingAndProduction", **siteResult)
                  continue
             if(response.content.startswith(b'[\n  "CountryCode is not valid:')):
                 writelog("Error creating site " + params["siteCode"] + ". The countryCode was not recognized.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "invalidCountryCode", **siteResult)
                 continue
             if(response.content.startswith(b'[\n  "TimeZoneId is not valid:')):
                 writelog("Error creating site " + params["siteCode"] + ". The timeZoneId was not recognized.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "invalidTimeZoneId", **siteResult)
                 continue
             else:
                 writelog("Status code: 400 - Failure. Site not added. Details:\n", path)
                 writelog(response.json(), path, disp = True, option = "error")
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "badRequest", **siteResult)
                 continue
         elif(response.status_code == 403):
             if(response.content == b'Production client required'):
                 writelog("Status code: 403 - Failure. Cannot create a Production site when API client is in Demo mode.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "productionClientRequired", **siteResult)
                 continue
             else:
                 writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Site not added.\n", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                add_result(results, started, response, "forbidden", **siteResult)
                 continue
         
         # Get the siteGuid of the created site
         siteGuid = re.search("[a-z0-9-]+$",response.json())
         siteGuid = siteGuid.group(0)
         writelog("Created site has siteGuid: " + siteGuid + ".", path)
+        add_site_to_cache(sitecache, dict(params, siteGuid = siteGuid))
+        add_result(results, started, response, None, siteGuid = siteGuid, **siteResult)
         
         # Add site manager as defined in Excel file
         if("roleSiteManager" in colnames and not pd.isnull(sitesToAdd.iloc[i]["roleSiteManager"])):
@@ -382,8 +735,12 @@ def create_sites(token, url, path, excelfile):
             writelog("- siteGuid: " + siteGuid, path, option = "notimestamp")
             header = { "Accept" : "application/json","Content-type": "application/json", "Authorization" : "Bearer " + token }
             body = '[\n{\n"email":"' + sitesToAdd.iloc[i]["roleSiteManager"] + '",\n"roles":[\n{\n"roleOID":"RoleSiteManager",\n"siteGuid":"' + siteGuid + '"\n}\n]\n}\n]'
+            started = time.perf_counter()
             response = requests.post(url + "/admin/adminusers", data = body, headers = header)
-            notinvited = check_response_status(response, sitesToAdd.iloc[i]["roleSiteManager"], i+2, notinvited, 0, "admin", path)[0]
+            notinvitedBefore = len(notinvited)
+            notinvited = check_response_status(response, sitesToAdd.iloc[i]["roleSiteManager"], rownr[i], notinvited, 0, "admin", path)[0]
+            add_result(results, started, response, "siteManagerNotInvited" if len(notinvited) > notinvitedBefore else None,
+                row = rownr[i], siteCode = params["siteCode"], endpoint = "/admin/adminusers", siteGuid = siteGuid)
         writelog("", path, option = "notimestamp")
         
     # Show the number of sites created and list the failures
@@ -397,19 +754,28 @@ def create_sites(token, url, path, excelfile):
         writelog("Failed to create site in Excel row: " + ", ".join(str(x) for x in failed) + ".\n", path)
     if(len(notinvited) > 0):
         writelog("Failed to invite site manager in Excel row: " + ", ".join(str(x) for x in notinvited) + ".\n", path)
+    results = save_results(results, ["row", "siteCode"], path, "results_sites", resultsformat)
     writelog("Returning to user input.", path, disp = False)
+    return {"sitesCreated": sitesCreated, "failed": failed, "notinvited": notinvited, "results": results}
 
 
-def create_users(token, url, path, excelfile):
+def create_users(token, url, path, excelfile, sitecache = None, skipexisting = False, resultsformat = "csv"):
     """
     Creates users in Viedoc from an Excel input.
     Args:
         token (str): Authentication token obtained from the STS server.
         url (str): API URL obtained from Viedoc Admin.
         path (str): Path where the log file should be saved.
-        excelfile (str): Path to the Excel file.
+        excelfile (str): Path to the Excel file, or to a plan created by plan_users. For a plan, only
+            the rows with action 'create' are imported.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+        skipexisting (bool): If True, the existing role assignments of the users in the Excel file are retrieved
+            first, and rows for which the user already has the role at the site are skipped without sending an invite.
+            This lists all users of the study and retrieves the roles of each user in the Excel file.
+        resultsformat (str): Format of the results file, "csv" or "parquet" (see save_results).
     Returns:
-        None
+        (dict): Number of roles assigned, the failed and the skipped Excel rows and the results per row (see save_results).
+            None if the import was not started.
     """
     writelog("Loading data from Excel.", path)
     try:  # Reading the Excel file within try statement, as permission may be denied.
@@ -422,105 +788,51 @@ def create_users(token, url, path, excelfile):
     if not((colnames[0] == "email") and (colnames[1] == "roleOID") and (colnames[2] == "siteGuid") and (colnames[3] == "siteName") and (colnames[4] == "siteCode") ):
         writelog("Invalid data layout. Use the import template. Ending execution of this function.\n", path)
         return
+    usersToAdd, rownr = select_plan_rows(usersToAdd, path)
+    roleOIDs = normalize_column(usersToAdd["roleOID"], normalize_role)
     # Retrieve list of sites from the API to convert siteName/siteCode in the Excel to siteGuid:
     writelog("Retrieving sites from " + url + "/admin/studysites to convert siteCode/siteName to siteGuid.", path)
-    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token }
-    response_sites = requests.get(url + "/admin/studysites", headers = header)
-    if(response_sites.status_code == 200):
-        writelog("Status code: 200 - Success.", path)
-    elif(response_sites.status_code == 403):
-        writelog("Status code: 403 - Failure. Check API configuration in Viedoc Admin. Ending execution of this function.\n", path)
+    response_sites = fetch_sites(token, url, path, sitecache)
+    if(response_sites is None):
         return
-    response_sites = response_sites.json()
     sites = pd.DataFrame(response_sites)
+    # Retrieve the existing role assignments, so that rows which are already satisfied can be skipped:
+    assignments = None
+    if skipexisting:
+        # The same rule as plan_users: rows are only skipped for roles confirmed by the API
+        assignments = load_role_assignments(token, url, path, sitecache, emails = excel_emails(usersToAdd))
+        if(assignments is None):
+            writelog("Existing role assignments not available. All rows will be sent.", path)
     # Start creating users / adding roles to users:
     header = { "Accept" : "application/json","Content-type": "application/json", "Authorization" : "Bearer " + token }
     usersAdded = 0
     failed = []  # To track failed Excel rows.
+    skipped = []  # To track Excel rows for which the role was already assigned.
+    results = []  # Outcome per Excel row, see save_results.
+    availableRoles = {}  # Clinic role names (lowercase) to roleOID, learned from the first API response that lists them
     for i in range(0, usersToAdd.shape[0]):
         params = usersToAdd.iloc[i][0:5].to_dict()
-        if((not isinstance(params["email"], str)) or (not isinstance(params["roleOID"], str))):
-            writelog("Skipping Excel row " + str(i+2) + " as required data is missing (email or roleOID).", path)
-            failed.append(i+2)
+        started = time.perf_counter()
+        # Check the roleOID, siteGuid, siteName and siteCode. Obtain siteGuid if needed and possible:
+        if(resolve_user_row(params, sites, rownr[i], path, roleOIDs.iloc[i]) is not None):
+            failed.append(rownr[i])
+            add_result(results, started, None, "invalidRow", row = rownr[i], email = params["email"], roleOID = params["roleOID"])
+            continue
+        # Skip the row if the user already has this role at this site
+        assignment = (params["email"].lower(), params["roleOID"].lower(), params["siteGuid"] if isinstance(params["siteGuid"], str) else "")
+        if(assignments is not None and assignment in assignments):
+            writelog("'" + params["email"] + "' already has role " + params["roleOID"] + (" at site " + params["siteGuid"] if assignment[2] else "") + ". Skipping this Excel row.", path)
+            skipped.append(rownr[i])
+            add_result(results, started, None, "alreadyAssigned", row = rownr[i], email = params["email"], roleOID = params["roleOID"], siteGuid = assignment[2] or None)
             continue
-        writelog("Working on Excel row " + str(i+2) + ". Email: " + params["email"] + ", roleOID: " + params["roleOID"] + ".", path)
-        # Check siteGuid, siteName and siteCode. Obtain siteGuid if needed and possible:
-        sysRoles = {
-            "study manager": "RoleStudyManager",
-            "site manager": "RoleSiteManager",
-            "api manager": "ApiManager",
-            "designer": "RoleDesigner",
-            "unblinded statistician": "UnblindedStatistician",
-            "dictionary manager": "DictionaryManager",
-            "reference data source manager": "RefDataSourceManager",
-            "etmf manager": "EtmfManager",
-            "design impact analyst": "DesignImpactAnalyst"}
-        if(params["roleOID"].lower() in sysRoles.keys()):
-            writelog("Role " + params["roleOID"] + " converted to " + sysRoles[params["roleOID"].lower()] + " for import.", path)
-            params["roleOID"] = sysRoles[params["roleOID"].lower()]
-        # Check if the role requires a siteGuid (i.e. not a system role except Site Manager)
-        if(not params["roleOID"] in ["RoleStudyManager","ApiManager","RoleDesigner","UnblindedStatistician","DictionaryManager","RefDataSourceManager","EtmfManager","DesignImpactAnalyst"]):
-            writelog("The provided role (" + params["roleOID"] + ") requires a siteGuid.", path)
-            # If a siteGuid is provided in the Excel
-            if(isinstance(params["siteGuid"],str)):
-                # If the provided siteGuid does not exist in the study, the row is skipped
-                if(not params["siteGuid"] in sites["siteGuid"].values):
-                    writelog("Invalid siteGuid provided (" + params["siteGuid"] + ")! Skipping this Excel row.", path)
-                    failed.append(i+2)
-                    continue
-                writelog("SiteGuid " + params["siteGuid"] + " provided in Excel file.", path)
-            # If no siteGuid was provided
-            else: writelog("SiteGuid not provided in Excel file. Trying to obtain from (1) siteCode or (2) siteName.", path)
-            # If a siteCode was provided
-            if((not isinstance(params["siteGuid"], str)) and (isinstance(params["siteCode"], str))):
-                # If the siteCode does not exist in the study, the row is skipped
-                if(not params["siteCode"] in sites["siteCode"].values):
-                    writelog("Provided siteCode (" + params["siteCode"] + ") does not exist in Viedoc! Skipping this Excel row.", path)
-                    failed.append(i+2)
-                    continue
-                # If the siteCode does exist in the study and is unique
-                if(len(sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values) == 1):
-                    # If provided, the siteName must match the siteCode, else the row is skipped
-                    if(isinstance(params["siteName"], str) and not sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values == params["siteName"]):
-                        writelog("The combination of siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' does not exist. Skipping this Excel row.", path)
-                        failed.append(i+2)
-                        continue
-                    # If no siteName provided, or siteCode and siteName match, then obtain the siteGuid
-                    params["siteGuid"] = sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values[0]
-                    writelog("Obtained siteGuid " + params["siteGuid"] + " from siteCode '" + params["siteCode"] + "' for import.", path)
-                # If the siteCode does exist, but is not unique
-                elif(len(sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values) > 1):
-                    # If a siteName is provided and matches the siteCode, then obtain the siteGuid
-                    if(isinstance(params["siteName"], str) and params["siteName"] in sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values):
-                        params["siteGuid"] = sites.loc[sites["siteCode"] == params["siteCode"]][sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values == params["siteName"]]["siteGuid"].values[0]
-                        writelog("Obtained siteGuid " + params["siteGuid"] + " from siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' for import.", path)
-                    # If no siteName is provided, the row is skipped
-                    elif(not isinstance(params["siteName"], str)):
-                        writelog("SiteCode '" + params["siteCode"] + "' is not unique and no siteName was provided to distinguish sites. Skipping this Excel row.", path)
-                        failed.append(i+2)
-                        continue
-                    # If a siteName is provided, but does not match the siteCode, the row is skipped
-                    elif(not params["siteName"] in sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values):
-                        writelog("The combination of siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' does not exist. Skipping this Excel row.", path)
-                        failed.append(i+2)
-                        continue
-            # If no siteGuid siteCode are provided, but siteName is provided
-            elif((not isinstance(params["siteGuid"], str)) and (isinstance(params["siteName"], str))):
-                # If siteName does not exist, the row is skipped
-                if(not params["siteName"].upper() in sites["siteName"].astype(str).str.upper().values):
-                    writelog("Provided siteName (" + params["siteName"] + ") does not exist in Viedoc! Skipping this Excel row.", path)
-                    failed.append(i+2)
-                    continue
-                # If siteName does exist, then obtain the siteGuid
-                params["siteGuid"] = sites.loc[sites["siteName"].astype(str).str.upper() == params["siteName"].upper()]["siteGuid"].values[0]
-                writelog("Obtained siteGuid " + params["siteGuid"] + " from siteName '" + params["siteName"] + "' for import.", path)
-            # Any other cases, no siteGuid is obtained
-            else: writelog("SiteGuid was not obtained.", path)
+        usersAddedBefore = usersAdded
+        failedBefore = len(failed)
+        errorclass = None  # Set where the reason of a failure is known better than from the status code
         # Check if the provided roleOID belongs to a system role
-        if(params["roleOID"] in sysRoles.values()):
+        if(params["roleOID"] in systemRoles):
             writelog("Provided roleOID is a system role. Using system role import routine.", path)
             # Import specifically for Site Manager, as the API requires a siteGuid here
-            if(params["roleOID"] == "RoleSiteManager" and isinstance(params["siteGuid"], str)):
+            if(params["roleOID"] == "RoleSiteManager"):
                 writelog("Adding '" + params["email"] + "' with role RoleSiteManager to site " + params["siteGuid"] + ".", path)
                 writelog("Sending the following user details to " + url + "/admin/adminusers:", path)
                 writelog("- email: " + params["email"], path, option = "notimestamp")
@@ -528,10 +840,7 @@ def create_users(token, url, path, excelfile):
                 writelog("- siteGuid: " + params["siteGuid"], path, option = "notimestamp")
                 body = '[\n{\n"email":"' + params["email"] + '",\n"roles":[\n{\n"roleOID":"RoleSiteManager",\n"siteGuid":"' + params["siteGuid"] + '"\n}\n]\n}\n]'
                 response = requests.post(url + "/admin/adminusers", data = body, headers = header)
-                failed, usersAdded = check_response_status(response, params["email"], i+2, failed, usersAdded, "admin", path)
-            elif(params["roleOID"] == "RoleSiteManager" and not isinstance(params["siteGuid"], str)):
-                writelog("Trying to add a site manager (" + params["email"] + "), but siteGuid, siteName and siteCode are all missing!", path)
-                failed.append(i+2)
+                failed, usersAdded = check_response_status(response, params["email"], rownr[i], failed, usersAdded, "admin", path)
             # Import for all other system roles, which do not require assignment to a siteGuid
             else:
                 writelog("Adding '" + params["email"] + "' with role " + params["roleOID"] + ".", path)
@@ -540,29 +849,33 @@ def create_users(token, url, path, excelfile):
                 writelog("- roleOID: " + params["roleOID"], path, option = "notimestamp")
                 body = '[\n{\n"email":"' + params["email"] + '",\n"roles":[\n{\n"roleOID":"' + params["roleOID"] + '"\n}\n]\n}\n]'
                 response = requests.post(url + "/admin/adminusers", data = body, headers = header)
-                failed, usersAdded = check_response_status(response, params["email"], i+2, failed, usersAdded, "admin", path)
-        # If not a system role, then the siteGuid is required
-        elif(not isinstance(params["siteGuid"],str)):
-            writelog("Trying to add a clinic user (" + params["email"] + ", role '" + params["roleOID"] + "'), but siteGuid, siteName and siteCode are all missing!", path)
-            failed.append(i+2)
-            continue
+                failed, usersAdded = check_response_status(response, params["email"], rownr[i], failed, usersAdded, "admin", path)
         # If the siteGuid is provided, then proceed with inviting the clinic role
         else:
             writelog("Provided roleOID is not a system role. Trying to import as a clinic role.", path)
+            # Convert role names with the roles learned earlier in this run, so that each row is sent only once
+            if(params["roleOID"].lower() in availableRoles.keys()):
+                writelog(params["roleOID"] + " converted to " + availableRoles[params["roleOID"].lower()] + " for import.", path)
+                params["roleOID"] = availableRoles[params["roleOID"].lower()]
+            elif(len(availableRoles) > 0 and not params["roleOID"].upper() in [x.upper() for x in availableRoles.values()]):
+                writelog("Unable to convert. " + params["roleOID"] + " is an invalid roleOID in this study.", path)
+                failed.append(rownr[i])
+                add_result(results, started, None, "invalidRole", row = rownr[i], email = params["email"], roleOID = params["roleOID"],
+                    endpoint = "/admin/clinicusers", siteGuid = params["siteGuid"])
+                continue
             writelog("Sending the following user details to " + url + "/admin/clinicusers:", path)
             writelog("- email: " + params["email"], path, option = "notimestamp")
             writelog("- roleOID: " + params["roleOID"].upper(), path, option = "notimestamp")
             writelog("- siteGuid: " + params["siteGuid"], path, option = "notimestamp")
             body = '[\n{\n"email":"' + params["email"] + '",\n"roles":[\n{\n"roleOID":"' + params["roleOID"].upper() + '",\n"siteGuid":"' + params["siteGuid"] + '"\n}\n]\n}\n]'
             response = requests.post(url + "/admin/clinicusers", data = body, headers = header)
-            failed, usersAdded = check_response_status(response, params["email"], i+2, failed, usersAdded, "clinic", path)
+            failed, usersAdded = check_response_status(response, params["email"], rownr[i], failed, usersAdded, "clinic", path)
             # If failed to add user, maybe roleOID not provided as a Role ID (R1, R2, etc). Try to convert using response content:
             if response.status_code == 400 and "availableRoles" in response.json():
-                response = response.json()
+                roles = response.json()
                 writelog("Status code: 400 - Failure. The provided roleOID is not a valid Role ID. Trying to convert.", path)
-                availableRoles = {}
-                for j in range(0, len(response["availableRoles"])):
-                    availableRoles[response["availableRoles"][j]["roleName"].lower()] = response["availableRoles"][j]["roleOID"]
+                for j in range(0, len(roles["availableRoles"])):
+                    availableRoles[roles["availableRoles"][j]["roleName"].lower()] = roles["availableRoles"][j]["roleOID"]
                 if(params["roleOID"].lower() in availableRoles.keys()):
                     writelog(params["roleOID"] + " converted to " + availableRoles[params["roleOID"].lower()] + " for import.", path)
                     params["roleOID"] = availableRoles[params["roleOID"].lower()]
@@ -572,21 +885,39 @@ def create_users(token, url, path, excelfile):
                     writelog("- siteGuid: " + params["siteGuid"], path, option = "notimestamp")
                     body = '[\n{\n"email":"' + params["email"] + '",\n"roles":[\n{\n"roleOID":"' + params["roleOID"] + '",\n"siteGuid":"' + params["siteGuid"] + '"\n}\n]\n}\n]'
                     response = requests.post(url + "/admin/clinicusers", data = body, headers = header)
-                    failed, usersAdded = check_response_status(response, params["email"], i+2, failed, usersAdded, "clinic", path)
+                    failed, usersAdded = check_response_status(response, params["email"], rownr[i], failed, usersAdded, "clinic", path)
                     if(response.status_code == 400 and response.content != b'The given key was not present in the dictionary'):
                         writelog("Status code: 400 - Failure. User not added. Details:", path)
                         writelog(response.json(), path, option = "notimestamp")
-                        failed.append(i+2)
+                        failed.append(rownr[i])
                 # If not possible to convert, print information on valid roleOIDs
                 else:
                     writelog("Unable to convert. " + params["roleOID"] + " is an invalid roleOID in this study.", path)
                     print("For clinic roles: see Role ID in Viedoc Designer.\nFor system roles, the following are valid: RoleStudyManager, RoleSiteManager, ApiManager,")
                     print("RoleDesigner, UnblindedStatistician, DictionaryManager, RefDataSourceManager, EtmfManager, DesignImpactAnalyst.")
-                    failed.append(i+2)
+                    failed.append(rownr[i])
+                    errorclass = "invalidRole"
             # If the API response does not contain availableRoles, then likely something caused the failure
             elif response.status_code == 400 and not "availableRoles" in response.json():
                 writelog("Status code: 400 - Failure. Is '" + params["email"] + "' a valid email?", path)
-                failed.append(i+2)
+                failed.append(rownr[i])
+                errorclass = "invalidEmail"
+        # Record the outcome of the last request for this row. A 400 that is not recorded as failed could not be confirmed
+        if(usersAdded > usersAddedBefore):
+            errorclass = None
+        elif(len(failed) > failedBefore):
+            errorclass = errorclass or response_error_class(response)
+        else:
+            errorclass = "unconfirmed"
+        add_result(results, started, response, errorclass, row = rownr[i], email = params["email"], roleOID = params["roleOID"],
+            endpoint = "/admin/adminusers" if params["roleOID"] in systemRoles else "/admin/clinicusers",
+            siteGuid = params["siteGuid"] if isinstance(params["siteGuid"], str) else None)
+        # Remember the assigned role, so that duplicate rows in the Excel file are skipped as well
+        if(assignments is not None and usersAdded > usersAddedBefore):
+            assignments.add(assignment)
+            assignments.add((params["email"].lower(), params["roleOID"].lower(), assignment[2]))
+        if(sitecache is not None and sitecache["store"] is not None and usersAdded > usersAddedBefore):
+            add_stored_role(sitecache["store"], params["email"], params["roleOID"], assignment[2] or None)
     if(usersAdded == 0):
         writelog("No users were created or roles assigned.\n", path)
     elif(usersAdded == 1):
@@ -595,13 +926,514 @@ def create_users(token, url, path, excelfile):
         writelog(str(usersAdded) + " roles were successfully assigned.\n", path)
     if(len(failed) > 0):
         writelog("Failed Excel rows: " + str(failed)[1:len(str(failed))-1] + ".\n", path)
+    if(len(skipped) > 0):
+        writelog("Skipped Excel rows, as the role was already assigned: " + str(skipped)[1:len(str(skipped))-1] + ".\n", path)
+    results = save_results(results, ["row", "email", "roleOID"], path, "results_users", resultsformat)
     writelog("Returning to user input.", path)
+    return {"usersAdded": usersAdded, "failed": failed, "skipped": skipped, "results": results}
+
+
+def resolve_user_row(params, sites, row, path, roleOID = None):
+    """
+    Checks a row of the users import and converts it to the values sent to the API.
+    Role names of system roles are converted to their roleOID, and the siteGuid is obtained
+    from siteCode or siteName if needed. params is updated in place.
+    Args:
+        params (dict): The email, roleOID, siteGuid, siteName and siteCode of the Excel row.
+        sites (DataFrame): Study sites from /admin/studysites.
+        row (int): The Excel row number, for logging.
+        path (str): Path where the log file should be saved.
+        roleOID (str): The roleOID converted by normalize_role, if already done for the whole column.
+    Returns:
+        (str): The reason why the row cannot be imported. None if the row is valid.
+    """
+    if((not isinstance(params["email"], str)) or (not isinstance(params["roleOID"], str))):
+        writelog("Skipping Excel row " + str(row) + " as required data is missing (email or roleOID).", path)
+        return "Required data is missing (email or roleOID)."
+    writelog("Working on Excel row " + str(row) + ". Email: " + params["email"] + ", roleOID: " + params["roleOID"] + ".", path)
+    roleOID = roleOID if isinstance(roleOID, str) else normalize_role(params["roleOID"])
+    if(roleOID != params["roleOID"]):
+        writelog("Role " + params["roleOID"] + " converted to " + roleOID + " for import.", path)
+        params["roleOID"] = roleOID
+    # Check if the role requires a siteGuid (i.e. not a system role except Site Manager)
+    if(not params["roleOID"] in studyRoles):
+        writelog("The provided role (" + params["roleOID"] + ") requires a siteGuid.", path)
+        # If a siteGuid is provided in the Excel
+        if(isinstance(params["siteGuid"],str)):
+            # If the provided siteGuid does not exist in the study, the row is skipped
+            if(not params["siteGuid"] in sites["siteGuid"].values):
+                writelog("Invalid siteGuid provided (" + params["siteGuid"] + ")! Skipping this Excel row.", path)
+                return "Invalid siteGuid."
+            writelog("SiteGuid " + params["siteGuid"] + " provided in Excel file.", path)
+        # If no siteGuid was provided
+        else: writelog("SiteGuid not provided in Excel file. Trying to obtain from (1) siteCode or (2) siteName.", path)
+        # If a siteCode was provided
+        if((not isinstance(params["siteGuid"], str)) and (isinstance(params["siteCode"], str))):
+            # If the siteCode does not exist in the study, the row is skipped
+            if(not params["siteCode"] in sites["siteCode"].values):
+                writelog("Provided siteCode (" + params["siteCode"] + ") does not exist in Viedoc! Skipping this Excel row.", path)
+                return "SiteCode does not exist."
+            # If the siteCode does exist in the study and is unique
+            if(len(sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values) == 1):
+                # If provided, the siteName must match the siteCode, else the row is skipped
+                if(isinstance(params["siteName"], str) and not sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values == params["siteName"]):
+                    writelog("The combination of siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' does not exist. Skipping this Excel row.", path)
+                    return "Combination of siteCode and siteName does not exist."
+                # If no siteName provided, or siteCode and siteName match, then obtain the siteGuid
+                params["siteGuid"] = sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values[0]
+                writelog("Obtained siteGuid " + params["siteGuid"] + " from siteCode '" + params["siteCode"] + "' for import.", path)
+            # If the siteCode does exist, but is not unique
+            elif(len(sites.loc[sites["siteCode"] == params["siteCode"]]["siteGuid"].values) > 1):
+                # If a siteName is provided and matches the siteCode, then obtain the siteGuid
+                if(isinstance(params["siteName"], str) and params["siteName"] in sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values):
+                    params["siteGuid"] = sites.loc[sites["siteCode"] == params["siteCode"]][sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values == params["siteName"]]["siteGuid"].values[0]
+                    writelog("Obtained siteGuid " + params["siteGuid"] + " from siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' for import.", path)
+                # If no siteName is provided, the row is skipped
+                elif(not isinstance(params["siteName"], str)):
+                    writelog("SiteCode '" + params["siteCode"] + "' is not unique and no siteName was provided to distinguish sites. Skipping this Excel row.", path)
+                    return "SiteCode is not unique and no siteName was provided."
+                # If a siteName is provided, but does not match the siteCode, the row is skipped
+                elif(not params["siteName"] in sites.loc[sites["siteCode"] == params["siteCode"]]["siteName"].values):
+                    writelog("The combination of siteCode '" + params["siteCode"] + "' and siteName '" + params["siteName"] + "' does not exist. Skipping this Excel row.", path)
+                    return "Combination of siteCode and siteName does not exist."
+        # If no siteGuid siteCode are provided, but siteName is provided
+        elif((not isinstance(params["siteGuid"], str)) and (isinstance(params["siteName"], str))):
+            # If siteName does not exist, the row is skipped
+            if(not params["siteName"].upper() in sites["siteName"].astype(str).str.upper().values):
+                writelog("Provided siteName (" + params["siteName"] + ") does not exist in Viedoc! Skipping this Excel row.", path)
+                return "SiteName does not exist."
+            # If siteName does exist, then obtain the siteGuid
+            params["siteGuid"] = sites.loc[sites["siteName"].astype(str).str.upper() == params["siteName"].upper()]["siteGuid"].values[0]
+            writelog("Obtained siteGuid " + params["siteGuid"] + " from siteName '" + params["siteName"] + "' for import.", path)
+        # Any other cases, no siteGuid is obtained
+        else: writelog("SiteGuid was not obtained.", path)
+    # Site Manager and clinic roles can only be assigned to a site
+    if(params["roleOID"] == "RoleSiteManager" and not isinstance(params["siteGuid"], str)):
+        writelog("Trying to add a site manager (" + params["email"] + "), but siteGuid, siteName and siteCode are all missing!", path)
+        return "SiteGuid, siteName and siteCode are all missing."
+    if(not params["roleOID"] in systemRoles and not isinstance(params["siteGuid"],str)):
+        writelog("Trying to add a clinic user (" + params["email"] + ", role '" + params["roleOID"] + "'), but siteGuid, siteName and siteCode are all missing!", path)
+        return "SiteGuid, siteName and siteCode are all missing."
+    return None
+
+
+def select_plan_rows(toAdd, path):
+    """
+    Selects the rows to import. For a plan created by plan_users or plan_sites, only rows with action 'create'
+    are kept and the original Excel row numbers are used.
+    Returns:
+        (tuple): [0] The rows to import, [1] their Excel row numbers.
+    """
+    if("action" in toAdd.columns and "row" in toAdd.columns):
+        toAdd = toAdd.loc[toAdd["action"] == "create"].reset_index(drop = True)
+        writelog("Plan file detected. Importing the " + str(toAdd.shape[0]) + " rows with action 'create'.", path)
+        return toAdd, [int(x) for x in toAdd["row"]]
+    return toAdd, [i+2 for i in range(0, toAdd.shape[0])]
+
+
+def load_role_assignments(token, url, path, sitecache = None, emails = None):
+    """
+    Retrieves the current role assignments in the study, using the same endpoints as get_users.
+    create_users and plan_users both use this function, so the import and its plan skip the same rows.
+    If the site cache has a metadata store with recently stored roles, the stored roles are only used to find
+    the users: the roles of the stored users are retrieved again by userGuid, so that a role revoked in Viedoc
+    since it was stored is not seen as assigned. This saves listing all users of the study. Users that are
+    not in the store (e.g. invited since it was refreshed) are not found, so their rows are sent.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log file should be saved.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+        emails (set): Optional lowercase emails, e.g. those of an import file. If given, the roles are only
+            retrieved for these users, and not saved to the store, as they are not complete.
+    Returns:
+        (set): Tuples of (email, role, siteGuid), in lowercase, for both the role ID and role name.
+            siteGuid is an empty string for roles without site. None if unsuccessful.
+    """
+    store = sitecache["store"] if sitecache is not None else None
+    age = store_age(store, "roles")
+    records = []
+    try:
+        if(age is not None):
+            # Find the users in the store, and check their roles against the API
+            users = {}
+            for record in load_stored_roles(store):
+                if(record["userGuid"] and record["email"] and (emails is None or record["email"].lower() in emails)):
+                    users[record["userGuid"]] = {"userGuid": record["userGuid"], "email": record["email"], "displayName": record["displayName"]}
+            writelog("Found " + str(len(users)) + " users in the metadata store (stored " + str(int(age)) + " seconds ago). Retrieving their current roles.", path)
+            for userInfo in users.values():
+                records += role_records(userInfo, get_user_roles(token, url, userInfo, path))
+        else:
+            writelog("Retrieving existing role assignments" + ("." if emails is None else " of the " + str(len(emails)) + " users in the Excel file."), path)
+            for userInfo, userRoles, sites in iter_user_roles(token, url, path, sitecache = sitecache, emails = emails):
+                records += role_records(userInfo, userRoles)
+            if(store is not None and emails is None):
+                save_stored_roles(store, records)
+    except RuntimeError:
+        writelog("Could not retrieve existing role assignments.", path)
+        return None
+    assignments = set()
+    for record in records:
+        # API clients cannot be invited, so they do not need to be checked
+        if(record["email"] is None or record["email"] == "<<API CLIENT>>"):
+            continue
+        for roleKey in (record["roleOID"], record["roleName"]):
+            if isinstance(roleKey, str):
+                assignments.add((record["email"].lower(), roleKey.lower(), record["siteGuid"] or ""))
+    writelog("Retrieved " + str(len(assignments)) + " existing role assignments.", path)
+    return assignments
+
+
+def excel_emails(usersToAdd):
+    """
+    Returns the emails of the users import in lowercase, to retrieve only the role assignments of these users.
+    """
+    return set(usersToAdd["email"].dropna().str.strip().str.lower())
+
+
+def refresh_store(token, url, path, sitecache):
+    """
+    Retrieves the sites and role assignments from Viedoc and replaces them in the local metadata store.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log file should be saved.
+        sitecache (dict): Site cache of the session with a metadata store, see new_site_cache.
+    Returns:
+        (dict): Number of sites and role assignments stored. None if unsuccessful.
+    """
+    writelog("Refreshing the metadata store with the sites and role assignments from " + url + ".", path)
+    invalidate_store(sitecache["store"])
+    sitecache["retrieved"] = None
+    sites = fetch_sites(token, url, path, sitecache, complete = True)
+    if(sites is None or load_role_assignments(token, url, path, sitecache) is None):
+        writelog("Metadata store not refreshed.\n", path)
+        return
+    roles = load_stored_roles(sitecache["store"])
+    writelog(str(len(sites)) + " sites and " + str(len(roles)) + " role assignments saved in the metadata store.\n", path)
+    return {"sites": len(sites), "roles": len(roles)}
+
+
+def plan_users(token, url, path, excelfile, sitecache = None):
+    """
+    Dry run of create_users: resolves each Excel row to its siteGuid and roleOID and classifies it, without
+    sending any invites. The plan is saved to Excel and can be passed to create_users to import only the
+    rows with action 'create'.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log and plan file should be saved.
+        excelfile (str): Path to the Excel file.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+    Returns:
+        (DataFrame): The plan, with per row the action (create, present or invalid) and the reason. None if unsuccessful.
+    """
+    writelog("Loading data from Excel.", path)
+    try:  # Reading the Excel file within try statement, as permission may be denied.
+        usersToAdd = pd.read_excel(excelfile, dtype = str)
+    except:
+        writelog("Unable to read Excel file. Permission denied.\n", path)
+        return
+    colnames = usersToAdd.columns
+    if not((colnames[0] == "email") and (colnames[1] == "roleOID") and (colnames[2] == "siteGuid") and (colnames[3] == "siteName") and (colnames[4] == "siteCode") ):
+        writelog("Invalid data layout. Use the import template. Ending execution of this function.\n", path)
+        return
+    writelog("Retrieving sites from " + url + "/admin/studysites to convert siteCode/siteName to siteGuid.", path)
+    response_sites = fetch_sites(token, url, path, sitecache)
+    if(response_sites is None):
+        return
+    sites = pd.DataFrame(response_sites)
+    if sites.empty:
+        sites = pd.DataFrame({"siteGuid": [], "siteName": [], "siteCode": []})
+    assignments = load_role_assignments(token, url, path, sitecache, emails = excel_emails(usersToAdd))
+    if(assignments is None):
+        return
+    
+    roleOIDs = normalize_column(usersToAdd["roleOID"], normalize_role)
+    plan = []
+    for i in range(0, usersToAdd.shape[0]):
+        params = usersToAdd.iloc[i][0:5].to_dict()
+        reason = resolve_user_row(params, sites, i+2, path, roleOIDs.iloc[i])
+        if(reason is not None):
+            action = "invalid"
+        elif((params["email"].lower(), params["roleOID"].lower(), params["siteGuid"] if isinstance(params["siteGuid"], str) else "") in assignments):
+            action, reason = "present", "User already has this role at this site."
+        else:
+            action = "create"
+        plan.append(dict(params, row = i+2, action = action, reason = reason))
+    plan = pd.DataFrame(plan, columns = ["email", "roleOID", "siteGuid", "siteName", "siteCode", "row", "action", "reason"])
+    
+    writelog("Plan: " + ", ".join(str(n) + " " + a for a, n in plan["action"].value_counts().items()) + ".", path)
+    try:  # Writing the Excel file within try statement, as permission may be denied.
+        plan.to_excel(path + "plan_users.xlsx", index = False, sheet_name = "Plan")
+        writelog("Output saved: " + path + "plan_users.xlsx. Select this file to import the rows with action 'create'.\n", path)
+    except:
+        writelog("Unable to write Excel file. Permission denied.\n", path)
+    return plan
+
+
+def plan_sites(token, url, path, excelfile, sitecache = None):
+    """
+    Dry run of create_sites: checks each Excel row against the existing sites and classifies it, without
+    creating any sites. The plan is saved to Excel and can be passed to create_sites to import only the
+    rows with action 'create'.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log and plan file should be saved.
+        excelfile (str): Path to the Excel file.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+    Returns:
+        (DataFrame): The plan, with per row the action (create, present or invalid) and the reason. None if unsuccessful.
+    """
+    writelog("Loading data from Excel.", path)
+    try:  # Reading the Excel file within try statement, as permission may be denied
+        sitesToAdd = pd.read_excel(excelfile, dtype = str)
+    except:
+        writelog("Unable to read Excel file. Permission denied.\n", path)
+        return
+    cols = ["siteCode", "siteName", "countryCode", "timeZoneId", "expectedNumberOfSubjectsScreened", 
+        "expectedNumberOfSubjectsEnrolled", "maximumNumberOfSubjectsScreened","isTrainingEnabled", "isProductionEnabled"]
+    if not all(value in sitesToAdd.columns for value in cols):
+        writelog("Invalid data layout. Use the import template. Ending execution of this function.\n", path)
+        return
+    writelog("Retrieving existing sites from " + url + "/admin/studysites to check for duplicates.", path)
+    response = fetch_sites(token, url, path, sitecache)
+    if(response is None):
+        return
+    sites = pd.DataFrame(response)
+    existingCodes = set(sites["siteCode"]) if not sites.empty else set()
+    existingNames = set(sites["siteName"]) if not sites.empty else set()
+    timeZoneIds = normalize_column(sitesToAdd["timeZoneId"], normalize_timezone)
+    
+    requiredcols = ["siteCode", "siteName", "countryCode", "timeZoneId", "isTrainingEnabled", "isProductionEnabled"]
+    duplicateCodes = sitesToAdd["siteCode"].duplicated(keep = False)
+    duplicateNames = sitesToAdd["siteName"].duplicated(keep = False)
+    plan = sitesToAdd.copy()
+    plan["row"] = [i+2 for i in range(0, plan.shape[0])]
+    plan["action"] = "create"
+    plan["reason"] = None
+    for i in range(0, plan.shape[0]):
+        site = plan.iloc[i]
+        missing = [x for x in requiredcols if pd.isnull(site[x])]
+        if(len(missing) > 0):
+            action, reason = "invalid", "Missing " + ", ".join(missing) + "."
+        elif(duplicateCodes.iloc[i] or duplicateNames.iloc[i]):
+            action, reason = "invalid", "Duplicate siteCode or siteName in the Excel file."
+        elif(site["siteCode"] in existingCodes):
+            action, reason = "present", "SiteCode already exists in the study."
+        elif(site["siteName"] in existingNames):
+            action, reason = "present", "SiteName already exists in the study."
+        elif(not isinstance(timeZoneIds.iloc[i], str)):
+            action, reason = "invalid", timezone_reason(site["timeZoneId"])
+        else:
+            action, reason = "create", None
+        plan.iloc[i, plan.columns.get_loc("action")] = action
+        plan.iloc[i, plan.columns.get_loc("reason")] = reason
+    
+    writelog("Plan: " + ", ".join(str(n) + " " + a for a, n in plan["action"].value_counts().items()) + ".", path)
+    try:  # Writing the Excel file within try statement, as permission may be denied.
+        plan.to_excel(path + "plan_sites.xlsx", index = False, sheet_name = "Plan")
+        writelog("Output saved: " + path + "plan_sites.xlsx. Select this file to import the rows with action 'create'.\n", path)
+    except:
+        writelog("Unable to write Excel file. Permission denied.\n", path)
+    return plan
+
+
+# Site fields that are compared by compare_sites, with the site details from /admin/studysites
+def timezone_reason(timeZoneId):
+    """
+    Returns why a timeZoneId cannot be imported, with the closest timezones as suggestions.
+    """
+    candidates = timezone_candidates(timeZoneId)
+    return "TimeZoneId " + str(timeZoneId) + " not recognized." + (" Did you mean " + " or ".join(candidates) + "?" if candidates else "")
+
+
+def toTrueFalse(x):
+    """
+    Converts various values to True or False. Kept for existing scripts; the imports use normalize_boolean.
+    """
+    return normalize_boolean(x)
+
+
+compareFields = ["siteName", "countryCode", "timeZoneId", "expectedNumberOfSubjectsScreened", "expectedNumberOfSubjectsEnrolled",
+    "maximumNumberOfSubjectsScreened", "isTrainingEnabled", "isProductionEnabled"]
+
+
+def diff_sites(sitesToCompare, sites):
+    """
+    Compares the sites in the Excel file with the existing sites, joined on siteCode.
+    Blank cells in the Excel file are not compared.
+    Args:
+        sitesToCompare (DataFrame): The rows of the site import file.
+        sites (DataFrame): Study sites from /admin/studysites.
+    Returns:
+        (DataFrame): One row per changed field, with row, siteCode, siteGuid, field, old and new value and action
+            'changed'. Sites that do not exist have field None and action 'missing'.
+    """
+    # Convert the Excel values to the format returned by the API
+    wanted = sitesToCompare[["siteCode"] + compareFields].copy()
+    wanted["row"] = [i+2 for i in range(0, wanted.shape[0])]
+    wanted["timeZoneId"] = normalize_column(wanted["timeZoneId"], normalize_timezone).fillna(wanted["timeZoneId"])
+    for j in ["isTrainingEnabled", "isProductionEnabled"]:
+        wanted[j] = normalize_column(wanted[j], normalize_boolean)
+    wanted["countryCode"] = wanted["countryCode"].str.upper()
+    existing = sites.reindex(columns = ["siteGuid", "siteCode"] + compareFields).set_index("siteCode")
+    numericFields = ["expectedNumberOfSubjectsScreened", "expectedNumberOfSubjectsEnrolled", "maximumNumberOfSubjectsScreened"]
+    
+    changes = []
+    for site in wanted.to_dict("records"):
+        if(site["siteCode"] not in existing.index):
+            changes.append({"row": site["row"], "siteCode": site["siteCode"], "siteGuid": None, "field": None, "old": None, "new": None, "action": "missing"})
+            continue
+        current = existing.loc[site["siteCode"]]
+        for field in compareFields:
+            # Non-numeric values of the numeric fields are ignored, as in create_sites
+            if(pd.isnull(site[field]) or (field in numericFields and not site[field].isdigit())):
+                continue
+            old = current[field]
+            if(pd.isnull(old)):
+                old = None
+            elif(isinstance(old, float) and old.is_integer()):
+                old = str(int(old))  # Numbers become floats if some sites have no value
+            else:
+                old = str(old)
+            if(site[field] != old):
+                changes.append({"row": site["row"], "siteCode": site["siteCode"], "siteGuid": current["siteGuid"],
+                    "field": field, "old": old, "new": site[field], "action": "changed"})
+    return pd.DataFrame(changes, columns = ["row", "siteCode", "siteGuid", "field", "old", "new", "action"])
+
+
+def compare_sites(token, url, path, excelfile, sitecache = None):
+    """
+    Compares an Excel input with the existing sites, matched on siteCode, and saves a report of the fields that
+    differ, with the existing and the new value. Nothing is changed in the study: the Web API has no documented
+    endpoint to update a site, so the changed fields need to be updated in Viedoc Admin.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log and report should be saved.
+        excelfile (str): Path to the Excel file, in the site import template.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+    Returns:
+        (DataFrame): The report, see diff_sites. None if unsuccessful.
+    """
+    writelog("Loading data from Excel.", path)
+    try:  # Reading the Excel file within try statement, as permission may be denied
+        sitesToCompare = pd.read_excel(excelfile, dtype = str)
+    except:
+        writelog("Unable to read Excel file. Permission denied.\n", path)
+        return
+    if not all(value in sitesToCompare.columns for value in ["siteCode"] + compareFields):
+        writelog("Invalid data layout. Use the import template. Ending execution of this function.\n", path)
+        return
+    if(sitesToCompare["siteCode"].isna().any() or sitesToCompare["siteCode"].duplicated().any()):
+        writelog("SiteCode is missing or duplicated in the Excel file! Ending execution of this function.\n", path)
+        return
+    writelog("Retrieving existing sites from " + url + "/admin/studysites to compare.", path)
+    response = fetch_sites(token, url, path, sitecache, complete = True)
+    if(response is None):
+        return
+    sites = pd.DataFrame(response)
+    if sites.empty:
+        sites = pd.DataFrame(columns = ["siteGuid", "siteCode"] + compareFields)
+    if(sites["siteCode"].duplicated().any()):
+        writelog("SiteCode is not unique in the study. Sites with a duplicate siteCode are not compared.", path)
+        sites = sites.drop_duplicates("siteCode", keep = False)
+    
+    changes = diff_sites(sitesToCompare, sites)
+    changed = changes.loc[changes["action"] == "changed"]
+    writelog(str(changed["siteGuid"].nunique()) + " sites with " + str(changed.shape[0]) + " changed fields, " +
+        str((changes["action"] == "missing").sum()) + " sites not found in the study (use option 3 to create them).", path)
+    try:  # Writing the Excel file within try statement, as permission may be denied.
+        changes.to_excel(path + "compare_sites.xlsx", index = False, sheet_name = "Changes")
+        writelog("Report saved: " + path + "compare_sites.xlsx.\n", path)
+    except:
+        writelog("Unable to write Excel file. Permission denied.\n", path)
+    return changes
+
+
+def new_site_cache(ttl = 300, store = None):
+    """
+    Creates a site cache, to share the list of study sites between functions within a session.
+    Args:
+        ttl (int): Number of seconds a retrieved list of sites remains valid.
+        store (dict): Optional metadata store from open_store, to keep the sites and role assignments between runs.
+    Returns:
+        (dict): The empty site cache.
+    """
+    return {"ttl": ttl, "retrieved": None, "sites": [], "complete": True, "store": store}
+
+
+def fetch_sites(token, url, path, sitecache = None, complete = False, session = None):
+    """
+    Retrieves the study sites from /admin/studysites, or from the site cache if still valid.
+    Args:
+        token (str): Authentication token obtained from the STS server.
+        url (str): API URL obtained from Viedoc Admin.
+        path (str): Path where the log file should be saved.
+        sitecache (dict): Optional site cache of the session, see new_site_cache.
+        complete (bool): Whether all site details are needed. Sites added to the cache by
+            create_sites only contain the details sent to the API.
+        session (requests.Session): Optional session to reuse connections.
+    Returns:
+        (list): The sites as returned by the API. None if unsuccessful.
+    """
+    # Use the cached sites if they were retrieved less than ttl seconds ago
+    if(sitecache is not None and sitecache["retrieved"] is not None and time.time() - sitecache["retrieved"] < sitecache["ttl"]
+        and (sitecache["complete"] or not complete)):
+        writelog("Using list of sites retrieved " + str(int(time.time() - sitecache["retrieved"])) + " seconds ago.", path)
+        return list(sitecache["sites"])
+    
+    # Use the sites of the metadata store if they were stored less than its ttl ago
+    store = sitecache["store"] if sitecache is not None else None
+    age = store_age(store, "sites", complete)
+    if(age is not None):
+        writelog("Using list of sites stored in the metadata store " + str(int(age)) + " seconds ago.", path)
+        sites = load_stored_sites(store)
+        sitecache.update({"retrieved": time.time(), "sites": list(sites), "complete": store_age(store, "sites", True) is not None})
+        return sites
+    
+    header = { "Accept" : "application/json", "Authorization" : "Bearer " + token }
+    response = (session or requests).get(url + "/admin/studysites", headers = header)
+    if(response.status_code == 200):
+        writelog("Status code: 200 - Success.", path)
+    else:
+        check_list_status(response, path)
+        return None
+    sites = response.json()
+    if(sitecache is not None):
+        sitecache.update({"retrieved": time.time(), "sites": list(sites), "complete": True})
+    if(store is not None):
+        save_stored_sites(store, sites)
+    return sites
+
+
+def add_site_to_cache(sitecache, site):
+    """
+    Adds a created site to the site cache and the metadata store, so that later functions and runs see it
+    without retrieving all sites again.
+    """
+    if(sitecache is not None and sitecache["store"] is not None):
+        add_stored_site(sitecache["store"], site)
+    if(sitecache is None or sitecache["retrieved"] is None):
+        return
+    sitecache["sites"].append(site)
+    sitecache["complete"] = False
 
 
 def writelog(logtxt, path, disp = True, option = "standard"):
     """
     Writes message to log file and optionally prints it to the console.
+    When used as a library, path may instead be a function that receives each message (e.g. logging.info),
+    or None to not log at all.
     """
+    if path is None:
+        return
+    if callable(path):
+        path(str(logtxt))
+        return
+    
     # For option "firstentry"
     if option == "firstentry":
         # If a log file exists, then continue in the same file after a line of dashes -----
@@ -651,22 +1483,99 @@ def check_response_status(response, email, row, failed, usersAdded, userType, pa
     return failed, usersAdded
 
 
+def response_error_class(response):
+    """
+    Returns the error class of a failed API response, for the results of create_sites and create_users.
+    """
+    if(response.status_code == 400):
+        return "badRequest"
+    if(response.status_code == 403):
+        return "forbidden"
+    return "http" + str(response.status_code)
+
+
+def add_result(results, started, response, errorclass, **fields):
+    """
+    Adds the outcome of an Excel row to the results of create_sites or create_users.
+    Args:
+        results (list): The results so far.
+        started (float): time.perf_counter() when work on the row started.
+        response (Response): The last API response for the row. None if no request was sent.
+        errorclass (str): Short name of the reason the row failed or was skipped. None if successful.
+        fields: The row number, the identifying fields of the row, endpoint and siteGuid.
+    """
+    fields["statusCode"] = None if response is None else response.status_code
+    fields["errorClass"] = errorclass
+    fields["elapsedMs"] = round((time.perf_counter() - started) * 1000)
+    results.append(fields)
+
+
+def save_results(results, keycols, path, filename, resultsformat = "csv"):
+    """
+    Saves the results of create_sites or create_users, one line per Excel row (two for a site with a site
+    manager invite), so that failed rows can be selected without reading the log file.
+    Args:
+        results (list): The results, see add_result.
+        keycols (list): The row number and the identifying fields of the row.
+        path (str): Path where the results file should be saved.
+        filename (str): Name of the results file, without extension.
+        resultsformat (str): "csv", or "parquet" (requires pyarrow).
+    Returns:
+        (DataFrame): The results, with columns keycols, endpoint, statusCode, errorClass, elapsedMs and siteGuid.
+    """
+    results = pd.DataFrame(results, columns = keycols + ["endpoint", "statusCode", "errorClass", "elapsedMs", "siteGuid"])
+    results["statusCode"] = results["statusCode"].astype("Int64")
+    try:  # Writing the file within try statement, as permission may be denied
+        if(resultsformat == "parquet"):
+            results.to_parquet(path + filename + ".parquet", index = False)
+            writelog("Results saved: " + path + filename + ".parquet", path)
+        else:
+            results.to_csv(path + filename + ".csv", index = False)
+            writelog("Results saved: " + path + filename + ".csv", path)
+    except ImportError:
+        writelog("Unable to write Parquet file, pyarrow is not installed.", path)
+    except:
+        writelog("Unable to write results file. Permission denied.", path)
+    return results
+
+
+@functools.lru_cache(maxsize = None)
+def template_bytes(columns, columnwidths, textcolumn):
+    """
+    Builds an import template in memory. Built once per template and reused for every output folder.
+    Args:
+        columns (tuple): The column names.
+        columnwidths (tuple): The width of each column.
+        textcolumn (str): Letter of the column that is formatted as text (siteCode), so that codes such as 001 are kept.
+    Returns:
+        (bytes): The xlsx file.
+    """
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Template"
+    side = openpyxl.styles.Side(style = "thin")
+    for i, column in enumerate(columns):
+        cell = ws.cell(row = 1, column = i+1, value = column)
+        # Same header style as written by pandas
+        cell.font = openpyxl.styles.Font(bold = True)
+        cell.border = openpyxl.styles.Border(left = side, right = side, top = side, bottom = side)
+        cell.alignment = openpyxl.styles.Alignment(horizontal = "center", vertical = "top")
+        ws.column_dimensions[openpyxl.utils.get_column_letter(i+1)].width = columnwidths[i]  # Set column widths in Excel file
+    ws.column_dimensions[textcolumn].number_format = "@"  # Set the whole column to text type
+    f = io.BytesIO()
+    wb.save(f)
+    return f.getvalue()
+
+
 def create_site_import_template(path):
     """
     Creates an Excel file to import sites, if it does not exist yet.
     """
     if not os.path.isfile(path + "SitesToAdd_template.xlsx"):
-        writer = pd.ExcelWriter(path + "SitesToAdd_template.xlsx", engine = "openpyxl")
-        sitesTemplate = pd.DataFrame({"siteCode":[], "siteName":[], "countryCode":[], "timeZoneId":[], "expectedNumberOfSubjectsScreened":[],
-            "expectedNumberOfSubjectsEnrolled":[], "maximumNumberOfSubjectsScreened":[], "isTrainingEnabled":[], "isProductionEnabled":[], "roleSiteManager":[]})
-        sitesTemplate.to_excel(writer, index = False, sheet_name = "Template")
-        ws = writer.sheets["Template"]
-        columnwidths = {"A": 10, "B": 30, "C": 12, "D": 42, "E": 35, "F": 35, "G": 35, "H": 17, "I": 19, "J": 30}
-        for column in columnwidths.keys():
-            ws.column_dimensions[column].width = columnwidths[column]  # Set column widths in Excel file
-        for row in range(2,1001): 
-            ws['A'+str(row)].number_format = "@"  # Set siteCode column to text type
-        writer.close()
+        columns = ("siteCode", "siteName", "countryCode", "timeZoneId", "expectedNumberOfSubjectsScreened",
+            "expectedNumberOfSubjectsEnrolled", "maximumNumberOfSubjectsScreened", "isTrainingEnabled", "isProductionEnabled", "roleSiteManager")
+        with open(path + "SitesToAdd_template.xlsx", "wb") as f:
+            f.write(template_bytes(columns, (10, 30, 12, 42, 35, 35, 35, 17, 19, 30), "A"))
         print("Template for importing sites was not found in the selected folder. It has been created.")
 
 
@@ -675,25 +1584,7 @@ def create_user_import_template(path):
     Creates an Excel file to import users, if it does not exist yet.
     """
     if not os.path.isfile(path + "UsersToAdd_template.xlsx"):
-        writer = pd.ExcelWriter(path + "UsersToAdd_template.xlsx", engine = "openpyxl")
-        usersTemplate = pd.DataFrame({"email":[], "roleOID":[], "siteGuid":[], "siteName":[], "siteCode":[]})
-        usersTemplate.to_excel(writer, index = False, sheet_name = "Template")
-        ws = writer.sheets["Template"]
-        columnwidths = {"A": 30, "B": 25, "C": 37, "D": 30, "E": 10}
-        for column in columnwidths.keys():
-            ws.column_dimensions[column].width = columnwidths[column]  # Set column widths in Excel file
-        for row in range(2,1001):
-            ws['E'+str(row)].number_format = "@"  # Set siteCode column to text type
-        writer.close()
+        columns = ("email", "roleOID", "siteGuid", "siteName", "siteCode")
+        with open(path + "UsersToAdd_template.xlsx", "wb") as f:
+            f.write(template_bytes(columns, (30, 25, 37, 30, 10), "E"))
         print("Template for importing users was not found in the selected folder. It has been created.\n")
-
-
-def toTrueFalse(x):
-    """
-    Converts various values to True or False.
-    """
-    if(x in ["TRUE","True","true","T","t","Yes","yes","Y","y","1"]):
-        return "True"
-    if(x in ["FALSE","False","false","F","f","No","no","N","n","0"]):
-        return "False"
-    return x
\ No newline at end of file
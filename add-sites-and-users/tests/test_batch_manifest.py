@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_batch import read_manifest  # noqa: E402
+
+
+def write(tmp_path, text):
+    path = str(tmp_path / "studies.csv")
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def test_server_column_is_optional_with_urls(tmp_path):
+    studies = read_manifest(write(tmp_path, "study,clientId,clientSecret,tokenUrl,apiUrl\nA,id,secret,https://sts,https://api\n"))
+    assert studies[0]["server"] == ""
+    assert studies[0]["apiUrl"] == "https://api"
+
+
+def test_valid_server(tmp_path):
+    studies = read_manifest(write(tmp_path, "study,server,clientId,clientSecret\nA,10,id,secret\n"))
+    assert studies[0]["server"] == "10"
+
+
+@pytest.mark.parametrize("server", ["11", "0", "", "x"])
+def test_invalid_server_is_rejected(tmp_path, server):
+    with pytest.raises(ValueError, match = "B"):
+        read_manifest(write(tmp_path, "study,server,clientId,clientSecret\nA,1,id,secret\nB," + server + ",id,secret\n"))
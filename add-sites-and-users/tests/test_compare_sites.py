@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_import.site_user_functions import compareFields, diff_sites  # noqa: E402
+
+
+def test_diff_sites_lists_changed_fields_only():
+    sites = pd.DataFrame([{"siteGuid": "g1", "siteCode": "001", "siteName": "Old name", "countryCode": "SE", "timeZoneId": "W. Europe Standard Time",
+        "expectedNumberOfSubjectsScreened": 10, "expectedNumberOfSubjectsEnrolled": 5.0, "maximumNumberOfSubjectsScreened": None,
+        "isTrainingEnabled": True, "isProductionEnabled": False}])
+    excel = pd.DataFrame([
+        {"siteCode": "001", "siteName": "New name", "countryCode": "se", "timeZoneId": None, "expectedNumberOfSubjectsScreened": "10",
+            "expectedNumberOfSubjectsEnrolled": "5", "maximumNumberOfSubjectsScreened": None, "isTrainingEnabled": None, "isProductionEnabled": None},
+        {"siteCode": "002", **{x: None for x in compareFields}},
+    ]).astype(object)
+    changes = diff_sites(excel, sites)
+    assert changes[["siteCode", "field", "old", "new", "action"]].fillna("").values.tolist() == [
+        ["001", "siteName", "Old name", "New name", "changed"],
+        ["002", "", "", "", "missing"],
+    ]
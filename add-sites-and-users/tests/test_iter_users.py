@@ -0,0 +1,85 @@
+import os
+import sys
+
+import openpyxl
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_import.site_user_functions import iter_users, save_users_excel, userColumns  # noqa: E402
+
+
+class Response:
+    def __init__(self, userInfos):
+        self.status_code = 200
+        self.userInfos = userInfos
+
+    def json(self):
+        return {"userInfos": self.userInfos}
+
+
+class Session:
+    """
+    Fake session for /admin/users with a number of users. If paged is False, pageIndex and pageSize
+    are ignored and all users are returned, capped at cap users if given.
+    """
+    def __init__(self, users, paged = True, cap = None):
+        self.users = [{"userGuid": "u" + str(i), "email": str(i) + "@example.com", "displayName": str(i)} for i in range(users)]
+        self.paged = paged
+        self.cap = cap
+        self.requests = 0
+
+    def post(self, url, headers, json):
+        self.requests += 1
+        if self.paged:
+            start = json["pageIndex"] * json["pageSize"]
+            return Response(self.users[start:start + json["pageSize"]])
+        return Response(self.users[:self.cap])
+
+
+def guids(session, pagesize = 500):
+    return [x["userGuid"] for x in iter_users("token", "https://api", None, session, pagesize)]
+
+
+@pytest.mark.parametrize("users", [0, 1, 499, 500, 501, 1000, 1234])
+def test_paged_api_returns_all_users(users):
+    session = Session(users)
+    assert guids(session) == ["u" + str(i) for i in range(users)]
+    assert session.requests == users // 500 + 1
+
+
+@pytest.mark.parametrize("users", [499, 500, 501, 2000])
+def test_unpaged_api_returns_all_users(users):
+    # The API ignores the paging: the first page holds all users, or exactly 500 users are returned again
+    session = Session(users, paged = False)
+    assert guids(session) == ["u" + str(i) for i in range(users)]
+    assert session.requests <= 2
+
+
+def test_page_repeating_other_users_raises():
+    class Repeating(Session):
+        def post(self, url, headers, json):
+            self.requests += 1
+            page = json["pageIndex"]
+            return Response(self.users[0:2] if page == 0 else self.users[2:4] if page == 1 else self.users[1:3])
+    with pytest.raises(RuntimeError):
+        guids(Repeating(4), pagesize = 2)
+
+
+def test_save_users_excel_streams_chunks(tmp_path):
+    chunks = (pd.DataFrame([{"userGuid": "u" + str(i), "email": "e" + str(i), "displayName": "d", "roleName": "Monitor",
+        "siteGuid": "s", "siteName": None, "siteCode": "1", "access_to_siteGroup": "No"}]) for i in range(3))
+    path = str(tmp_path) + os.sep
+    assert save_users_excel(chunks, path) == 3
+    rows = list(openpyxl.load_workbook(path + "export_studyUsers.xlsx")["Export"].values)
+    assert list(rows[0]) == userColumns
+    assert [row[0] for row in rows[1:]] == ["u0", "u1", "u2"]
+    assert rows[1][5] is None
+
+
+def test_save_users_excel_raises_when_users_fail(tmp_path):
+    def chunks():
+        yield pd.DataFrame([{"userGuid": "u0"}])
+        raise RuntimeError("Users could not be retrieved.")
+    with pytest.raises(RuntimeError):
+        save_users_excel(chunks(), str(tmp_path) + os.sep)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_import import toTrueFalse  # noqa: E402
+from site_user_import.normalization import normalize_timezone, timezone_candidates  # noqa: E402
+
+
+@pytest.mark.parametrize("value, tzid", [("W. Europe Standard Time", "W. Europe Standard Time"), ("berlin", "W. Europe Standard Time"),
+    ("UTC+04:30", "Afghanistan Standard Time")])
+def test_recognized_timezones(value, tzid):
+    assert normalize_timezone(value) == tzid
+
+
+def test_misspelled_timezone_is_not_converted():
+    assert normalize_timezone("X. Europe Standard Time") is None
+    assert {"W. Europe Standard Time", "E. Europe Standard Time"} <= set(timezone_candidates("X. Europe Standard Time"))
+
+
+def test_toTrueFalse_is_exported():
+    assert toTrueFalse("y") == "True"
+    assert toTrueFalse("No") == "False"
+    assert toTrueFalse("maybe") == "maybe"
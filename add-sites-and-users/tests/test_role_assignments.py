@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_import import site_user_functions  # noqa: E402
+from site_user_import.metadata_store import open_store, save_stored_roles  # noqa: E402
+from site_user_import.site_user_functions import load_role_assignments, new_site_cache  # noqa: E402
+
+
+class Response:
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+    def json(self):
+        return self.content
+
+
+class Api:
+    """
+    Fake /admin/users and /admin/users/{userGuid}/roles with three users, each with one role at site s1.
+    """
+    def __init__(self):
+        self.users = [{"userGuid": "u" + str(i), "email": "User" + str(i) + "@example.com", "displayName": str(i)} for i in range(3)]
+        self.roles = {x["userGuid"]: [{"roleId": "R1", "roleName": "Monitor", "siteGuids": ["s1"], "siteGroupGuids": None}] for x in self.users}
+        self.rolerequests = []
+
+    def post(self, url, headers, json):
+        return Response({"userInfos": self.users})
+
+    def get(self, url, headers):
+        guid = url.split("/")[-2]
+        self.rolerequests.append(guid)
+        return Response({"roles": self.roles[guid]})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = Api()
+    monkeypatch.setattr(site_user_functions, "requests", api)
+    monkeypatch.setattr(site_user_functions, "fetch_sites", lambda *args, **kwargs: [])
+    return api
+
+
+def test_roles_only_retrieved_for_emails(api):
+    assignments = load_role_assignments("token", "https://api", None, emails = {"user1@example.com"})
+    assert api.rolerequests == ["u1"]
+    assert assignments == {("user1@example.com", "r1", "s1"), ("user1@example.com", "monitor", "s1")}
+
+
+def test_roles_retrieved_for_all_users(api):
+    assignments = load_role_assignments("token", "https://api", None)
+    assert api.rolerequests == ["u0", "u1", "u2"]
+    assert len(assignments) == 6
+
+
+def test_stored_roles_are_checked_against_the_api(api, tmp_path):
+    store = open_store(str(tmp_path / "metadata.db"), "https://api", "study")
+    save_stored_roles(store, [{"userGuid": "u1", "email": "user1@example.com", "displayName": "1", "roleOID": "R1",
+        "roleName": "Monitor", "siteGuid": "s1"}])
+    api.roles["u1"] = []  # Revoked in Viedoc since it was stored
+    assignments = load_role_assignments("token", "https://api", None, new_site_cache(store = store), emails = {"user1@example.com"})
+    assert api.rolerequests == ["u1"]
+    assert assignments == set()
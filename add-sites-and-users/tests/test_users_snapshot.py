@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_user_import import site_user_functions  # noqa: E402
+from site_user_import.site_user_functions import get_users, load_users_snapshot  # noqa: E402
+
+
+class Response:
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+    def json(self):
+        return self.content
+
+
+class Api:
+    """
+    Fake /admin/users and /admin/users/{userGuid}/roles with two users, each with one role at site s1.
+    """
+    def __init__(self):
+        self.users = [{"userGuid": "u" + str(i), "email": "user" + str(i) + "@example.com", "displayName": str(i)} for i in range(2)]
+        self.rolerequests = []
+
+    def post(self, url, headers, json):
+        return Response({"userInfos": self.users})
+
+    def get(self, url, headers):
+        self.rolerequests.append(url.split("/")[-2])
+        return Response({"roles": [{"roleId": "R1", "roleName": "Monitor", "siteGuids": ["s1"], "siteGroupGuids": None}]})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = Api()
+    monkeypatch.setattr(site_user_functions, "requests", api)
+    monkeypatch.setattr(site_user_functions, "fetch_sites", lambda *args, **kwargs: [])
+    return api
+
+
+@pytest.mark.parametrize("content", ['{"users": {}}', '{"export": []}', '[]', '{"users": {"u0": {"info": {}}}, "export": null}', 'not json'])
+def test_invalid_snapshot_is_empty(tmp_path, content):
+    path = str(tmp_path) + os.sep
+    with open(path + "snapshot_studyUsers.json", "w") as f:
+        f.write(content)
+    assert load_users_snapshot(path) == {"users": {}, "export": None}
+
+
+def test_incremental_run_retrieves_stale_roles(api, tmp_path):
+    path = str(tmp_path) + os.sep
+    assert get_users("token", "https://api", path, incremental = True) == 2
+    assert api.rolerequests == ["u0", "u1"]
+    # Unchanged users are taken from the snapshot
+    api.rolerequests = []
+    assert get_users("token", "https://api", path, incremental = True) == 2
+    assert api.rolerequests == []
+    # The roles of u1 were retrieved too long ago, so they are retrieved again
+    with open(path + "snapshot_studyUsers.json") as f:
+        snapshot = json.load(f)
+    snapshot["users"]["u1"]["checked"] = time.time() - 2 * 86400
+    with open(path + "snapshot_studyUsers.json", "w") as f:
+        json.dump(snapshot, f)
+    assert get_users("token", "https://api", path, incremental = True) == 2
+    assert api.rolerequests == ["u1"]
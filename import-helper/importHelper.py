@@ -1,119 +1,394 @@
-print('''Viedoc Data Import Application Helper, version 1.\n
-
-This application helps with the setup of data imports via the Data Import Application.
-Step 1: Create your data mappings in Viedoc Designer - Global Design Settings.
-Step 2: Publish your Global Design Settings and download the mapping files.
-Step 3: Create one main folder for your imports and place all your mapping files in it.
-Step 4: Create a WCF API client in Viedoc Admin. Copy the GUID.
-Step 5: Run this application.
-''')
-
 from tkinter import Tk
 from tkinter.filedialog import askdirectory,askopenfilename
 import os.path
 import os
 import re
 import csv
+import sys
+import argparse
+import io
+from profiling import start_profile, stop_profile
+from xml.sax.saxutils import XMLGenerator
+from concurrent.futures import ProcessPoolExecutor
+
+#WCF API URLs per server type, in the order of the server regions:
+servers = {"Production": ["https://v4api.viedoc.net/HelipadService.svc", "https://api.us.viedoc.com/HelipadService.svc", "https://v4apijp.viedoc.net/HelipadService.svc", "https://api.viedoc.cn/HelipadService.svc"],
+    "Training": ["https://v4apitraining.viedoc.net/HelipadService.svc", "https://apitraining.us.viedoc.com/HelipadService.svc", "https://v4apitrainingjp.viedoc.net/HelipadService.svc", "https://apitraining.viedoc.cn/HelipadService.svc"]}
+serverRegions = ["EU", "US", "Japan", "China"]
+yes = ["Y", "Yes", "y", "yes", "True", "true", "1"]
+#Set to False by --profile, so that the checks run in this process, where they are seen by the profiler
+parallel = True
+
+#All mapping file checks, combined in one pattern so that each file is scanned only once:
+#- {SiteCode}: the mapping file must contain a mapped {SiteCode}
+#- {THIS: sometimes the $-sign is forgotten in $THIS
+#- &#xA;: newlines in the Column Name are indicated &#xa; and can interfere with the mapping
+#- whitespace: extra whitespaces at the end of the Column Name can interfere with the mapping
+mappingChecks = re.compile(r'(?P<SiteCode>\{SiteCode\})|(?P<THIS>\{THIS)|SASFieldName="(?P<newline>[\w\s]+)&#xA;|SASFieldName="(?P<whitespace>[\w\s]+)\s">')
+
+def checkMappingFile(path):
+    #This function searches one mapping file for some common mistakes, in one pass over the whole file,
+    #so that a column name split over several lines is found as well. {THIS is reported once per file.
+    #Returns a list of findings, each a dict with the file, line number (of the first occurrence), check, column name and message.
+    name = os.path.basename(path)
+    findings = []
+    siteCode = False
+    this = False
+    with open(path, "r", encoding = "utf-8", errors = "replace") as f:
+        mf = f.read()
+    lineNr = 1
+    position = 0
+    for match in mappingChecks.finditer(mf):
+        lineNr += mf.count("\n", position, match.start())
+        position = match.start()
+        if match.lastgroup == "SiteCode":
+            siteCode = True
+        elif match.lastgroup == "THIS" and not this:
+            this = True
+            findings.append({"file": name, "line": lineNr, "check": "THIS", "column": None,
+                "message": "THIS used instead of $THIS in mapping file " + name + "!"})
+        elif match.lastgroup == "newline":
+            findings.append({"file": name, "line": lineNr, "check": "newline", "column": match.group("newline"),
+                "message": "There is a newline in column name " + match.group("newline") + " in mapping file " + name + "!"})
+        elif match.lastgroup == "whitespace":
+            findings.append({"file": name, "line": lineNr, "check": "whitespace", "column": match.group("whitespace"),
+                "message": "There is a whitespace at the end of column name " + match.group("whitespace") + " in mapping file " + name + "!"})
+    if not siteCode:
+        findings.insert(0, {"file": name, "line": None, "check": "SiteCode", "column": None,
+            "message": "SiteCode not defined in mapping file " + name + "!"})
+    return findings
 
 def checkMappingFiles(pars):
-    #This function searches the mapping files for some common mistakes.
-    warnings = 0
-    for i in pars["mappingfiles"]:
-        with open(pars["path"] + "/" + i, "r") as f:
-            mf = f.read()
-        #The mapping file must contain a mapped {SiteCode}:
-        if not re.search("{SiteCode}", mf):
-            print("SiteCode not defined in mapping file " + i + "!")
-            warnings += 1
-        #Sometimes the $-sign is forgotten in $THIS:
-        if re.search("{THIS", mf):
-            print("THIS used instead of $THIS in mapping file " + i + "!")
-            warnings += 1
-        #Newlines in the Column Name are indicated &#xa; and can interfere with the mapping:
-        newlines = re.findall("(?<=SASFieldName=\")[\w\s]+(?=&#xA;)", mf)
-        for j in newlines:
-            print("There is a newline in column name " + j + " in mapping file " + i + "!")
-            warnings += 1
-        #Extra whitespaces at the end of the Column Name can interfere with the mapping:
-        extraspaces = re.findall("(?<=SASFieldName=\")[\w\s]+(?=\s\"\>)", mf)
-        for j in extraspaces:
-            print("There is a whitespace at the end of column name " + j + " in mapping file " + i + "!")
-            warnings += 1
-    return warnings
+    #This function searches the mapping files for some common mistakes, checking the files in parallel.
+    #Returns the findings of all files, in the order of pars["mappingfiles"].
+    results = checkMappingPaths([mappingFilePath(pars, i) for i in pars["mappingfiles"]])
+    return [finding for result in results for finding in result]
 
-def writexml(pars):
-    with open(pars["path"] + "/" + "config.xml", "a") as f:
-        f.write('<?xml version="1.0" encoding="utf-8"?>')
-        f.write('\n<ViedocImportConfiguration xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">\n')
-        f.write('<BasePath>' + pars["path"] + '</BasePath>\n')
-        for i in pars["mappingfiles"]:
-            f.write('<ImportConfiguration>\n')
-            f.write('<FolderName>' + i[:-4] + '</FolderName>\n')
-            f.write('<DefineXmlFileName>' + i + '</DefineXmlFileName>\n')
-            f.write('<FileEncoding>utf-8</FileEncoding>\n')
-            f.write('<FileDelimiter>' + pars["delimiter"] + '</FileDelimiter>\n')
-            f.write('<ApiUrl>' + pars["server"] + '</ApiUrl>\n')
-            f.write('<ClientGuid>' + pars["GUID"] + '</ClientGuid>\n')
-            f.write('<UserName>' + pars["email"] + '</UserName>\n')
-            f.write('<AllowCreatingSubjects>' + pars["createSubj"] + '</AllowCreatingSubjects>\n')
-            f.write('<AllowInitiatingStudyEvents>' + pars["initEvent"] + '</AllowInitiatingStudyEvents>\n')
-            f.write('</ImportConfiguration>\n')
-        f.write('</ViedocImportConfiguration>')
-
-runApp = input("Did you complete the above steps? [Y/N]: ").strip()
-yes = ["Y", "Yes", "y", "yes", "True", "true", "1"]
-if runApp in yes:
-    root = Tk()
-    root.attributes("-topmost", True)
-    root.withdraw()
-    pars = {}
-    print("Select the main folder for your imports (containing the mapping files).")
-    pars["path"] = askdirectory(title = "Select the main folder for your imports.", parent = root)
-    pars["mappingfiles"] = [x for x in os.listdir(pars["path"]) if x.endswith(".xml")]
-    print("")
-    warnings = checkMappingFiles(pars)
-    if warnings == 1:
-        print("\nThere was " + str(warnings) + " warning about your mapping file(s). It is recommended to fix it first.")
-        runApp = input("Continue running this program anyway? [Y/N]: ").strip()
-    if warnings > 1:
-        print("\nThere were " + str(warnings) + " warnings about your mapping file(s). It is recommended to fix them first.")
-        runApp = input("Continue running this program anyway? [Y/N]: ").strip()
-if runApp in yes:
-    print("Select one of your CSV files.")
-    csvFile = askopenfilename(title = "Select one of your CSV files.", parent = root)
-    with open(csvFile) as f:
-        pars["delimiter"] = csv.Sniffer().sniff(f.read(1000)).delimiter
-    print('The delimiter in your CSV file is "' + pars["delimiter"] + '".')
-    serverType = 0
-    while serverType not in ["1", "2"]:
-        serverType = input("On which server TYPE is your study? 1=Production, 2=Training [1/2]: ").strip()
-    if serverType == "1":
-        serveroptions = ["https://v4api.viedoc.net/HelipadService.svc", "https://api.us.viedoc.com/HelipadService.svc", "https://v4apijp.viedoc.net/HelipadService.svc", "https://api.viedoc.cn/HelipadService.svc"]
-    elif serverType == "2":
-        serveroptions = ["https://v4apitraining.viedoc.net/HelipadService.svc", "https://apitraining.us.viedoc.com/HelipadService.svc", "https://v4apitrainingjp.viedoc.net/HelipadService.svc", "https://apitraining.viedoc.cn/HelipadService.svc"]
-    serverRegion = 0
-    while serverRegion not in ["1", "2", "3", "4"]:
-        serverRegion = input("On which server REGION is your study? 1=EU, 2=US, 3=Japan, 4=China [1/2/3/4]: ").strip()
-    pars["server"] = serveroptions[int(serverRegion) - 1]
-    pars["GUID"] = ""
-    while not re.search(r"^[0-9a-f-]{36}$", pars["GUID"]):
-        pars["GUID"] = input("Provide the study GUID obtained from Viedoc Admin - API Configuration: ").strip()
-    pars["email"] = ""
-    while not re.search(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+.[a-zA-Z]{2,}$', pars["email"]):
-        pars["email"] = input("What is the email address for the account performing the imports?: ").strip()
-    pars["createSubj"] = "true" if input("Is the import allowed to create subjects? [Y/N]: ").strip() in yes else "false"
-    pars["initEvent"] = "true" if input("Is the import allowed to initiate events? [Y/N]: ").strip() in yes else "false"
+def checkMappingPaths(paths):
+    #This function checks the mapping files at the given paths in parallel and returns the findings per file.
+    if len(paths) <= 1 or not parallel:
+        results = [checkMappingFile(i) for i in paths]
+    else:
+        with ProcessPoolExecutor() as pool:
+            results = list(pool.map(checkMappingFile, paths, chunksize = max(1, len(paths) // (4 * (os.cpu_count() or 1)))))
+    return results
+
+def findMappingFiles(path):
+    #This function lists the mapping files of an import folder: the XML files in the main folder (except config.xml),
+    #and the mapping files already moved to their subfolder by a previous run.
+    mappingfiles = []
+    for x in sorted(os.listdir(path)):
+        if x.endswith(".xml") and x != "config.xml" and os.path.isfile(path + "/" + x):
+            mappingfiles.append(x)
+        elif os.path.isfile(path + "/" + x + "/" + x + ".xml"):
+            mappingfiles.append(x + ".xml")
+    return mappingfiles
+
+def mappingFilePath(pars, i):
+    #This function returns the current location of a mapping file, in the main folder or in its subfolder.
+    if os.path.isfile(pars["path"] + "/" + i):
+        return pars["path"] + "/" + i
+    return pars["path"] + "/" + i[:-4] + "/" + i
+
+def sniffDelimiter(path):
+    #This function determines the delimiter from the first CSV file found in the import folder or its subfolders.
+    for folder, subfolders, files in os.walk(path):
+        for x in sorted(files):
+            if x.lower().endswith(".csv"):
+                with open(folder + "/" + x) as f:
+                    return csv.Sniffer().sniff(f.read(1000)).delimiter
+    return ","
+
+def setupImportFolder(pars):
+    #This function writes the config.xml and moves each mapping file into its own subfolder.
     writexml(pars)
-    print("\nConfiguration file created!")
     for i in pars["mappingfiles"]:
         if not os.path.exists(pars["path"] + "/" + i[:-4]):
             os.makedirs(pars["path"] + "/" + i[:-4])
-        os.rename(pars["path"] + "/" + i, pars["path"] + "/" + i[:-4] + "/" + i)
-    print('''Subfolders created for each import (for each mapping file).
+        if os.path.isfile(pars["path"] + "/" + i):
+            os.rename(pars["path"] + "/" + i, pars["path"] + "/" + i[:-4] + "/" + i)
+
+def readManifest(manifestFile):
+    #This function reads the batch manifest (CSV) with one import folder per row and returns the pars per folder.
+    #Columns: path, serverType (Production/Training) and serverRegion (EU/US/Japan/China) or server (the API URL),
+    #GUID, email, createSubj (Y/N), initEvent (Y/N) and optionally delimiter.
+    allPars = []
+    with open(manifestFile, newline = "") as f:
+        for rowNr, row in enumerate(csv.DictReader(f), start = 2):
+            pars = {"path": os.path.abspath(row["path"]).replace("\\", "/"), "GUID": row["GUID"].strip(), "email": row["email"].strip(),
+                "createSubj": "true" if row.get("createSubj", "").strip() in yes else "false",
+                "initEvent": "true" if row.get("initEvent", "").strip() in yes else "false",
+                "delimiter": row.get("delimiter") or None}
+            if row.get("server"):
+                pars["server"] = row["server"].strip()
+            elif row.get("serverType", "").strip() in servers and row.get("serverRegion", "").strip() in serverRegions:
+                pars["server"] = servers[row["serverType"].strip()][serverRegions.index(row["serverRegion"].strip())]
+            else:
+                print("Row " + str(rowNr) + " of the manifest: invalid server. Skipping " + pars["path"] + ".")
+                continue
+            if not re.search(r"^[0-9a-f-]{36}$", pars["GUID"]):
+                print("Row " + str(rowNr) + " of the manifest: invalid study GUID. Skipping " + pars["path"] + ".")
+                continue
+            if not re.search(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+.[a-zA-Z]{2,}$', pars["email"]):
+                print("Row " + str(rowNr) + " of the manifest: invalid email address. Skipping " + pars["path"] + ".")
+                continue
+            if not os.path.isdir(pars["path"]):
+                print("Row " + str(rowNr) + " of the manifest: folder " + pars["path"] + " does not exist. Skipping.")
+                continue
+            allPars.append(pars)
+    return allPars
+
+def runBatch(manifestFile, ignoreWarnings = False):
+    #This function sets up all import folders in the manifest without user interaction.
+    #The mapping files of all folders are checked together in parallel. Folders with warnings are skipped, unless ignoreWarnings.
+    #Returns the number of folders set up.
+    allPars = readManifest(manifestFile)
+    for pars in allPars:
+        pars["mappingfiles"] = findMappingFiles(pars["path"])
+    results = checkMappingPaths([mappingFilePath(pars, i) for pars in allPars for i in pars["mappingfiles"]])
+    done = 0
+    for pars in allPars:
+        #The results are in the order of the folders and their mapping files
+        folderFindings = [finding for result in results[:len(pars["mappingfiles"])] for finding in result]
+        results = results[len(pars["mappingfiles"]):]
+        for i in folderFindings:
+            print(pars["path"] + ": " + i["message"] + ("" if i["line"] is None else " (line " + str(i["line"]) + ")"))
+        if folderFindings and not ignoreWarnings:
+            print(pars["path"] + ": skipped because of " + str(len(folderFindings)) + " warning(s).")
+            continue
+        if not pars["delimiter"]:
+            pars["delimiter"] = sniffDelimiter(pars["path"])
+        setupImportFolder(pars)
+        print(pars["path"] + ": configuration file created for " + str(len(pars["mappingfiles"])) + " mapping file(s).")
+        done += 1
+    print("\n" + str(done) + " of " + str(len(allPars)) + " import folders set up.")
+    return done
+
+sasFieldNames = re.compile(r'SASFieldName="([^"]*)"')
+invalidBytes = re.compile("[\udc80-\udcff]")  #Bytes that are not valid utf-8, decoded with surrogateescape
+
+def mappingColumns(path):
+    #This function returns the column names (SASFieldName) defined in a mapping file, reading it line by line.
+    columns = []
+    with open(path, "r", encoding = "utf-8", errors = "replace") as f:
+        for line in f:
+            columns.extend(x.replace("&#xA;", "").strip() for x in sasFieldNames.findall(line))
+    return list(dict.fromkeys(columns))
+
+def preflightCsv(csvPath, columns, delimiter):
+    #This function checks one CSV data file against the columns of its mapping file, streaming it in buffered chunks.
+    #It checks the header, the encoding (utf-8), the delimiter and the number of fields per row.
+    #Returns a profile of the file, with a list of findings in the same format as checkMappingFile.
+    name = os.path.basename(csvPath)
+    profile = {"file": csvPath, "rows": 0, "delimiter": None, "findings": []}
+    findings = profile["findings"]
+    with open(csvPath, "rb") as raw:
+        text = io.TextIOWrapper(io.BufferedReader(raw, 1024 * 1024), encoding = "utf-8-sig", errors = "surrogateescape", newline = "")
+        sample = text.read(1000)
+        try:
+            profile["delimiter"] = csv.Sniffer().sniff(sample).delimiter
+        except csv.Error:
+            profile["delimiter"] = delimiter
+        if profile["delimiter"] != delimiter:
+            findings.append({"file": name, "line": 1, "check": "delimiter", "column": None,
+                "message": "The delimiter in CSV file " + name + " is \"" + profile["delimiter"] + "\" instead of \"" + delimiter + "\"!"})
+        text.seek(0)
+        
+        encodingLine = [None]
+        def lines():
+            #Yields the lines of the file, and remembers the first line that is not valid utf-8
+            for lineNr, line in enumerate(text, start = 1):
+                if encodingLine[0] is None and invalidBytes.search(line):
+                    encodingLine[0] = lineNr
+                yield line
+        reader = csv.reader(lines(), delimiter = delimiter)
+        header = next(reader, [])
+        header = [x.strip() for x in header]
+        for x in columns:
+            if x not in header:
+                findings.append({"file": name, "line": 1, "check": "missingColumn", "column": x,
+                    "message": "Column " + x + " of the mapping file is missing in CSV file " + name + "!"})
+        for x in header:
+            if x not in columns:
+                findings.append({"file": name, "line": 1, "check": "unmappedColumn", "column": x,
+                    "message": "Column " + x + " in CSV file " + name + " is not in the mapping file!"})
+        badRows = 0
+        for row in reader:
+            profile["rows"] += 1
+            if len(row) != len(header) and row:
+                badRows += 1
+                if badRows == 1:
+                    firstBadRow = reader.line_num
+        if badRows > 0:
+            findings.append({"file": name, "line": firstBadRow, "check": "fieldCount", "column": None,
+                "message": str(badRows) + " row(s) in CSV file " + name + " do not have " + str(len(header)) + " fields, the first at line " + str(firstBadRow) + "!"})
+        if encodingLine[0] is not None:
+            findings.append({"file": name, "line": encodingLine[0], "check": "encoding", "column": None,
+                "message": "CSV file " + name + " is not utf-8 encoded (first invalid character at line " + str(encodingLine[0]) + ")!"})
+        if profile["rows"] == 0:
+            findings.append({"file": name, "line": None, "check": "empty", "column": None,
+                "message": "CSV file " + name + " does not contain any data rows!"})
+        text.detach()
+    return profile
+
+def preflightFolder(pars):
+    #This function checks all CSV files in the subfolders of an import folder in parallel.
+    #Returns the profiles of the CSV files, in the order of the mapping files.
+    jobs = []
+    for i in pars["mappingfiles"]:
+        folder = pars["path"] + "/" + i[:-4]
+        if not os.path.isdir(folder):
+            continue
+        columns = mappingColumns(mappingFilePath(pars, i))
+        for x in sorted(os.listdir(folder)):
+            if x.lower().endswith(".csv"):
+                jobs.append((folder + "/" + x, columns, pars["delimiter"]))
+    if len(jobs) <= 1 or not parallel:
+        return [preflightCsv(*job) for job in jobs]
+    with ProcessPoolExecutor() as pool:
+        return list(pool.map(preflightCsv, *zip(*jobs)))
+
+def runPreflight(manifestFile):
+    #This function runs the pre-flight checks for all import folders in the manifest and prints the findings.
+    #Returns the number of findings.
+    warnings = 0
+    for pars in readManifest(manifestFile):
+        pars["mappingfiles"] = findMappingFiles(pars["path"])
+        if not pars["delimiter"]:
+            pars["delimiter"] = sniffDelimiter(pars["path"])
+        for profile in preflightFolder(pars):
+            print(profile["file"] + ": " + str(profile["rows"]) + " rows.")
+            for i in profile["findings"]:
+                print("    " + i["message"])
+            warnings += len(profile["findings"])
+    print("\nPre-flight check completed with " + str(warnings) + " warning(s).")
+    return warnings
+
+def configModel(pars):
+    #This function builds the content of config.xml: the base path and one import configuration per mapping file.
+    #Each import configuration is a list of (element, value) pairs, in the order in which they are written.
+    return {"BasePath": pars["path"],
+        "ImportConfigurations": [[("FolderName", i[:-4]),
+            ("DefineXmlFileName", i),
+            ("FileEncoding", "utf-8"),
+            ("FileDelimiter", pars["delimiter"]),
+            ("ApiUrl", pars["server"]),
+            ("ClientGuid", pars["GUID"]),
+            ("UserName", pars["email"]),
+            ("AllowCreatingSubjects", pars["createSubj"]),
+            ("AllowInitiatingStudyEvents", pars["initEvent"])] for i in pars["mappingfiles"]]}
+
+def writexml(pars, model = None):
+    #This function writes config.xml with a streaming XML writer, which escapes all values.
+    #The file is written to a temporary file first and then renamed, so an existing config.xml is replaced in one step.
+    if model is None:
+        model = configModel(pars)
+    configFile = pars["path"] + "/" + "config.xml"
+    with open(configFile + ".tmp", "w", encoding = "utf-8") as f:
+        xml = XMLGenerator(f, encoding = "utf-8")
+        xml.startDocument()
+        xml.startElement("ViedocImportConfiguration", {"xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance", "xmlns:xsd": "http://www.w3.org/2001/XMLSchema"})
+        xml.ignorableWhitespace("\n")
+        writeElement(xml, "BasePath", model["BasePath"])
+        for importConfiguration in model["ImportConfigurations"]:
+            xml.startElement("ImportConfiguration", {})
+            xml.ignorableWhitespace("\n")
+            for element, value in importConfiguration:
+                writeElement(xml, element, value)
+            xml.endElement("ImportConfiguration")
+            xml.ignorableWhitespace("\n")
+        xml.endElement("ViedocImportConfiguration")
+        xml.endDocument()
+    os.replace(configFile + ".tmp", configFile)
+
+def writeElement(xml, element, value):
+    #This function writes one element with a text value on its own line.
+    xml.startElement(element, {})
+    xml.characters(value)
+    xml.endElement(element)
+    xml.ignorableWhitespace("\n")
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    parser = argparse.ArgumentParser(description = "Viedoc Data Import Application Helper, batch mode")
+    parser.add_argument("--manifest", required = True, help = "CSV file with one import folder per row")
+    parser.add_argument("--ignore_warnings", required = False, default = "N", choices = ["Y", "N"], help = "Set up folders with mapping file warnings (Y/N)")
+    parser.add_argument("--preflight", required = False, default = "N", choices = ["Y", "N"], help = "Only check the CSV files placed in the subfolders (Y/N)")
+    parser.add_argument("--profile", required = False, default = "N", choices = ["Y", "N"], help = "Profile the run in one process and summarize the hotspots (Y/N)")
+    args = parser.parse_args()
+    if args.profile == "Y":
+        #The profile is saved next to the manifest
+        parallel = False
+        profile = start_profile()
+    try:
+        if args.preflight == "Y":
+            runPreflight(args.manifest)
+        else:
+            runBatch(args.manifest, args.ignore_warnings == "Y")
+    finally:
+        if args.profile == "Y":
+            prefix = os.path.join(os.path.dirname(os.path.abspath(args.manifest)), "profile")
+            print(stop_profile(profile, prefix))
+            print("Profile saved to " + prefix + ".prof and " + prefix + "_hotspots.txt.")
+elif __name__ == "__main__":
+    print('''Viedoc Data Import Application Helper, version 1.\n
+
+This application helps with the setup of data imports via the Data Import Application.
+Step 1: Create your data mappings in Viedoc Designer - Global Design Settings.
+Step 2: Publish your Global Design Settings and download the mapping files.
+Step 3: Create one main folder for your imports and place all your mapping files in it.
+Step 4: Create a WCF API client in Viedoc Admin. Copy the GUID.
+Step 5: Run this application.
+''')
+
+    runApp = input("Did you complete the above steps? [Y/N]: ").strip()
+    if runApp in yes:
+        root = Tk()
+        root.attributes("-topmost", True)
+        root.withdraw()
+        pars = {}
+        print("Select the main folder for your imports (containing the mapping files).")
+        pars["path"] = askdirectory(title = "Select the main folder for your imports.", parent = root)
+        pars["mappingfiles"] = findMappingFiles(pars["path"])
+        print("")
+        findings = checkMappingFiles(pars)
+        for i in findings:
+            print(i["message"] + ("" if i["line"] is None else " (line " + str(i["line"]) + ")"))
+        warnings = len(findings)
+        if warnings == 1:
+            print("\nThere was " + str(warnings) + " warning about your mapping file(s). It is recommended to fix it first.")
+            runApp = input("Continue running this program anyway? [Y/N]: ").strip()
+        if warnings > 1:
+            print("\nThere were " + str(warnings) + " warnings about your mapping file(s). It is recommended to fix them first.")
+            runApp = input("Continue running this program anyway? [Y/N]: ").strip()
+    if runApp in yes:
+        print("Select one of your CSV files.")
+        csvFile = askopenfilename(title = "Select one of your CSV files.", parent = root)
+        with open(csvFile) as f:
+            pars["delimiter"] = csv.Sniffer().sniff(f.read(1000)).delimiter
+        print('The delimiter in your CSV file is "' + pars["delimiter"] + '".')
+        serverType = 0
+        while serverType not in ["1", "2"]:
+            serverType = input("On which server TYPE is your study? 1=Production, 2=Training [1/2]: ").strip()
+        serveroptions = servers["Production"] if serverType == "1" else servers["Training"]
+        serverRegion = 0
+        while serverRegion not in ["1", "2", "3", "4"]:
+            serverRegion = input("On which server REGION is your study? 1=EU, 2=US, 3=Japan, 4=China [1/2/3/4]: ").strip()
+        pars["server"] = serveroptions[int(serverRegion) - 1]
+        pars["GUID"] = ""
+        while not re.search(r"^[0-9a-f-]{36}$", pars["GUID"]):
+            pars["GUID"] = input("Provide the study GUID obtained from Viedoc Admin - API Configuration: ").strip()
+        pars["email"] = ""
+        while not re.search(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+.[a-zA-Z]{2,}$', pars["email"]):
+            pars["email"] = input("What is the email address for the account performing the imports?: ").strip()
+        pars["createSubj"] = "true" if input("Is the import allowed to create subjects? [Y/N]: ").strip() in yes else "false"
+        pars["initEvent"] = "true" if input("Is the import allowed to initiate events? [Y/N]: ").strip() in yes else "false"
+        setupImportFolder(pars)
+        print("\nConfiguration file created!")
+        print('''Subfolders created for each import (for each mapping file).
 
     \nNext steps:
 1. Download the Data Import Application from Viedoc Designer.
 2. Place your CSV data files in the correct subfolders.
 3. Run the Data Import Application.
 4. (Optional) Set up Task Scheduler: https://help.viedoc.net/l/5b5c16/en/''')
-print("Program ended.")
\ No newline at end of file
+    print("Program ended.")
\ No newline at end of file
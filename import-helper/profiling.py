@@ -0,0 +1,45 @@
+import cProfile
+import io
+import os
+import pstats
+
+# The same small module is used by viedoc-export, add-sites-and-users and import-helper, so that all three
+# tools profile with the same API: start_profile, stop_profile and profile_summary.
+
+
+def start_profile():
+    """
+    Starts cProfile for the current thread. Work in other threads is not profiled; the time the current
+    thread waits for it shows up in the waiting function (e.g. result or join).
+    Returns the profile, to pass to stop_profile.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop_profile(profile, prefix, top = 20):
+    """
+    Stops the profile and saves it as <prefix>.prof (readable with pstats or snakeviz), with the summary
+    from profile_summary as <prefix>_hotspots.txt. Returns the summary.
+    """
+    profile.disable()
+    if os.path.dirname(prefix):
+        os.makedirs(os.path.dirname(prefix), exist_ok = True)
+    profile.dump_stats(prefix + ".prof")
+    return profile_summary([prefix + ".prof"], prefix + "_hotspots.txt", top)
+
+
+def profile_summary(files, summaryfile = None, top = 20):
+    """
+    Returns the functions with the most own time and the most cumulative time in one or more saved
+    profiles, and saves them in summaryfile if given.
+    """
+    out = io.StringIO()
+    stats = pstats.Stats(*files, stream = out)
+    stats.sort_stats("tottime").print_stats(top)
+    stats.sort_stats("cumulative").print_stats(top)
+    if summaryfile is not None:
+        with open(summaryfile, "w") as f:
+            f.write(out.getvalue())
+    return out.getvalue()
@@ -0,0 +1,41 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from importHelper import configModel, writexml  # noqa: E402
+
+def _pars(path, mappingfiles):
+    return {"path": str(path), "mappingfiles": mappingfiles, "delimiter": ";", "server": "https://api/HelipadService.svc",
+        "GUID": "guid", "email": "a&b@example.com", "createSubj": "true", "initEvent": "false"}
+
+def _read(path):
+    return ET.parse(os.path.join(str(path), "config.xml")).getroot()
+
+def test_values_are_escaped(tmp_path):
+    writexml(_pars(tmp_path, ["AE.xml"]))
+    root = _read(tmp_path)
+    assert root.find("BasePath").text == str(tmp_path)
+    assert root.find("ImportConfiguration/UserName").text == "a&b@example.com"
+    assert root.find("ImportConfiguration/FolderName").text == "AE"
+
+def test_rewrite_replaces_the_file(tmp_path):
+    writexml(_pars(tmp_path, ["AE.xml", "DM.xml"]))
+    writexml(_pars(tmp_path, ["AE.xml", "DM.xml"]))
+    first = (tmp_path / "config.xml").read_bytes()
+    writexml(_pars(tmp_path, ["DM.xml"]))
+    assert [x.text for x in _read(tmp_path).iter("FolderName")] == ["DM"]
+    writexml(_pars(tmp_path, ["AE.xml", "DM.xml"]))
+    assert (tmp_path / "config.xml").read_bytes() == first
+    assert sorted(os.listdir(str(tmp_path))) == ["config.xml"]
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    writexml(_pars(tmp_path, ["AE.xml"]))
+    previous = (tmp_path / "config.xml").read_bytes()
+    model = configModel(_pars(tmp_path, ["DM.xml"]))
+    model["ImportConfigurations"][0].append(("Broken", 5))
+    with pytest.raises(Exception):
+        writexml(_pars(tmp_path, ["DM.xml"]), model)
+    assert (tmp_path / "config.xml").read_bytes() == previous
@@ -0,0 +1,123 @@
+import itertools  # For numbering the queued downloads
+import logging  # For logging information
+import os  # For file and directory operations
+import shutil  # For checking the free disk space
+import threading  # For the worker threads
+from concurrent.futures import Future  # For returning the result of a download
+
+class DownloadManager:
+    """
+    Runs downloads in worker threads, smallest first, within limits on bandwidth, connections and disk space.
+
+    A download is started when:
+    - the bytes in flight stay within max_bytes, or no other download is in progress (so a single large
+      export is never blocked),
+    - fewer than max_per_host downloads are in progress for the same host.
+    Downloads of unknown size are started after those of known size and are counted as max_bytes.
+    Before a download starts, the free space in its folder must be at least its size plus min_free_bytes.
+    """
+
+    def __init__(self, workers=2, max_bytes=2 * 1024**3, max_per_host=2, folder_path="out", min_free_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.max_per_host = max_per_host
+        self.folder_path = folder_path
+        self.min_free_bytes = min_free_bytes
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.bytes_in_flight = 0
+        self.host_downloads = {}
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, host, size, fn, *args, folder_path=None):
+        """
+        Queue a download.
+
+        Args:
+        - host (str): Host the download connects to, for the per-host limit.
+        - size (int): Size of the download in bytes, or None if unknown.
+        - fn (callable): Function performing the download, called with args.
+        - folder_path (str): Folder the download is written to, for the disk space check. Default is the
+          folder_path of the manager.
+
+        Returns:
+        - Future: Result of fn.
+        """
+        future = Future()
+        with self.condition:
+            # Unknown sizes are sorted after all known sizes
+            self.queue.append(((size is None, size or 0), next(self.counter), host, size, fn, args, folder_path or self.folder_path, future))
+            self.condition.notify_all()
+        return future
+
+    def _fits(self, host, size):
+        """
+        Check whether a download can start within the limits. Called with the condition held.
+        """
+        if self.host_downloads.get(host, 0) >= self.max_per_host:
+            return False
+        return self.bytes_in_flight == 0 or self.bytes_in_flight + (self.max_bytes if size is None else size) <= self.max_bytes
+
+    def _next(self):
+        """
+        Wait for the smallest queued download that fits, and reserve its share of the limits.
+        """
+        with self.condition:
+            while True:
+                for entry in sorted(self.queue):
+                    host, size = entry[2], entry[3]
+                    if self._fits(host, size):
+                        self.queue.remove(entry)
+                        self.bytes_in_flight += self.max_bytes if size is None else size
+                        self.host_downloads[host] = self.host_downloads.get(host, 0) + 1
+                        return entry
+                if self.closed and not self.queue:
+                    return None
+                self.condition.wait()
+
+    def _release(self, host, size):
+        with self.condition:
+            self.bytes_in_flight -= self.max_bytes if size is None else size
+            self.host_downloads[host] -= 1
+            self.condition.notify_all()
+
+    def _check_free_space(self, folder_path, size):
+        """
+        Raise an exception if there is not enough free disk space for a download of the given size.
+        """
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        free = shutil.disk_usage(folder_path).free
+        needed = (size or 0) + self.min_free_bytes
+        if free < needed:
+            raise Exception(f"Not enough free disk space in {folder_path}: {free} bytes free, {needed} bytes needed")
+
+    def _worker(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            _, _, host, size, fn, args, folder_path, future = entry
+            try:
+                if future.set_running_or_notify_cancel():
+                    self._check_free_space(folder_path, size)
+                    logging.info("Starting download from %s (%s bytes)", host, "unknown" if size is None else size)
+                    future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._release(host, size)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once all queued downloads are finished.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
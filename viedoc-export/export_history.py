@@ -0,0 +1,79 @@
+import argparse  # For parsing command-line arguments
+import json  # For storing the export model and file list
+import sqlite3  # For the local history database
+import time  # For the timestamps
+
+def open_history(db_path, api_url, study):
+    """
+    Open the export history in a local SQLite database, creating the table if needed.
+
+    The database may be shared with other studies and with the metadata store of add-sites-and-users;
+    all rows are keyed by API URL and study.
+
+    Args:
+    - db_path (str): Path to the SQLite file.
+    - api_url (str): Base API URL.
+    - study (str): Study key, e.g. the client ID, as each API client belongs to a single study.
+
+    Returns:
+    - dict: The history handle for record_export and list_exports.
+    """
+    db = sqlite3.connect(db_path, timeout=30)
+    db.execute("""CREATE TABLE IF NOT EXISTS exports (url TEXT, study TEXT, export_id TEXT, export_model TEXT,
+        status TEXT, started REAL, finished REAL, files TEXT, PRIMARY KEY (url, study, export_id))""")
+    db.execute("CREATE INDEX IF NOT EXISTS exports_started ON exports (url, study, started)")
+    db.commit()
+    return {"db": db, "url": api_url, "study": study}
+
+def record_export(history, export_id, status, export_model=None, files=None):
+    """
+    Record a started export, or update the status of a recorded one.
+
+    Args:
+    - history (dict): History handle from open_history, or None to record nothing.
+    - export_id (str): ID of the export.
+    - status (str): "Started", "Downloaded" or "Error".
+    - export_model (str): JSON string of the export model, recorded when the export is started.
+    - files (list): Paths of the downloaded files.
+    """
+    if history is None:
+        return
+    db = history["db"]
+    key = (history["url"], history["study"], export_id)
+    if status == "Started":
+        db.execute("INSERT OR REPLACE INTO exports (url, study, export_id, export_model, status, started) VALUES (?, ?, ?, ?, ?, ?)",
+            key + (export_model, status, time.time()))
+    else:
+        db.execute("UPDATE exports SET status = ?, finished = ?, files = ? WHERE url = ? AND study = ? AND export_id = ?",
+            (status, time.time(), None if files is None else json.dumps(files)) + key)
+    db.commit()
+
+def list_exports(history, limit=20):
+    """
+    Return the most recent exports of the study, newest first.
+
+    Returns:
+    - list: One dict per export, with the file list decoded.
+    """
+    cursor = history["db"].execute("""SELECT export_id, export_model, status, started, finished, files FROM exports
+        WHERE url = ? AND study = ? ORDER BY started DESC LIMIT ?""", (history["url"], history["study"], limit))
+    columns = [c[0] for c in cursor.description]
+    exports = [dict(zip(columns, row)) for row in cursor]
+    for export in exports:
+        export["files"] = json.loads(export["files"]) if export["files"] else []
+    return exports
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the export history of a study")
+
+    # Define command-line arguments
+    parser.add_argument("--history_db", required=True, help="SQLite file written with viedoc_export.py --history_db")
+    parser.add_argument("--api_url", required=True, help="API URL")
+    parser.add_argument("--client_id", required=True, help="Client ID")
+    parser.add_argument("--limit", required=False, default=20, type=int, help="Number of exports to show")
+
+    args = parser.parse_args()
+
+    for export in list_exports(open_history(args.history_db, args.api_url, args.client_id), args.limit):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(export["started"]))
+        print(f"{started}  {export['export_id']}  {export['status']:<10}  {len(export['files'])} files")
@@ -0,0 +1,242 @@
+import argparse  # For parsing command-line arguments
+import json  # For reading the study list and the state file
+import logging  # For logging information
+import os  # For file and directory operations
+import threading  # For protecting the shared state
+import time  # For the scheduling loop
+import requests  # For reusing HTTP connections
+import viedoc_export as ve  # Export, status and download functions
+from download_manager import DownloadManager  # For running downloads in the background
+
+# States of a study in the state file
+IDLE = "Idle"  # Waiting until the next export is due
+STARTED = "Started"  # Export started, waiting until it is ready
+DOWNLOADING = "Downloading"  # Export ready, download in progress
+ERROR = "Error"  # Last export failed, retried at the next due time
+
+def load_studies(path):
+    """
+    Load the study list.
+
+    Args:
+    - path (str): JSON file with a list of studies. Each study has a unique 'name', 'token_url', 'api_url',
+      'client_id', 'client_secret', 'export_model' (object or JSON string) and 'cadence_minutes'. Optional:
+      'output_path' (default out/<name>), 'extract_zip', 'remove_prefix' (default true), 'convert_parquet'
+      and 'dedup' (default false).
+
+    Returns:
+    - dict: Studies by name.
+    """
+    with open(path) as f:
+        studies = json.load(f)
+    result = {}
+    for study in studies:
+        if not isinstance(study["export_model"], str):
+            study["export_model"] = json.dumps(study["export_model"])
+        study.setdefault("output_path", os.path.join("out", study["name"]))
+        study.setdefault("extract_zip", True)
+        study.setdefault("remove_prefix", True)
+        study.setdefault("convert_parquet", False)
+        study.setdefault("dedup", False)
+        result[study["name"]] = study
+    return result
+
+def load_state(path):
+    """
+    Load the state file written by a previous run, or an empty state if there is none.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_state(path, state):
+    """
+    Write the state file, replacing the previous file in one step.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+class ExportScheduler:
+    """
+    Long-running scheduler that exports each study at its own cadence.
+
+    Sessions are kept per host and tokens are cached until shortly before they expire. At most
+    max_exports exports are in progress at the same time, of which at most max_downloads are downloading.
+    Ready exports are downloaded smallest first, within max_download_bytes in flight, max_per_host
+    connections per host and min_free_bytes of free disk space (see DownloadManager).
+    The state of each study is written to the state file, so that after a restart exports that were
+    already started are polled and downloaded instead of started again.
+    """
+
+    def __init__(self, studies, state_path, max_exports=4, max_downloads=2, poll_interval=10,
+            max_download_bytes=2 * 1024**3, max_per_host=2, min_free_bytes=1024**3):
+        self.studies = studies
+        self.state_path = state_path
+        self.state = load_state(state_path)
+        self.max_exports = max_exports
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()  # Reentrant, as token() calls session() while holding it
+        self.sessions = {}
+        self.tokens = {}
+        self.downloads = DownloadManager(max_downloads, max_download_bytes, max_per_host, min_free_bytes=min_free_bytes)
+        for name in studies:
+            self.state.setdefault(name, {"status": IDLE, "export_id": None, "next_due": 0, "last_poll": 0})
+
+    def session(self, url):
+        """
+        Return the session for the host of the URL, so that connections are reused.
+        """
+        host = requests.utils.urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = requests.Session()
+            return self.sessions[host]
+
+    def token(self, study):
+        """
+        Return a cached token for the study, requesting a new one if it expires within a minute.
+        The lock is held while a new token is requested, so that the download threads and the
+        polling loop do not request the same token at the same time.
+        """
+        key = (study["token_url"], study["client_id"])
+        with self.lock:
+            token, expires = self.tokens.get(key, (None, 0))
+            if time.time() > expires - 60:
+                response = ve.get_token_response(study["token_url"], study["client_id"], study["client_secret"], self.session(study["token_url"]))
+                token, expires = response["access_token"], time.time() + response.get("expires_in", 3600)
+                self.tokens[key] = (token, expires)
+            return token
+
+    def update(self, name, **values):
+        """
+        Update the state of a study and write the state file.
+        """
+        with self.lock:
+            self.state[name].update(values)
+            save_state(self.state_path, self.state)
+
+    def finish(self, name, status):
+        """
+        Mark the export of a study as finished and schedule the next one.
+        """
+        study = self.studies[name]
+        now = time.time()
+        values = {"status": status, "export_id": None, "next_due": now + study["cadence_minutes"] * 60}
+        if status == IDLE:
+            values["last_completed"] = now
+        self.update(name, **values)
+
+    def download(self, name):
+        """
+        Download the ready export of a study. Executed in the download pool.
+        """
+        study = self.studies[name]
+        export_id = self.state[name]["export_id"]
+        try:
+            dedup_manifest = os.path.join(study["output_path"], ".manifests", study["client_id"] + ".json") if study["dedup"] else None
+            files = ve.download_export(study["api_url"] + "/clinic/dataexport/download", self.token(study), export_id,
+                study["extract_zip"], study["remove_prefix"], dedup_manifest, study["output_path"], self.session(study["api_url"]))
+            if study["convert_parquet"]:
+                ve.convert_to_parquet(files, study["output_path"])
+            logging.info("%s: export %s downloaded", name, export_id)
+            self.finish(name, IDLE)
+        except Exception:
+            logging.exception("%s: download of export %s failed", name, export_id)
+            self.finish(name, ERROR)
+
+    def submit_download(self, name):
+        """
+        Queue the download of the ready export of a study, with its size if the server reports it.
+        """
+        study = self.studies[name]
+        url = study["api_url"] + "/clinic/dataexport/download"
+        try:
+            size = ve.get_export_size(url, self.token(study), self.state[name]["export_id"], self.session(url))
+        except Exception:
+            size = None
+        future = self.downloads.submit(requests.utils.urlparse(url).netloc, size, self.download, name, folder_path=study["output_path"])
+        future.add_done_callback(lambda f: self.download_done(name, f))
+
+    def download_done(self, name, future):
+        """
+        Reschedule a study whose download could not be started, e.g. because the disk is full.
+        Errors during the download itself are handled by download.
+        """
+        if future.exception() is not None and self.state[name]["status"] == DOWNLOADING:
+            logging.error("%s: download of export %s not started: %s", name, self.state[name]["export_id"], future.exception())
+            self.finish(name, ERROR)
+
+    def tick(self):
+        """
+        Poll the started exports and start the exports that are due, within the concurrency limit.
+        """
+        now = time.time()
+        for name, study in self.studies.items():
+            state = self.state[name]
+            if state["status"] == STARTED and now - state["last_poll"] >= self.poll_interval:
+                try:
+                    status = ve.get_export_status(study["api_url"] + "/clinic/dataexport/status", self.token(study), state["export_id"], self.session(study["api_url"]))
+                except Exception:
+                    logging.exception("%s: status check of export %s failed", name, state["export_id"])
+                    continue
+                logging.info("%s: export status %s", name, status)
+                if status == "Ready":
+                    self.update(name, status=DOWNLOADING, last_poll=now)
+                    self.submit_download(name)
+                elif status == "Error":
+                    logging.info("%s: export %s failed", name, state["export_id"])
+                    self.finish(name, ERROR)
+                else:
+                    self.update(name, last_poll=now)
+
+        in_progress = sum(1 for state in self.state.values() if state["status"] in (STARTED, DOWNLOADING))
+        due = sorted((state["next_due"], name) for name, state in self.state.items()
+            if name in self.studies and state["status"] in (IDLE, ERROR) and state["next_due"] <= now)
+        for next_due, name in due[:max(0, self.max_exports - in_progress)]:
+            study = self.studies[name]
+            try:
+                export_id = ve.start_export(study["api_url"] + "/clinic/dataexport/start", self.token(study), study["export_model"], self.session(study["api_url"]))
+            except Exception:
+                logging.exception("%s: starting the export failed", name)
+                self.finish(name, ERROR)
+                continue
+            logging.info("%s: export %s started", name, export_id)
+            self.update(name, status=STARTED, export_id=export_id, started=now, last_poll=now)
+
+    def run(self):
+        """
+        Run the scheduler until interrupted.
+        """
+        # Downloads that were interrupted by a restart are started again; the export itself is still available
+        for name, state in self.state.items():
+            if name in self.studies and state["status"] == DOWNLOADING:
+                logging.info("%s: resuming download of export %s", name, state["export_id"])
+                self.submit_download(name)
+            elif name in self.studies and state["status"] == STARTED:
+                logging.info("%s: resuming polling of export %s", name, state["export_id"])
+        try:
+            while True:
+                self.tick()
+                time.sleep(1)
+        finally:
+            self.downloads.shutdown(wait=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Viedoc export scheduler")
+
+    # Define command-line arguments
+    parser.add_argument("--studies", required=True, help="JSON file with the studies and their cadence")
+    parser.add_argument("--state_file", required=False, default="scheduler_state.json", help="State file, used to resume after a restart")
+    parser.add_argument("--max_exports", required=False, default=4, type=int, help="Maximum number of exports in progress at the same time")
+    parser.add_argument("--max_downloads", required=False, default=2, type=int, help="Maximum number of downloads at the same time")
+    parser.add_argument("--poll_interval", required=False, default=10, type=int, help="Seconds between status checks of an export")
+    parser.add_argument("--max_download_mb", required=False, default=2048, type=int, help="Maximum size in MB of the downloads in progress at the same time")
+    parser.add_argument("--max_per_host", required=False, default=2, type=int, help="Maximum number of downloads at the same time from one server")
+    parser.add_argument("--min_free_mb", required=False, default=1024, type=int, help="Free disk space in MB to keep after each download")
+
+    args = parser.parse_args()
+
+    ExportScheduler(load_studies(args.studies), args.state_file, args.max_exports, args.max_downloads, args.poll_interval,
+        args.max_download_mb * 1024**2, args.max_per_host, args.min_free_mb * 1024**2).run()
@@ -0,0 +1,49 @@
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from viedoc_export import extract_changed_members  # noqa: E402
+
+def _run(tmp_path, files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for name, content in files.items():
+            z.writestr("Study_" + name, content)
+    with zipfile.ZipFile(buf) as z:
+        return extract_changed_members(z, str(tmp_path / "out"), "Study", True, str(tmp_path / "manifest.json"))
+
+def _read(tmp_path, name):
+    with open(tmp_path / "out" / name) as f:
+        return f.read()
+
+def test_swapped_content(tmp_path):
+    _run(tmp_path, {"a": "one", "b": "two"})
+    _run(tmp_path, {"a": "two", "b": "one"})
+    assert _read(tmp_path, "a") == "two"
+    assert _read(tmp_path, "b") == "one"
+
+def test_new_file_with_previous_content(tmp_path):
+    _run(tmp_path, {"a": "one", "b": "two"})
+    _run(tmp_path, {"a": "two", "b": "one"})
+    changed = _run(tmp_path, {"a": "new", "c": "two"})
+    assert _read(tmp_path, "a") == "new"
+    assert _read(tmp_path, "c") == "two"
+    assert sorted(os.path.basename(p) for p in changed) == ["a", "c"]
+
+def test_unchanged_file_is_linked(tmp_path):
+    _run(tmp_path, {"a": "one"})
+    changed = _run(tmp_path, {"a": "one", "b": "one"})
+    assert [os.path.basename(p) for p in changed] == ["b"]
+    assert os.path.samefile(tmp_path / "out" / "a", tmp_path / "out" / "b")
+
+@pytest.mark.parametrize("name", ["../evil", "sub/../../evil", "/tmp/evil"])
+def test_unsafe_name_is_rejected(tmp_path, name):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr(name, "x")
+    with zipfile.ZipFile(buf) as z, pytest.raises(Exception, match="Unsafe"):
+        extract_changed_members(z, str(tmp_path / "out"), "Study", True, str(tmp_path / "manifest.json"))
@@ -0,0 +1,79 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from download_manager import DownloadManager  # noqa: E402
+
+class Tracker:
+    """
+    Download function that records the order in which downloads start and how many run at the same time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = []
+        self.active = 0
+        self.max_active = 0
+
+    def __call__(self, name, wait=None):
+        with self.lock:
+            self.order.append(name)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        if wait is not None:
+            wait()
+        with self.lock:
+            self.active -= 1
+        return name
+
+def _manager(tmp_path, **kwargs):
+    return DownloadManager(folder_path=str(tmp_path), min_free_bytes=0, **kwargs)
+
+def test_smallest_first_and_unknown_sizes_last(tmp_path):
+    tracker = Tracker()
+    started = threading.Event()
+    release = threading.Event()
+    manager = _manager(tmp_path, workers=1)
+    manager.submit("h", 1, tracker, "first", lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    futures = [manager.submit("h", size, tracker, name) for name, size in [("30", 30), ("unknown", None), ("10", 10), ("20", 20)]]
+    release.set()
+    manager.shutdown()
+    assert [future.result() for future in futures] == ["30", "unknown", "10", "20"]
+    assert tracker.order == ["first", "10", "20", "30", "unknown"]
+
+def test_bytes_in_flight_are_limited(tmp_path):
+    tracker = Tracker()
+    manager = _manager(tmp_path, workers=3, max_bytes=100, max_per_host=3)
+    futures = [manager.submit("h" + str(i), 60, tracker, i, lambda: threading.Event().wait(0.05)) for i in range(3)]
+    # A single download larger than max_bytes is still started
+    futures.append(manager.submit("h", 500, tracker, "large"))
+    manager.shutdown()
+    assert [future.result() for future in futures] == [0, 1, 2, "large"]
+    assert tracker.max_active == 1
+
+def test_downloads_per_host_are_limited(tmp_path):
+    tracker = Tracker()
+    manager = _manager(tmp_path, workers=3, max_per_host=1)
+    futures = [manager.submit("h", 1, tracker, i, lambda: threading.Event().wait(0.05)) for i in range(3)]
+    manager.shutdown()
+    assert [future.result() for future in futures] == [0, 1, 2]
+    assert tracker.max_active == 1
+
+def test_different_hosts_run_together(tmp_path):
+    barrier = threading.Barrier(2, timeout=5)
+    manager = _manager(tmp_path, workers=2, max_per_host=1)
+    futures = [manager.submit(host, 1, lambda: barrier.wait()) for host in ("a", "b")]
+    manager.shutdown()
+    assert sorted(future.result() for future in futures) == [0, 1]
+
+def test_not_enough_disk_space(tmp_path):
+    manager = DownloadManager(workers=1, folder_path=str(tmp_path), min_free_bytes=2**62)
+    called = []
+    future = manager.submit("h", 1, called.append, "x")
+    manager.shutdown()
+    with pytest.raises(Exception, match="Not enough free disk space"):
+        future.result()
+    assert called == []
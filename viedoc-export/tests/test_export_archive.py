@@ -0,0 +1,26 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from viedoc_export import ExportArchive  # noqa: E402
+
+def _archive(tmp_path, names):
+    path = str(tmp_path / "Study_20240101.zip")
+    with zipfile.ZipFile(path, "w") as z:
+        for name in names:
+            z.writestr(name, "a,b\n1,2\n")
+    return path
+
+def test_extract_member_in_subfolder(tmp_path):
+    with ExportArchive(_archive(tmp_path, ["Study_20240101_DM.csv", "Study_20240101_sub/AE.csv"])) as archive:
+        paths = archive.extract(folder_path=str(tmp_path / "out"))
+    assert sorted(os.path.relpath(p, tmp_path / "out") for p in paths) == ["DM.csv", os.path.join("sub", "AE.csv")]
+    assert os.path.isfile(tmp_path / "out" / "sub" / "AE.csv")
+
+def test_extract_rejects_unsafe_name(tmp_path):
+    with ExportArchive(_archive(tmp_path, ["../evil.csv"])) as archive, pytest.raises(Exception, match="Unsafe"):
+        archive.extract(folder_path=str(tmp_path / "out"))
+    assert not os.path.exists(tmp_path / "evil.csv")
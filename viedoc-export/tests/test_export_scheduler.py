@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import export_scheduler  # noqa: E402
+from export_scheduler import DOWNLOADING, IDLE, STARTED, ExportScheduler, save_state  # noqa: E402
+
+class Stop(Exception):
+    pass
+
+def _study(tmp_path, name):
+    return {"name": name, "token_url": "https://sts/token", "api_url": "https://api", "client_id": name, "client_secret": "s",
+        "export_model": "{}", "cadence_minutes": 60, "output_path": str(tmp_path / name), "extract_zip": True,
+        "remove_prefix": True, "convert_parquet": False, "dedup": False}
+
+def test_resume_downloads_and_polls_without_starting_again(tmp_path, monkeypatch):
+    studies = {name: _study(tmp_path, name) for name in ("A", "B")}
+    state_path = str(tmp_path / "state.json")
+    save_state(state_path, {"A": {"status": DOWNLOADING, "export_id": "a1", "next_due": 0, "last_poll": 0},
+        "B": {"status": STARTED, "export_id": "b1", "next_due": 0, "last_poll": 0}})
+
+    downloaded = []
+    def start_export(*args):
+        raise AssertionError("An export was started again")
+    monkeypatch.setattr(export_scheduler.ve, "get_token_response", lambda *args: {"access_token": "t", "expires_in": 3600})
+    monkeypatch.setattr(export_scheduler.ve, "start_export", start_export)
+    monkeypatch.setattr(export_scheduler.ve, "get_export_status", lambda url, token, export_id, session: "Ready")
+    monkeypatch.setattr(export_scheduler.ve, "get_export_size", lambda url, token, export_id, session: 10)
+    monkeypatch.setattr(export_scheduler.ve, "download_export", lambda url, token, export_id, *args: downloaded.append(export_id) or [])
+    # Stop the scheduler after its first tick; run() then waits for the queued downloads
+    def sleep(seconds):
+        raise Stop()
+    monkeypatch.setattr(time, "sleep", sleep)
+
+    scheduler = ExportScheduler(studies, state_path, poll_interval=0, min_free_bytes=0)
+    with pytest.raises(Stop):
+        scheduler.run()
+
+    assert sorted(downloaded) == ["a1", "b1"]
+    with open(state_path) as f:
+        state = json.load(f)
+    assert [state[name]["status"] for name in ("A", "B")] == [IDLE, IDLE]
+    assert all(state[name]["next_due"] > time.time() for name in ("A", "B"))
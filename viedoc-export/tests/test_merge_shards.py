@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from viedoc_export import _merge_csv, merge_shards  # noqa: E402
+
+def _shards(tmp_path, shards):
+    """
+    Write the files of each shard, a dict of name to content, and return the folders and paths for merge_shards.
+    """
+    folders, files = [], []
+    for i, shard in enumerate(shards):
+        folder = tmp_path / ".shards" / str(i)
+        folder.mkdir(parents=True)
+        for name, content in shard.items():
+            (folder / name).write_bytes(content)
+        folders.append(str(folder))
+        files.append([str(folder / name) for name in shard])
+    return folders, files
+
+def _read(tmp_path, name):
+    return (tmp_path / "out" / name).read_bytes()
+
+def test_site_shards_are_concatenated(tmp_path):
+    folders, files = _shards(tmp_path, [
+        {"AE.csv": b"\xef\xbb\xbfSite,Subject\r\nS1,1", "Meta.xml": b"<m/>"},
+        {"AE.csv": b"\xef\xbb\xbfSite,Subject\r\nS2,2\r\n", "Meta.xml": b"<m/>"}])
+    merged = merge_shards(folders, files, str(tmp_path / "out"), "site")
+    assert sorted(os.path.basename(x) for x in merged) == ["AE.csv", "Meta.xml"]
+    assert _read(tmp_path, "AE.csv") == b"\xef\xbb\xbfSite,Subject\r\nS1,1\r\nS2,2\r\n"
+    assert _read(tmp_path, "Meta.xml") == b"<m/>"
+
+def test_form_shards_write_study_rows_once(tmp_path):
+    folders, files = _shards(tmp_path, [
+        {"AE.csv": b"Subject,Term\n1,Headache\n", "VisitDates.csv": b"Subject,Visit\n1,V1\n2,V1\n"},
+        {"DM.csv": b"Subject,Sex\n1,F\n", "VisitDates.csv": b"Subject,Visit\n1,V1\n2,V1\n2,V2\n"}])
+    merge_shards(folders, files, str(tmp_path / "out"), "form")
+    assert _read(tmp_path, "AE.csv") == b"Subject,Term\n1,Headache\n"
+    assert _read(tmp_path, "DM.csv") == b"Subject,Sex\n1,F\n"
+    assert _read(tmp_path, "VisitDates.csv").splitlines() == [b"Subject,Visit", b"1,V1", b"2,V1", b"2,V2"]
+
+def test_other_differing_files_keep_the_first_shard(tmp_path):
+    folders, files = _shards(tmp_path, [{"Meta.xml": b"<a/>"}, {"Meta.xml": b"<b/>"}])
+    merge_shards(folders, files, str(tmp_path / "out"), "site")
+    assert _read(tmp_path, "Meta.xml") == b"<a/>"
+
+def test_merge_csv_aligns_columns(tmp_path):
+    (tmp_path / "a.csv").write_text("Subject,Term\n1,Headache\n")
+    (tmp_path / "b.csv").write_text("Subject,Grade,Term\n2,3,Nausea\n")
+    assert _merge_csv([str(tmp_path / "a.csv"), str(tmp_path / "b.csv")], str(tmp_path / "m.csv")) == 2
+    assert (tmp_path / "m.csv").read_text().splitlines() == ["Subject,Term,Grade", "1,Headache,", "2,Nausea,3"]
+    assert not (tmp_path / "m.csv.tmp").exists()
@@ -0,0 +1,19 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from viedoc_export import convert_to_parquet  # noqa: E402
+
+def test_parquet_manifest_keeps_unconverted_forms(tmp_path):
+    pytest.importorskip("pyarrow")
+    for form in ("AE", "DM"):
+        with open(tmp_path / (form + ".csv"), "w") as f:
+            f.write("a,b\n1,x\n")
+    convert_to_parquet([str(tmp_path / "AE.csv"), str(tmp_path / "DM.csv")], str(tmp_path))
+    converted = convert_to_parquet([str(tmp_path / "DM.csv")], str(tmp_path))
+    assert [entry["form"] for entry in converted] == ["DM"]
+    with open(tmp_path / "parquet" / "manifest.json") as f:
+        assert sorted(entry["form"] for entry in json.load(f)) == ["AE", "DM"]
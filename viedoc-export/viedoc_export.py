@@ -1,4 +1,5 @@
 import argparse  # For parsing command-line arguments
+import csv  # For merging CSV files with different columns
 import io  # For handling byte streams
 import zipfile  # For handling zip files
 import requests  # For making HTTP requests
@@ -6,11 +7,25 @@ import time  # For adding delays
 import re  # For regular expression operations
 import os  # For file and directory operations
 import logging  # For logging information
+import json  # For reading and writing manifests
+import hashlib  # For hashing extracted files
+import shutil  # For checking the free disk space and moving files
+import mmap  # For reading downloaded archives without extracting them
+from download_manager import DownloadManager  # For downloading several exports in parallel
+from export_history import open_history, record_export  # For the local export history
+from profiling import start_profile, stop_profile  # For profiling a run
+
+try:  # pyarrow is only needed for the optional Parquet conversion
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # Configure logging to display info messages with a specific format
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_token(url, client_id, client_secret):
+def get_token_response(url, client_id, client_secret, session=None):
     """
     Request an access token from the authentication server.
     
@@ -18,9 +33,10 @@ def get_token(url, client_id, client_secret):
     - url (str): URL to get the token from.
     - client_id (str): Client ID for authentication.
     - client_secret (str): Client secret for authentication.
+    - session (requests.Session): Optional session to reuse connections.
     
     Returns:
-    - str: Access token.
+    - dict: Token response, with the access token and its lifetime in seconds (expires_in).
     """
     logging.info("Getting token...")
     payload = {
@@ -28,11 +44,26 @@ def get_token(url, client_id, client_secret):
         "client_id": client_id,
         "client_secret": client_secret
     }
-    response = requests.post(url, data=payload)
+    response = (session or requests).post(url, data=payload)
     response.raise_for_status()  # Raise an exception for HTTP errors
-    return response.json()["access_token"]
+    return response.json()
 
-def start_export(url, token, export_model):
+def get_token(url, client_id, client_secret, session=None):
+    """
+    Request an access token from the authentication server.
+    
+    Args:
+    - url (str): URL to get the token from.
+    - client_id (str): Client ID for authentication.
+    - client_secret (str): Client secret for authentication.
+    - session (requests.Session): Optional session to reuse connections.
+    
+    Returns:
+    - str: Access token.
+    """
+    return get_token_response(url, client_id, client_secret, session)["access_token"]
+
+def start_export(url, token, export_model, session=None):
     """
     Start the export process.
 
@@ -40,13 +71,14 @@ def start_export(url, token, export_model):
     - url (str): URL to start the export.
     - token (str): Access token for authorization.
     - export_model (str): JSON string representing the export model.
+    - session (requests.Session): Optional session to reuse connections.
     
     Returns:
     - str: Export ID.
     """
     logging.info("Starting export...")
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=export_model)
+    response = (session or requests).post(url, headers=headers, data=export_model)
     
     if response.status_code > 399:
         logging.info("Error: %s", response.text)
@@ -54,7 +86,44 @@ def start_export(url, token, export_model):
     
     return response.json()["exportId"]
 
-def check_export_status(url, token, export_id):
+def get_export_status(url, token, export_id, session=None):
+    """
+    Check the status of the export once.
+
+    Args:
+    - url (str): URL to check the export status.
+    - token (str): Access token for authorization.
+    - export_id (str): ID of the export to check.
+    - session (requests.Session): Optional session to reuse connections.
+
+    Returns:
+    - str: Export status, e.g. "Ready" or "Error".
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    response = (session or requests).get(f"{url}?exportId={export_id}", headers=headers)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    return response.json()["exportStatus"]
+
+def get_export_size(url, token, export_id, session=None):
+    """
+    Get the size of a ready export from the Content-Length of the download, without downloading it.
+
+    Args:
+    - url (str): URL to download the export.
+    - token (str): Access token for authorization.
+    - export_id (str): ID of the export.
+    - session (requests.Session): Optional session to reuse connections.
+
+    Returns:
+    - int: Size in bytes, or None if the server does not report it.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    response = (session or requests).head(f"{url}?exportId={export_id}", headers=headers, allow_redirects=True)
+    if not response.ok or "Content-Length" not in response.headers:
+        return None
+    return int(response.headers["Content-Length"])
+
+def check_export_status(url, token, export_id, session=None):
     """
     Check the status of the export until it's ready.
 
@@ -62,13 +131,11 @@ def check_export_status(url, token, export_id):
     - url (str): URL to check the export status.
     - token (str): Access token for authorization.
     - export_id (str): ID of the export to check.
+    - session (requests.Session): Optional session to reuse connections.
     """
     logging.info("Checking export status...")
-    headers = {"Authorization": f"Bearer {token}"}
     while True:
-        response = requests.get(f"{url}?exportId={export_id}", headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        status = response.json()["exportStatus"]
+        status = get_export_status(url, token, export_id, session)
 
         logging.info("Export status: %s", status)
 
@@ -80,7 +147,97 @@ def check_export_status(url, token, export_id):
         logging.info("Sleeping...")
         time.sleep(10)  # Wait for 10 seconds before checking again
 
-def download_export(url, token, export_id, extract_zip, remove_prefix):
+def _hash_member(z, member):
+    """
+    Compute the SHA-256 of a zip member by streaming it, without writing it to disk.
+    """
+    sha = hashlib.sha256()
+    with z.open(member) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _safe_path(folder_path, name):
+    """
+    Return the path of a member in the output folder, rejecting absolute names and names
+    with '..' that would be written outside of it.
+    """
+    parts = re.split(r"[/\\]", name)
+    if os.path.isabs(name) or name.startswith(("/", "\\")) or re.match(r"^[A-Za-z]:", name) or ".." in parts:
+        raise Exception(f"Unsafe file name in export: {name}")
+    return os.path.join(folder_path, name)
+
+def extract_changed_members(z, folder_path, zip_filename_without_extension, remove_prefix, manifest_path):
+    """
+    Extract only the zip members whose content changed since the previous run.
+
+    Each member is hashed and compared against the manifest written by the previous run.
+    Unchanged files that are still on disk are skipped. Changed files whose content is
+    the same as an unchanged file, or as a file already written in this run, are
+    hardlinked to it instead of written again.
+
+    Args:
+    - z (ZipFile): Opened export archive.
+    - folder_path (str): Folder to extract to.
+    - zip_filename_without_extension (str): Prefix of the member names.
+    - remove_prefix (bool): Whether to remove the prefix from extracted files.
+    - manifest_path (str): Path of the per-study manifest (file name to SHA-256).
+
+    Returns:
+    - list: Paths of the new or changed files.
+    """
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+
+    # Hash all members first, so files are only linked to files whose content is known in this run
+    current = {}
+    members = {}
+    for member in z.namelist():
+        if member.endswith("/"):
+            continue
+        name = member
+        if remove_prefix and member.startswith(zip_filename_without_extension):
+            name = member[len(zip_filename_without_extension):].lstrip("_")
+        _safe_path(folder_path, name)
+        current[name] = _hash_member(z, member)
+        members[name] = member
+
+    # Files unchanged since the previous run are left untouched and can be linked to
+    unchanged = {name for name, digest in current.items()
+                 if previous.get(name) == digest and os.path.exists(_safe_path(folder_path, name))}
+    paths_by_hash = {current[name]: _safe_path(folder_path, name) for name in unchanged}
+
+    changed_files = []
+    for name, digest in current.items():
+        if name in unchanged:
+            continue
+        file_path = _safe_path(folder_path, name)
+        changed_files.append(file_path)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        if digest in paths_by_hash:
+            os.link(paths_by_hash[digest], file_path)  # Same content already on disk under another name
+        else:
+            with z.open(members[name]) as source, open(file_path, "wb") as target:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    target.write(chunk)
+            paths_by_hash[digest] = file_path
+
+    for name in previous.keys() - current.keys():
+        logging.info("File no longer in export: %s", name)
+
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(current, f, indent=2)
+    with open(os.path.join(folder_path, "changed_files.txt"), "w") as f:
+        f.writelines(file_path + "\n" for file_path in changed_files)
+    logging.info("%d of %d file(s) changed since the previous run", len(changed_files), len(current))
+    return changed_files
+
+def download_export(url, token, export_id, extract_zip, remove_prefix, dedup_manifest=None, folder_path="out", session=None):
     """
     Download the export file and optionally extract it.
 
@@ -90,34 +247,50 @@ def download_export(url, token, export_id, extract_zip, remove_prefix):
     - export_id (str): ID of the export to download.
     - extract_zip (bool): Whether to extract the zip file.
     - remove_prefix (bool): Whether to remove the prefix from extracted files.
+    - dedup_manifest (str): Optional path of a per-study manifest. If given, only files that
+      changed since the previous run are written, and they are listed in changed_files.txt.
+    - folder_path (str): Folder to save the export to.
+    - session (requests.Session): Optional session to reuse connections.
+
+    Returns:
+    - list: Paths of the extracted files, or of the saved file if not extracted.
+      With dedup_manifest, only the new or changed files.
     """
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{url}?exportId={export_id}", headers=headers)
+    response = (session or requests).get(f"{url}?exportId={export_id}", headers=headers)
     response.raise_for_status()  # Raise an exception for HTTP errors
 
     # Extract the filename from the Content-Disposition header
     content_disposition_header = response.headers.get("Content-Disposition")
     filename = re.search("filename=(.+)", content_disposition_header).group(1)
 
-    # Create the 'out' folder if it doesn't exist
-    if not os.path.exists("out"):
-        os.makedirs("out")
-
-    folder_path = "out"
+    # Create the output folder if it doesn't exist
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
 
     logging.info("Folder path: %s", folder_path)
 
     # If the filename is .zip and extract_zip is True, extract the file
     if filename.endswith(".zip") and extract_zip:
         logging.info("Extracting zip file...")
+        zip_filename_without_extension = os.path.splitext(filename)[0]
         with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+            # Check the free disk space before writing anything, so a full disk does not leave a partial export
+            extracted_size = sum(info.file_size for info in z.infolist())
+            free = shutil.disk_usage(folder_path).free
+            if free < extracted_size:
+                raise Exception(f"Not enough free disk space in {folder_path}: {free} bytes free, {extracted_size} bytes needed")
+            if dedup_manifest:
+                changed_files = extract_changed_members(z, folder_path, zip_filename_without_extension, remove_prefix, dedup_manifest)
+                logging.info("File extracted successfully!")
+                return changed_files
             z.extractall(folder_path)
+            extracted_files = z.namelist()
         logging.info("File extracted successfully!")
 
         # Remove the prefix from the extracted files if required
         if remove_prefix:
-            zip_filename_without_extension = os.path.splitext(filename)[0]
-            extracted_files = os.listdir(folder_path)
+            renamed_files = []
 
             for file in extracted_files:
                 if file.startswith(zip_filename_without_extension):
@@ -126,13 +299,544 @@ def download_export(url, token, export_id, extract_zip, remove_prefix):
                     if os.path.exists(new_file_path):
                         os.remove(new_file_path)
                     os.rename(os.path.join(folder_path, file), new_file_path)
-        return
+                    renamed_files.append(new_filename)
+                else:
+                    renamed_files.append(file)
+            extracted_files = renamed_files
+        return [os.path.join(folder_path, file) for file in extracted_files]
     else:
         # Save the file to out/filename
         with open(os.path.join(folder_path, filename), "wb") as f:
             f.write(response.content)
+        return [os.path.join(folder_path, filename)]
+
+class _MappedFile(mmap.mmap):
+    """
+    Memory map usable as a file by zipfile, which requires seekable() (only built in from Python 3.13).
+    """
+    def seekable(self):
+        return True
+
+class ExportArchive:
+    """
+    Read-only handle to a downloaded export archive, without extracting it to disk.
+
+    The archive file is memory-mapped, so members are decompressed straight from the page cache
+    when they are read. Members can be addressed by their name in the archive or, if remove_prefix
+    is set, by the name without the export prefix (as the files are named when extracted).
+    Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, path, remove_prefix=True):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = _MappedFile(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._zip = zipfile.ZipFile(self._map)
+        prefix = os.path.splitext(os.path.basename(path))[0]
+        self._names = {}
+        for member in self._zip.namelist():
+            if member.endswith("/"):
+                continue
+            name = member[len(prefix):].lstrip("_") if remove_prefix and member.startswith(prefix) else member
+            self._names[name] = member
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def members(self):
+        """
+        Return the member names, with the prefix removed if remove_prefix is set.
+        """
+        return list(self._names)
+
+    def _member(self, name):
+        return self._names.get(name, name)
+
+    def size(self, name):
+        """
+        Return the uncompressed size of a member in bytes.
+        """
+        return self._zip.getinfo(self._member(name)).file_size
+
+    def open(self, name):
+        """
+        Open a member as a binary file object, decompressed while it is read.
+        """
+        return self._zip.open(self._member(name))
+
+    def read_dataframe(self, name, **kwargs):
+        """
+        Load a CSV member into a pandas DataFrame. Keyword arguments are passed to pandas.read_csv.
+        """
+        import pandas as pd  # pandas is only needed for this method
+        with self.open(name) as f:
+            return pd.read_csv(f, **kwargs)
+
+    def extract(self, names=None, folder_path="out"):
+        """
+        Extract members to disk, under the names returned by members(). Members in a subfolder are
+        extracted into that subfolder; names that are absolute or contain '..' are rejected.
+
+        Args:
+        - names (list): Members to extract. Default is all members.
+        - folder_path (str): Folder to extract to.
+
+        Returns:
+        - list: Paths of the extracted files.
+        """
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        paths = []
+        for name in names or self.members():
+            path = _safe_path(folder_path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.open(name) as source, open(path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        self._zip.close()
+        self._map.close()
+        self._file.close()
+
+def download_export_archive(url, token, export_id, remove_prefix=True, folder_path="out", session=None):
+    """
+    Download the export archive to disk without extracting it, and return a handle to read its members.
+
+    Args:
+    - url (str): URL to download the export.
+    - token (str): Access token for authorization.
+    - export_id (str): ID of the export to download.
+    - remove_prefix (bool): Whether members are addressed without the export prefix.
+    - folder_path (str): Folder to save the archive to.
+    - session (requests.Session): Optional session to reuse connections.
+
+    Returns:
+    - ExportArchive: Handle to the downloaded archive.
+
+    Example:
+    with download_export_archive(download_url, token, export_id) as archive:
+        for name in archive:
+            df = archive.read_dataframe(name)
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    with (session or requests).get(f"{url}?exportId={export_id}", headers=headers, stream=True) as response:
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        filename = re.search("filename=(.+)", response.headers.get("Content-Disposition")).group(1)
+        if not filename.endswith(".zip"):
+            raise Exception(f"Export {filename} is not a zip archive")
+
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        path = os.path.join(folder_path, filename)
+
+        # Stream the archive to disk, so it is never held in memory as a whole
+        with open(path + ".tmp", "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    os.replace(path + ".tmp", path)
+    logging.info("Archive saved: %s", path)
+    return ExportArchive(path, remove_prefix)
 
-def main(token_url, api_url, client_id, client_secret, export_model, extract_zip, remove_prefix):
+def _arrow_type(type_name):
+    """
+    Map a cached type name back to a pyarrow type, falling back to string.
+    """
+    try:
+        return pa.type_for_alias(type_name)
+    except (ValueError, KeyError):
+        return pa.string()
+
+def _stream_csv_to_parquet(csv_path, parquet_path, column_types):
+    """
+    Stream one CSV file into a Parquet file, one record batch at a time.
+
+    Args:
+    - csv_path (str): Path of the CSV file to read.
+    - parquet_path (str): Path of the Parquet file to write.
+    - column_types (dict): Column name to pyarrow type, applied while parsing.
+
+    Returns:
+    - tuple: [0] Schema of the written file, [1] number of rows written.
+    """
+    convert_options = pacsv.ConvertOptions(column_types=column_types)
+    reader = pacsv.open_csv(csv_path, convert_options=convert_options)
+    temp_path = parquet_path + ".tmp"
+    rows = 0
+    with pq.ParquetWriter(temp_path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    reader.close()
+    os.replace(temp_path, parquet_path)  # Only replace the previous file once fully written
+    return reader.schema, rows
+
+def convert_to_parquet(files, folder_path="out"):
+    """
+    Convert extracted CSV files to Parquet, with a manifest of the converted forms.
+
+    Column types are inferred the first time a form is converted and cached in
+    parquet/schemas.json, so later runs parse each form with the same types. The entries
+    of the converted forms are merged into parquet/manifest.json, so forms that were not
+    converted in this run (e.g. unchanged with dedup) keep their entries.
+
+    Args:
+    - files (list): Paths of the downloaded files; files other than CSV are ignored.
+    - folder_path (str): Output folder; Parquet files are written to its 'parquet' subfolder.
+
+    Returns:
+    - list: Manifest entries, one per converted form.
+    """
+    if pa is None:
+        raise Exception("Parquet conversion requires pyarrow (pip install pyarrow)")
+
+    parquet_folder = os.path.join(folder_path, "parquet")
+    if not os.path.exists(parquet_folder):
+        os.makedirs(parquet_folder)
+
+    schema_cache_path = os.path.join(parquet_folder, "schemas.json")
+    schema_cache = {}
+    if os.path.exists(schema_cache_path):
+        with open(schema_cache_path) as f:
+            schema_cache = json.load(f)
+
+    manifest = []
+    for csv_path in files:
+        if not csv_path.lower().endswith(".csv"):
+            continue
+        form = os.path.splitext(os.path.basename(csv_path))[0]
+        parquet_path = os.path.join(parquet_folder, form + ".parquet")
+        logging.info("Converting %s to Parquet...", csv_path)
+
+        # Use the cached types if the header still matches, otherwise infer them from the first block
+        header_reader = pacsv.open_csv(csv_path)
+        header = header_reader.schema
+        header_reader.close()
+        cached = schema_cache.get(form)
+        if cached is not None and list(cached.keys()) == header.names:
+            column_types = {name: _arrow_type(type_name) for name, type_name in cached.items()}
+        else:
+            # Columns that are empty in the first block are inferred as null; read them as text
+            column_types = {field.name: pa.string() if pa.types.is_null(field.type) else field.type for field in header}
+
+        try:
+            schema, rows = _stream_csv_to_parquet(csv_path, parquet_path, column_types)
+        except pa.ArrowInvalid:
+            # A later block did not fit the inferred types; read every column as text instead
+            logging.info("Inferred types do not fit all rows of %s, converting as text", form)
+            column_types = {name: pa.string() for name in header.names}
+            schema, rows = _stream_csv_to_parquet(csv_path, parquet_path, column_types)
+
+        schema_cache[form] = {field.name: str(field.type) for field in schema}
+        manifest.append({
+            "form": form,
+            "csv": csv_path,
+            "parquet": parquet_path,
+            "rows": rows,
+            "columns": schema.names,
+            "csv_bytes": os.path.getsize(csv_path),
+            "parquet_bytes": os.path.getsize(parquet_path)
+        })
+
+    with open(schema_cache_path, "w") as f:
+        json.dump(schema_cache, f, indent=2)
+
+    # Keep the entries of forms converted by previous runs whose Parquet file still exists
+    manifest_path = os.path.join(parquet_folder, "manifest.json")
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            entries = {entry["form"]: entry for entry in json.load(f) if os.path.exists(entry["parquet"])}
+    entries.update((entry["form"], entry) for entry in manifest)
+    with open(manifest_path, "w") as f:
+        json.dump(list(entries.values()), f, indent=2)
+    logging.info("Converted %d file(s) to Parquet in %s", len(manifest), parquet_folder)
+    return manifest
+
+def export_folder_names(export_models):
+    """
+    Name the output subfolder of each export model after its output format, numbering repeated formats.
+
+    Args:
+    - export_models (list): JSON strings representing the export models.
+
+    Returns:
+    - list: Subfolder name per export model, e.g. ["csv", "excel", "odm"].
+    """
+    formats = [str(json.loads(model).get("outputFormat", "export")).lower() for model in export_models]
+    return [name if formats.count(name) == 1 else f"{name}_{formats[:i].count(name) + 1}" for i, name in enumerate(formats)]
+
+def run_exports(api_url, token, export_models, extract_zip, remove_prefix, folder_path="out", dedup_prefix=None, convert_parquet=False, poll_interval=10, history=None):
+    """
+    Run several exports of the same study at once: start all, check their status in one loop and
+    download each as soon as it is ready, in parallel, into a subfolder per output format.
+
+    Args:
+    - api_url (str): Base API URL.
+    - token (str): Access token for authorization.
+    - export_models (list): JSON strings representing the export models.
+    - extract_zip (bool): Whether to extract the zip files.
+    - remove_prefix (bool): Whether to remove the prefix from extracted files.
+    - folder_path (str): Folder in which the subfolders are created.
+    - dedup_prefix (str): Optional manifest path prefix; if given, each subfolder uses its own manifest
+      <dedup_prefix>_<subfolder>.json (see download_export).
+    - convert_parquet (bool): Whether to convert the extracted CSV files to Parquet.
+    - poll_interval (int): Seconds between status checks.
+    - history (dict): Optional export history from open_history, in which each export is recorded.
+
+    Returns:
+    - dict: Downloaded file paths per subfolder.
+    """
+    session = requests.Session()
+    folders = export_folder_names(export_models)
+    download_url = api_url + "/clinic/dataexport/download"
+
+    # Start all exports before checking any status, so the server prepares them at the same time
+    pending = {}
+    export_ids = {}
+    for folder, export_model in zip(folders, export_models):
+        export_id = start_export(api_url + "/clinic/dataexport/start", token, export_model, session)
+        logging.info("Export ID (%s): %s", folder, export_id)
+        record_export(history, export_id, "Started", export_model)
+        pending[folder] = export_ids[folder] = export_id
+
+    downloads = DownloadManager(workers=len(export_models), folder_path=folder_path, min_free_bytes=0)
+    futures = {}
+    failed = []
+    try:
+        while pending:
+            for folder, export_id in list(pending.items()):
+                status = get_export_status(api_url + "/clinic/dataexport/status", token, export_id, session)
+                logging.info("Export status (%s): %s", folder, status)
+                if status == "Error":
+                    record_export(history, export_id, "Error")
+                    failed.append(folder)
+                    del pending[folder]
+                elif status == "Ready":
+                    size = get_export_size(download_url, token, export_id, session)
+                    subfolder = os.path.join(folder_path, folder)
+                    dedup_manifest = f"{dedup_prefix}_{folder}.json" if dedup_prefix else None
+                    futures[folder] = downloads.submit(requests.utils.urlparse(download_url).netloc, size, download_export,
+                        download_url, token, export_id, extract_zip, remove_prefix, dedup_manifest, subfolder, session, folder_path=subfolder)
+                    del pending[folder]
+            if pending:
+                logging.info("Sleeping...")
+                time.sleep(poll_interval)
+    finally:
+        downloads.shutdown(wait=True)
+
+    files = {}
+    for folder, future in futures.items():
+        try:
+            files[folder] = future.result()
+        except Exception:
+            logging.exception("Download of the %s export failed", folder)
+            record_export(history, export_ids[folder], "Error")
+            failed.append(folder)
+            continue
+        record_export(history, export_ids[folder], "Downloaded", files=files[folder])
+        if convert_parquet:
+            convert_to_parquet(files[folder], os.path.join(folder_path, folder))
+    if failed:
+        raise Exception("Export failed: " + ", ".join(failed))
+    return files
+
+def shard_export_models(export_model, shard_by, ids, shards):
+    """
+    Split an export model into shard export models, each limited to a group of sites or forms.
+
+    Args:
+    - export_model (str): JSON string representing the export model.
+    - shard_by (str): "site" to filter the shards on siteIds, "form" to filter them on formDefIds.
+    - ids (list): Site IDs or form IDs of the study, divided over the shards in the given order.
+    - shards (int): Number of shards; fewer if there are fewer ids.
+
+    Returns:
+    - list: JSON strings of the shard export models.
+    """
+    key = {"site": "siteIds", "form": "formDefIds"}[shard_by]
+    model = json.loads(export_model)
+    if model.get(key):
+        logging.warning("%s of the export model are replaced by the shard ids", key)
+    shards = max(1, min(shards, len(ids)))
+    size, extra = divmod(len(ids), shards)
+    shard_models = []
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < extra else 0)
+        shard_models.append(json.dumps({**model, key: list(ids[start:end])}))
+        start = end
+    return shard_models
+
+def _hash_file(path):
+    """
+    Compute the SHA-256 of a file by streaming it.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _merge_csv(paths, target_path, dedupe=False):
+    """
+    Merge CSV files into one, with the header once and the rows of each file in the given order.
+
+    Files with the same header are appended as bytes, without parsing them. Otherwise the columns are
+    aligned by name, in the order in which they first occur, and missing values are left empty.
+
+    Args:
+    - paths (list): CSV files to merge.
+    - target_path (str): Merged file.
+    - dedupe (bool): Whether to write a row only once if it occurs in several files, for files that
+      are not split by the shard key and therefore repeat the same rows in each shard.
+
+    Returns:
+    - int: Number of files merged.
+    """
+    headers = []
+    for path in paths:
+        with open(path, "rb") as f:
+            headers.append(f.readline().lstrip(b"\xef\xbb\xbf"))
+    temp_path = target_path + ".tmp"
+    if not dedupe and all(header == headers[0] for header in headers):
+        newline = headers[0][len(headers[0].rstrip(b"\r\n")):] or b"\n"
+        with open(temp_path, "wb") as out:
+            for i, path in enumerate(paths):
+                with open(path, "rb") as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+                    # Make sure the rows of the next file start on a new line
+                    if f.tell() > len(header):
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            out.write(newline)
+    else:
+        if any(header != headers[0] for header in headers):
+            logging.info("Columns differ between shards, aligning them by name: %s", os.path.basename(target_path))
+        columns = []
+        for path in paths:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                for column in next(csv.reader(f), []):
+                    if column not in columns:
+                        columns.append(column)
+        seen = set()
+        duplicates = 0
+        with open(temp_path, "w", newline="", encoding="utf-8") as out:
+            writer = csv.DictWriter(out, columns, restval="")
+            writer.writeheader()
+            for path in paths:
+                with open(path, newline="", encoding="utf-8-sig") as f:
+                    for row in csv.DictReader(f):
+                        if dedupe:
+                            key = tuple(row.get(column) or "" for column in columns)
+                            if key in seen:
+                                duplicates += 1
+                                continue
+                            seen.add(key)
+                        writer.writerow(row)
+        if duplicates:
+            logging.info("Skipped %s rows repeated between shards: %s", duplicates, os.path.basename(target_path))
+    os.replace(temp_path, target_path)  # Only replace the previous file once fully written
+    return len(paths)
+
+def merge_shards(shard_folders, shard_files, folder_path="out", shard_by=None):
+    """
+    Merge the extracted files of shard exports into one output folder.
+
+    Files that are the same in every shard in which they occur, such as the study metadata, are written
+    once, and so are files that occur in a single shard, such as the data of a form in a form shard.
+    CSV files that are split by the shard key, which are all data files of site shards, are concatenated:
+    the header once, then the rows of each shard in shard order. Other CSV files that differ, such as the
+    visit dates or subject status in form shards, repeat rows of the whole study in each shard, so each row
+    is written once. Other files that differ are taken from the first shard.
+
+    Args:
+    - shard_folders (list): Folders the shards were extracted to, in shard order.
+    - shard_files (list): Per shard, the paths of the extracted files.
+    - folder_path (str): Output folder of the merged files.
+    - shard_by (str): "site" or "form", the key the shards were split by (see shard_export_models).
+      If not given, no file is assumed to be split, and repeated rows are written once.
+
+    Returns:
+    - list: Paths of the merged files.
+    """
+    paths = {}
+    for shard_folder, files in zip(shard_folders, shard_files):
+        for path in files:
+            paths.setdefault(os.path.relpath(path, shard_folder), []).append(path)
+
+    merged_files = []
+    for name, shard_paths in paths.items():
+        target_path = os.path.join(folder_path, name)
+        if os.path.dirname(target_path) and not os.path.exists(os.path.dirname(target_path)):
+            os.makedirs(os.path.dirname(target_path))
+        if len(shard_paths) == 1 or len({_hash_file(path) for path in shard_paths}) == 1:
+            os.replace(shard_paths[0], target_path)
+        elif name.lower().endswith(".csv") and shard_by == "site":
+            _merge_csv(shard_paths, target_path)
+        elif name.lower().endswith(".csv"):
+            logging.warning("%s differs between shards but is not split by %s, writing each row once", name, shard_by or "the shard key")
+            _merge_csv(shard_paths, target_path, dedupe=True)
+        else:
+            logging.warning("%s differs between shards, keeping the first shard's file", name)
+            os.replace(shard_paths[0], target_path)
+        merged_files.append(target_path)
+    return merged_files
+
+def run_sharded_export(api_url, token, export_model, shard_by, ids, shards, folder_path="out", convert_parquet=False, poll_interval=10, history=None):
+    """
+    Export a large study as several smaller exports, one per group of sites or forms, and merge them.
+
+    The shards are started at once, checked in one status loop and downloaded in parallel (see run_exports)
+    into folder_path/.shards, then merged per file into folder_path (see merge_shards). If any shard
+    fails, nothing is merged, so the output is never partial. The extracted files have no prefix.
+
+    Args:
+    - api_url (str): Base API URL.
+    - token (str): Access token for authorization.
+    - export_model (str): JSON string representing the export model; outputFormat must be CSV.
+    - shard_by (str): "site" or "form" (see shard_export_models).
+    - ids (list): Site IDs or form IDs to divide over the shards.
+    - shards (int): Number of shards.
+    - folder_path (str): Output folder.
+    - convert_parquet (bool): Whether to convert the merged CSV files to Parquet.
+    - poll_interval (int): Seconds between status checks.
+    - history (dict): Optional export history from open_history, in which each shard is recorded.
+
+    Returns:
+    - list: Paths of the merged files.
+    """
+    if str(json.loads(export_model).get("outputFormat", "")).upper() != "CSV":
+        raise Exception("Sharded exports can only be merged with outputFormat CSV")
+    shard_models = shard_export_models(export_model, shard_by, ids, shards)
+    logging.info("Exporting %s shards by %s", len(shard_models), shard_by)
+
+    shards_path = os.path.join(folder_path, ".shards")
+    if os.path.exists(shards_path):
+        shutil.rmtree(shards_path)
+    files = run_exports(api_url, token, shard_models, True, True, shards_path, poll_interval=poll_interval, history=history)
+
+    folders = export_folder_names(shard_models)
+    shard_folders = [os.path.join(shards_path, folder) for folder in folders]
+    merged_files = merge_shards(shard_folders, [files[folder] for folder in folders], folder_path, shard_by)
+    shutil.rmtree(shards_path)
+    logging.info("Merged %s shards into %s files", len(shard_models), len(merged_files))
+
+    if convert_parquet:
+        convert_to_parquet(merged_files, folder_path)
+    return merged_files
+
+def main(token_url, api_url, client_id, client_secret, export_model, extract_zip, remove_prefix, convert_parquet=False, dedup=False, history_db=None, shard_by=None, shard_ids=None, shards=4):
     """
     Main function to execute the export process.
 
@@ -141,9 +845,18 @@ def main(token_url, api_url, client_id, client_secret, export_model, extract_zip
     - api_url (str): Base API URL.
     - client_id (str): Client ID for authentication.
     - client_secret (str): Client secret for authentication.
-    - export_model (str): JSON string representing the export model.
+    - export_model (str or list): JSON string representing the export model. With a list of export models,
+      all are run at once and downloaded into a subfolder of "out" per output format (see run_exports).
     - extract_zip (bool): Whether to extract the zip file.
     - remove_prefix (bool): Whether to remove the prefix from extracted files.
+    - convert_parquet (bool): Whether to convert the extracted CSV files to Parquet.
+    - dedup (bool): Whether to only write extracted files that changed since the previous run.
+    - history_db (str): Optional SQLite file in which the exports are recorded, keyed by API URL and client ID
+      (see export_history.py).
+    - shard_by (str): Optional "site" or "form" to export a large study as several shards, started and
+      downloaded in parallel and merged into "out" (see run_sharded_export).
+    - shard_ids (list): Site IDs or form IDs to divide over the shards.
+    - shards (int): Number of shards.
     
     Example export mode:
     {"outputFormat":"CSV","includeVisitDates":true,"includeEditStatus":true,"includeSignatures":true,"includeReviewStatus":true,"includeSdv":true,"includeQueries":true,"includeQueryHistory":true,"includeSubjectStatus":true,"includePendingForms":true}"
@@ -166,16 +879,50 @@ def main(token_url, api_url, client_id, client_secret, export_model, extract_zip
     
     # Get the access token
     token = get_token(token_url, client_id, client_secret)
+    history = open_history(history_db, api_url, client_id) if history_db else None
+
+    # Split a large export into shards by site or form, and merge them
+    if shard_by:
+        if isinstance(export_model, list):
+            if len(export_model) > 1:
+                raise Exception("Sharded exports take a single export model")
+            export_model = export_model[0]
+        if not shard_ids:
+            raise Exception("Sharded exports need the site or form IDs to shard by")
+        if dedup:
+            logging.warning("Deduplication is not applied to sharded exports")
+        run_sharded_export(api_url, token, export_model, shard_by, shard_ids, shards, "out", convert_parquet, history=history)
+        return
+
+    # Run several export models together, with one token and one status loop
+    if isinstance(export_model, list) and len(export_model) > 1:
+        dedup_prefix = os.path.join("out", ".manifests", client_id) if dedup else None
+        run_exports(api_url, token, export_model, extract_zip, remove_prefix, "out", dedup_prefix, convert_parquet, history=history)
+        return
+    if isinstance(export_model, list):
+        export_model = export_model[0]
 
     # Start the export process
     export_id = start_export(start_export_url, token, export_model)
     logging.info("Export ID: %s", export_id)
+    record_export(history, export_id, "Started", export_model)
 
-    # Check the export status until it's ready
-    check_export_status(check_status_url, token, export_id)
-    
-    # Download the export file
-    download_export(download_url, token, export_id, extract_zip, remove_prefix)
+    try:
+        # Check the export status until it's ready
+        check_export_status(check_status_url, token, export_id)
+        
+        # Download the export file
+        # One manifest per API client, as each client belongs to a single study
+        dedup_manifest = os.path.join("out", ".manifests", client_id + ".json") if dedup else None
+        files = download_export(download_url, token, export_id, extract_zip, remove_prefix, dedup_manifest)
+    except Exception:
+        record_export(history, export_id, "Error")
+        raise
+    record_export(history, export_id, "Downloaded", files=files)
+
+    # Convert the extracted CSV files to Parquet if required
+    if convert_parquet:
+        convert_to_parquet(files)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Viedoc export script")
@@ -185,11 +932,24 @@ if __name__ == "__main__":
     parser.add_argument("--api_url", required=True, help="API URL")
     parser.add_argument("--client_id", required=True, help="Client ID")
     parser.add_argument("--client_secret", required=True, help="Client secret")
-    parser.add_argument("--export_model", required=True, help="Export model")
+    parser.add_argument("--export_model", required=True, nargs="+", help="Export model; several models are run at once, each into a subfolder per output format")
     parser.add_argument("--extract_zip", required=False, default="Y", choices=["Y", "N"], help="Extract zip file (Y/N)")
     parser.add_argument("--remove_prefix", required=False, default="Y", choices=["Y", "N"], help="Remove prefix from extracted files (Y/N)")
+    parser.add_argument("--convert_parquet", required=False, default="N", choices=["Y", "N"], help="Convert extracted CSV files to Parquet (Y/N)")
+    parser.add_argument("--dedup", required=False, default="N", choices=["Y", "N"], help="Only write extracted files that changed since the previous run (Y/N)")
+    parser.add_argument("--history_db", required=False, help="SQLite file in which the exports are recorded")
+    parser.add_argument("--shard_by", required=False, choices=["site", "form"], help="Split the export into shards by site or form, and merge them")
+    parser.add_argument("--shard_ids", required=False, nargs="+", help="Site IDs or form IDs to divide over the shards")
+    parser.add_argument("--shards", required=False, default=4, type=int, help="Number of shards")
+    parser.add_argument("--profile", required=False, default="N", choices=["Y", "N"], help="Profile the run and summarize the hotspots (Y/N)")
 
     args = parser.parse_args()
 
-    # Call the main function with parsed arguments
-    main(args.token_url, args.api_url, args.client_id, args.client_secret, args.export_model, args.extract_zip == "Y", args.remove_prefix == "Y")
+    # Profile the run if required; the results are written to the output folder
+    profile = start_profile() if args.profile == "Y" else None
+    try:
+        # Call the main function with parsed arguments
+        main(args.token_url, args.api_url, args.client_id, args.client_secret, args.export_model, args.extract_zip == "Y", args.remove_prefix == "Y", args.convert_parquet == "Y", args.dedup == "Y", args.history_db, args.shard_by, args.shard_ids, args.shards)
+    finally:
+        if profile is not None:
+            logging.info("Profile saved to out/profile.prof and out/profile_hotspots.txt\n%s", stop_profile(profile, os.path.join("out", "profile")))